@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from blog.common.setting import Setting
+
+
+class Command(BaseCommand):
+    help = 'Make every worker reload the server settings, run it after editing them without model saves'
+
+    def handle(self, *args, **options):
+        Setting.update_version()
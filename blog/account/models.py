@@ -1,4 +1,5 @@
 from django.db import models
+from django.dispatch import receiver
 
 
 class ServerSetting(models.Model):
@@ -7,3 +8,12 @@ class ServerSetting(models.Model):
 
     class Meta:
         db_table = 'server_setting'
+
+
+# workers reload the settings when the version is bumped, queryset update() and bulk_create()
+# as well as raw SQL send no signals and need the reload_setting command afterwards
+@receiver(models.signals.post_save, sender=ServerSetting, dispatch_uid='models.server_setting_save')
+@receiver(models.signals.post_delete, sender=ServerSetting, dispatch_uid='models.server_setting_delete')
+def server_setting_change(sender, instance, **kwargs):
+    from blog.common.setting import Setting
+    Setting.update_version()
@@ -77,6 +77,7 @@ class RoleService(Service):
                                    default=default)
         role_dict = model_to_dict(role)
         role_dict['permissions'] = RoleService._permission_create(role=role, **kwargs)
+        Grant().load_permission(role=role)
         return 201, role_dict
 
     def update(self, role_id, name=None, nick=None, role_level=None,
@@ -120,6 +121,7 @@ class RoleService(Service):
                 else:
                     raise ServiceError(code=403, message=AccountErrorMsg.NO_DEFAULT_ROLE)
             role.delete()
+            Grant().remove_permission(role_id=delete_id)
         except Role.DoesNotExist:
             result['status'] = 'NOT_FOUND'
         return result
@@ -10,7 +10,7 @@ from blog.account.roles.models import Role
 from blog.account.groups.models import Group
 from blog.content.albums.models import Album
 from blog.content.photos.models import Photo
-from blog.common.utils import paging, str_to_list, model_to_dict, encode
+from blog.common.utils import paging, cursor_paging, str_to_list, model_to_dict, encode
 from blog.common.base import Authorize, Service
 from blog.common.error import ServiceError
 from blog.common.message import ErrorMsg, AccountErrorMsg
@@ -57,7 +57,7 @@ class UserService(Service):
         return 200, user_dict
 
     def list(self, page=0, page_size=10, order_field=None, order='desc',
-             query=None, query_field=None):
+             query=None, query_field=None, cursor=None):
         query_level, order_level = self.get_permission_level(PermissionName.USER_SELECT)
         privacy_level, _ = self.get_permission_level(PermissionName.USER_PRIVACY, False)
         _, cancel_level = self.get_permission_level(PermissionName.USER_CANCEL, False)
@@ -105,8 +105,13 @@ class UserService(Service):
             else:
                 raise ServiceError(code=403,
                                    message=ErrorMsg.QUERY_PERMISSION_DENIED)
-        users, total = paging(users, page=page, page_size=page_size)
-        return 200, {'users': [model_to_dict(user) for user in users], 'total': total}
+        if cursor is None:
+            users, total = paging(users, page=page, page_size=page_size)
+            page_dict = {'total': total}
+        else:
+            users, page_dict = cursor_paging(users, cursor=cursor, page_size=page_size)
+        page_dict['users'] = [model_to_dict(user) for user in users]
+        return 200, page_dict
 
     def create(self, username, password, nick=None, role_id=None,
                group_ids=None, gender=None, email=None, phone=None,
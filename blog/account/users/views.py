@@ -123,11 +123,14 @@ def user_list(request):
     @apiUse Header
     @apiParam {number} [page=0] 用户信息列表页码, 页码为0时返回所有数据
     @apiParam {number} [page_size=10] 用户信息列表页长
+    @apiParam {string} [cursor] 用户信息列表游标, 传入时使用游标分页并忽略page参数, 空字符串返回第一页
     @apiParam {string} [order_field] 用户信息列表排序字段
     @apiParam {string=desc, asc} [order="desc"] 用户信息列表排序方向
     @apiParam {string} [query] 搜索内容，若无搜索字段则全局搜索nick, role, group, remark
     @apiParam {string=uuid, nick, role, group, remark, DjangoFilterParams} [query_field] 搜索字段, 支持Django filter参数
-    @apiSuccess {String} total 用户信息列表总数
+    @apiSuccess {String} total 用户信息列表总数, 游标分页时不返回
+    @apiSuccess {String} next_cursor 下一页游标, 仅游标分页时返回, 无下一页时为null
+    @apiSuccess {String} prev_cursor 上一页游标, 仅游标分页时返回, 无上一页时为null
     @apiSuccess {String} users 用户信息列表
     @apiSuccessExample {json} Success-Response:
     HTTP/1.1 200 OK
@@ -160,7 +163,8 @@ def user_list(request):
         'order_field': str,
         'order': str,
         'query': str,
-        'query_field': str
+        'query_field': str,
+        'cursor': str
     }
     try:
         params_dict = request_parser(data=request.GET, params=params)
@@ -58,7 +58,9 @@ def sign_in(request):
             if user.status == User.CANCEL or encode(password, user.uuid) != user.password:
                 raise AuthError()
             code, data = 200, UserService.user_to_dict(user=user,
-                                                       token=Authorize().gen_token(uuid=user.uuid))
+                                                       token=Authorize().gen_token(uuid=user.uuid,
+                                                                                   user_id=user.id,
+                                                                                   role_id=user.role_id))
         except (User.DoesNotExist, AuthError):
             code, data = 403, AccountErrorMsg.PASSWORD_ERROR
     else:
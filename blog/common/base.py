@@ -2,26 +2,37 @@
 # -*- coding: utf-8 -*-
 
 import base64
+import hashlib
+import hmac
 import redis
 import memcache
 import random
 import time
 import json
+import threading
 import uuid as identifier
 
 from functools import reduce
+from contextlib import contextmanager
+from collections import OrderedDict
 from abc import ABCMeta, abstractmethod
 
-from django.db.models import Q
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import Q, Case, When, Value, IntegerField
+from django.dispatch import receiver
 
 from blog.account.users.models import User
 from blog.account.roles.models import Role, RolePermission
 from blog.common.error import AuthError, ServiceError
 from blog.common.message import ErrorMsg, AccountErrorMsg
 from blog.common.setting import Setting, PermissionName, PermissionLevel, AuthType
-from blog.common.utils import ignored, get_md5
-from blog.settings import TOKEN_HEADER_KEY, TOKEN_COOKIE_KEY, TOKEN_URL_KEY, \
-    REDIS_HOSTS, REDIS_PASSWORD, MEMCACHED_HOSTS
+from blog.common.utils import get_md5
+from blog.settings import TOKEN_HEADER_KEY, TOKEN_COOKIE_KEY, TOKEN_URL_KEY, TOKEN_SIGNED, TOKEN_SIGN_KEY, \
+    TOKEN_REFRESH_WINDOW, REDIS_HOSTS, REDIS_PASSWORD, MEMCACHED_HOSTS, \
+    METADATA_SYNC_BATCH_SIZE, METADATA_SYNC_MAX_BATCHES, METADATA_EVICT_SCAN_COUNT, METADATA_TOUCH_INTERVAL, \
+    PERMISSION_CACHE_SIZE, PERMISSION_CACHE_CHECK_INTERVAL, TOKEN_SESSION_CACHE_SIZE, TOKEN_SESSION_CHECK_INTERVAL, \
+    TOKEN_SESSION_REVOKE_SIZE
 
 
 class RedisClient(object):
@@ -34,11 +45,29 @@ class RedisClient(object):
 
     @classmethod
     def _init_pool(cls):
+        # the database is read through django settings, tests override it with their own one
         cls.__pool = redis.ConnectionPool(host=REDIS_HOSTS, port=6379,
-                                          db=0, password=REDIS_PASSWORD)
+                                          db=settings.REDIS_DB, password=REDIS_PASSWORD)
 
-    def set(self, name, value, ex=None):
-        return self.client.set(name, value, ex)
+    @classmethod
+    def reset_pool(cls):
+        if cls.__pool:
+            cls.__pool.disconnect()
+        cls.__pool = None
+
+    @contextmanager
+    def pipeline(self, transaction=False):
+        # commands issued on the yielded client are queued and sent in one round trip on exit,
+        # replies are collected in order on pipe.results
+        pipe = RedisPipeline(self.client.pipeline(transaction=transaction))
+        try:
+            yield pipe
+            pipe.results = pipe.client.execute()
+        finally:
+            pipe.client.reset()
+
+    def set(self, name, value, ex=None, nx=False):
+        return self.client.set(name, value, ex, nx=nx)
 
     def get(self, name):
         return self.client.get(name)
@@ -46,6 +75,12 @@ class RedisClient(object):
     def exists(self, name):
         return self.client.exists(name)
 
+    def exists_many(self, *names):
+        with self.pipeline() as pipe:
+            for name in names:
+                pipe.exists(name)
+        return pipe.results
+
     def delete(self, *names):
         return self.client.delete(*names)
 
@@ -61,12 +96,26 @@ class RedisClient(object):
     def set_delete(self, name, *values):
         return self.client.srem(name, *values)
 
+    def set_pop(self, name):
+        return self.client.spop(name)
+
+    def increase(self, name, amount=1):
+        return self.client.incr(name, amount)
+
     def hash_set(self, name, key, value):
         return self.client.hset(name, key, value)
 
     def hash_get(self, name, key):
         return self.client.hget(name, key)
 
+    def hash_get_many(self, name, keys):
+        return self.client.hmget(name, keys)
+
+    def hash_set_many(self, name, mapping):
+        if not mapping:
+            return None
+        return self.client.hmset(name, mapping)
+
     def hash_delete(self, name, *keys):
         return self.client.hdel(name, *keys)
 
@@ -79,6 +128,9 @@ class RedisClient(object):
     def hash_keys(self, name):
         return self.client.hkeys(name)
 
+    def hash_scan_iter(self, name, count=None):
+        return self.client.hscan_iter(name, count=count)
+
     def sorted_set_add(self, name, *args, **kwargs):
         return self.client.zadd(name, *args, **kwargs)
 
@@ -87,15 +139,46 @@ class RedisClient(object):
         return self.client.zrange(name, start, end, desc,
                                   withscores, score_cast_func)
 
+    def sorted_set_range_by_score(self, name, min_score='-inf', max_score='+inf',
+                                  withscores=False, score_cast_func=int):
+        return self.client.zrangebyscore(name, min_score, max_score,
+                                         withscores=withscores, score_cast_func=score_cast_func)
+
     def sorted_set_count(self, name):
         return self.client.zcard(name)
 
     def sorted_set_score(self, name, value):
         return self.client.zscore(name, value)
 
+    def sorted_set_score_many(self, names, value):
+        with self.pipeline() as pipe:
+            for name in names:
+                pipe.sorted_set_score(name, value)
+        return pipe.results
+
     def sorted_set_delete(self, name, *values):
         return self.client.zrem(name, *values)
 
+    def script_register(self, script):
+        return self.client.register_script(script)
+
+
+@receiver(setting_changed, dispatch_uid='base.redis_db_change')
+def redis_db_change(setting, **kwargs):
+    if setting == 'REDIS_DB':
+        RedisClient.reset_pool()
+
+
+class RedisPipeline(RedisClient):
+    def __init__(self, client):
+        self.client = client
+        self.results = None
+
+    @contextmanager
+    def pipeline(self, transaction=False):
+        # nested batches join the outer pipeline, their replies land on the outer results
+        yield self
+
 
 class MemcachedClient(object):
     def __init__(self):
@@ -115,32 +198,161 @@ class MemcachedClient(object):
 
 
 # Todo rewrite access token JWT or OAuth 2.0
+# per-worker LRU cache, dropped whenever the version counter kept in Redis changes
+class LocalCache(object):
+    # per-worker LRU, emptied whenever the version counter in Redis changes,
+    # with a revoke key single entries are dropped on every worker through a bounded log of revoked keys
+    # KEYS: revoke log, revoke sequence
+    # ARGV: revoked key, log size
+    REVOKE_SCRIPT = """
+local seq = redis.call('INCR', KEYS[2])
+redis.call('ZADD', KEYS[1], seq, ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[2]) - 1)
+return seq
+"""
+    __revoke_script = None
+
+    def __init__(self, version_key, size, check_interval, revoke_key=None, revoke_size=None):
+        self.version_key = version_key
+        self.size = size
+        self.check_interval = check_interval
+        self.revoke_key = revoke_key
+        self.revoke_size = revoke_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._revoke_seq = None
+        # bumped on every drop, a load racing one is not cached
+        self._generation = 0
+        self._check_time = 0
+
+    def get(self, key, loader):
+        self._check_version()
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                self._data[key] = value
+                return value
+            generation = self._generation
+        value = loader(key)
+        if value is not None:
+            with self._lock:
+                # skip the fill when an invalidation happened while loading
+                if generation == self._generation:
+                    self._data[key] = value
+                    while len(self._data) > self.size:
+                        self._data.popitem(last=False)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._generation += 1
+
+    def revoke(self, key, redis_client=None):
+        # drops the key here and, within the check interval, on every other worker
+        redis_client = redis_client or RedisClient()
+        if not LocalCache.__revoke_script:
+            LocalCache.__revoke_script = redis_client.script_register(self.REVOKE_SCRIPT)
+        LocalCache.__revoke_script(keys=[self.revoke_key, self._get_revoke_seq_key()],
+                                   args=[key, self.revoke_size], client=redis_client.client)
+        self.delete(key)
+
+    def update_version(self, redis_client=None):
+        (redis_client or RedisClient()).increase(self.version_key)
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+            self._version = None
+            self._check_time = 0
+
+    def _check_version(self):
+        now = time.time()
+        if now - self._check_time < self.check_interval:
+            return
+        self._check_time = now
+        if not self.revoke_key:
+            version = RedisClient().get(name=self.version_key)
+            if version != self._version:
+                with self._lock:
+                    self._data.clear()
+                    self._generation += 1
+                    self._version = version
+            return
+        revoke_seq = self._revoke_seq or 0
+        with RedisClient().pipeline(transaction=True) as pipe:
+            pipe.get(name=self.version_key)
+            pipe.get(name=self._get_revoke_seq_key())
+            pipe.sorted_set_range(self.revoke_key, 0, 0, desc=False, withscores=True)
+            pipe.sorted_set_range_by_score(self.revoke_key, '(%d' % revoke_seq, '+inf')
+        version, seq, oldest, revoked = pipe.results
+        seq = int(seq or 0)
+        if version == self._version and seq == self._revoke_seq:
+            return
+        with self._lock:
+            # a revocation past what this worker saw may have been trimmed from the log, start over then
+            if version != self._version or self._revoke_seq is None or seq < self._revoke_seq or \
+                    seq > self._revoke_seq and (not oldest or oldest[0][1] > self._revoke_seq + 1):
+                self._data.clear()
+            else:
+                for key in revoked:
+                    self._data.pop(key, None)
+            self._generation += 1
+            self._version, self._revoke_seq = version, seq
+
+    def _get_revoke_seq_key(self):
+        return '%s&SEQ' % self.revoke_key
+
+
 class Authorize(object):
     TOKEN_FLAG = 'ETERN'
     GUEST_FLAG = 'GUEST'
-
-    def gen_token(self, uuid):
-        if not Setting().SESSION_LIMIT and RedisClient().get(name=uuid):
+    SIGNED_FLAG = 'SIGND'
+    # sessions of signed tokens as seen by this worker, dropped whenever a session is revoked or changed
+    __session_cache = LocalCache(version_key='TOKEN_SESSION_VERSION',
+                                 size=TOKEN_SESSION_CACHE_SIZE,
+                                 check_interval=TOKEN_SESSION_CHECK_INTERVAL,
+                                 revoke_key='TOKEN_SESSION_REVOKED',
+                                 revoke_size=TOKEN_SESSION_REVOKE_SIZE)
+
+    def gen_token(self, uuid, user_id=None, role_id=None):
+        if TOKEN_SIGNED:
+            return self._gen_signed_token(uuid=uuid, user_id=user_id, role_id=role_id)
+        if not Setting().SESSION_LIMIT:
             token = self.update_token(uuid=uuid)
         else:
+            token = None
+            self._revoke_session(uuid=uuid)
+        if not token:
             md5 = get_md5(str(random.random()))
             token = base64.b64encode('%s%s' % (md5, base64.b64encode(uuid))).rstrip('=')
             token = '%s%s' % (self.TOKEN_FLAG, token)
-            self._save_token(uuid=uuid, md5=md5)
+            self._save_token(uuid=uuid, md5=md5, user_id=user_id, role_id=role_id)
         return token
 
     def gen_guest_token(self):
         md5 = get_md5(str(random.random()))
         uuid = str(identifier.uuid5(identifier.NAMESPACE_DNS, ('%s%s' % (md5, time.time())).encode('utf-8')))
         role_id = Setting().GUEST_ROLE
-        token = base64.b64encode('%s%s' % (md5, base64.b64encode(uuid))).rstrip('=')
-        token = '%s%s' % (self.GUEST_FLAG, token)
+        if TOKEN_SIGNED:
+            token = self._sign_token(uuid=uuid, user_id=0, md5=md5)
+        else:
+            token = base64.b64encode('%s%s' % (md5, base64.b64encode(uuid))).rstrip('=')
+            token = '%s%s' % (self.GUEST_FLAG, token)
         self._save_token(uuid=uuid, md5=md5, user_id=0, role_id=role_id)
         return {'token': token, 'uuid': uuid, 'role': role_id}
 
     def update_token(self, token=None, uuid=None, role_id=None, update_stamp=True):
-        if uuid and RedisClient().get(name=uuid):
-            user_id, role_id_stamp, md5_stamp, time_stamp = self._parse_cache_value(uuid=uuid)
+        # role ids may come straight from request parameters, the session stores them as ints
+        role_id = None if role_id is None else int(role_id)
+        user_id, role_id_stamp, md5_stamp, time_stamp = self._parse_cache_value(uuid=uuid) \
+            if uuid else (None, None, None, None)
+        if md5_stamp and TOKEN_SIGNED:
+            token = self._sign_token(uuid=uuid, user_id=user_id, md5=md5_stamp)
+        elif md5_stamp:
             token = base64.b64encode('%s%s' % (md5_stamp, base64.b64encode(uuid))).rstrip('=')
             if role_id == Setting().GUEST_ROLE or \
                     role_id is None and role_id_stamp == Setting().GUEST_ROLE:
@@ -159,23 +371,62 @@ class Authorize(object):
                              time_stamp=time_stamp,
                              user_id=user_id,
                              role_id=role_id)
+            if role_id_stamp != role_id:
+                self.__session_cache.revoke(uuid)
             return token
         return None
 
     def auth_token(self, token):
         if not token:
             raise AuthError()
+        if token.startswith(self.SIGNED_FLAG):
+            return self._auth_signed_token(token=token)
         uuid, user_id, role_id, md5_stamp, time_stamp = self._auth_token_md5(token=token)
         if Setting().TOKEN_EXPIRATION and time.time() - int(time_stamp) > Setting().TOKEN_EXPIRATION_TIME:
             RedisClient().delete(uuid)
             raise AuthError(code=419, message=AccountErrorMsg.TOKEN_TIMEOUT)
-        self._save_token(uuid=uuid, md5=md5_stamp, user_id=user_id, role_id=role_id)
+        # slide the expiration only once the remaining lifetime drops below the refresh window
+        remaining_time = Setting().TOKEN_EXPIRATION_TIME - (time.time() - int(time_stamp))
+        if remaining_time < Setting().TOKEN_EXPIRATION_TIME * TOKEN_REFRESH_WINDOW:
+            self._save_token(uuid=uuid, md5=md5_stamp, user_id=user_id, role_id=role_id)
         return uuid, user_id, role_id
 
     def cancel_token(self, uuid=None, token=None):
         if not uuid:
             uuid, md5 = self._parse_token(token=token)
         RedisClient().delete(uuid)
+        self.__session_cache.revoke(uuid)
+
+    def _revoke_session(self, uuid):
+        # a replaced session must stop authenticating on every worker, not only here
+        if RedisClient().exists(uuid):
+            self.__session_cache.revoke(uuid)
+
+    def _auth_signed_token(self, token):
+        uuid, user_id, issue_time, md5 = self._parse_signed_payload(token=token)
+        if not uuid:
+            raise AuthError()
+        session = self.__session_cache.get(uuid, self._get_session)
+        if session is None or time.time() - max(session[1], issue_time) > Setting().TOKEN_EXPIRATION_TIME:
+            # the local copy may predate a refresh made by another worker, look again before giving up
+            self.__session_cache.delete(uuid)
+            session = self.__session_cache.get(uuid, self._get_session)
+        if session is None:
+            raise AuthError(code=419, message=AccountErrorMsg.TOKEN_TIMEOUT)
+        md5_stamp, time_stamp, user_id_stamp, role_id = session
+        if md5_stamp != md5 or user_id_stamp != user_id:
+            raise AuthError(code=418, message=AccountErrorMsg.UNEXPECTED_FLAG)
+        # a token issued after the cached refresh still counts as activity
+        active_time = max(time_stamp, issue_time)
+        if Setting().TOKEN_EXPIRATION and time.time() - active_time > Setting().TOKEN_EXPIRATION_TIME:
+            RedisClient().delete(uuid)
+            self.__session_cache.delete(uuid)
+            raise AuthError(code=419, message=AccountErrorMsg.TOKEN_TIMEOUT)
+        remaining_time = Setting().TOKEN_EXPIRATION_TIME - (time.time() - active_time)
+        if remaining_time < Setting().TOKEN_EXPIRATION_TIME * TOKEN_REFRESH_WINDOW:
+            self._save_token(uuid=uuid, md5=md5, user_id=user_id, role_id=role_id)
+            self.__session_cache.delete(uuid)
+        return uuid, user_id, role_id
 
     def _auth_token_md5(self, token):
         uuid, md5 = self._parse_token(token=token)
@@ -188,6 +439,28 @@ class Authorize(object):
             raise AuthError(code=418, message=AccountErrorMsg.UNEXPECTED_FLAG)
         return uuid, user_id, role_id, md5_stamp, time_stamp
 
+    def _gen_signed_token(self, uuid, user_id=None, role_id=None):
+        md5_stamp = None
+        if not Setting().SESSION_LIMIT:
+            user_id_stamp, role_id_stamp, md5_stamp, time_stamp = self._parse_cache_value(uuid=uuid)
+        else:
+            self._revoke_session(uuid=uuid)
+        if md5_stamp:
+            user_id, role_id = self._save_token(uuid=uuid, md5=md5_stamp,
+                                                user_id=user_id_stamp, role_id=role_id_stamp)
+        else:
+            md5_stamp = get_md5(str(random.random()))
+            user_id, role_id = self._save_token(uuid=uuid, md5=md5_stamp, user_id=user_id, role_id=role_id)
+        return self._sign_token(uuid=uuid, user_id=user_id, md5=md5_stamp)
+
+    def _sign_token(self, uuid, user_id, md5):
+        # the role stays in the session, role changes apply without reissuing tokens
+        payload = '%s&%s&%s&%s' % (uuid, user_id, int(time.time()), md5)
+        signature = hmac.new(TOKEN_SIGN_KEY, payload, hashlib.sha256).digest()
+        return '%s%s.%s' % (self.SIGNED_FLAG,
+                            base64.urlsafe_b64encode(payload).rstrip('='),
+                            base64.urlsafe_b64encode(signature).rstrip('='))
+
     @staticmethod
     def _save_token(uuid, md5, time_stamp=None, user_id=None, role_id=None):
         if not time_stamp:
@@ -203,9 +476,13 @@ class Authorize(object):
             raise AuthError()
         value = '%s&%s&%s&%s' % (md5, time_stamp, user_id, role_id)
         RedisClient().set(name=uuid, value=value, ex=Setting().TOKEN_EXPIRATION_TIME)
+        return user_id, role_id
 
     @staticmethod
     def _parse_token(token):
+        if token and token.startswith(Authorize.SIGNED_FLAG):
+            uuid, _, _, md5 = Authorize._parse_signed_payload(token=token)
+            return uuid, md5
         flag_len = len(Authorize.TOKEN_FLAG)
         if token and len(token) > flag_len + 4:
             if token[:flag_len] not in (Authorize.TOKEN_FLAG, Authorize.GUEST_FLAG):
@@ -223,6 +500,33 @@ class Authorize(object):
                 return base64.b64decode(code[32:]), code[:32]
         return None, None
 
+    @staticmethod
+    def _parse_signed_payload(token):
+        code = token[len(Authorize.SIGNED_FLAG):].split('.')
+        if len(code) != 2:
+            return None, None, None, None
+        try:
+            payload, signature = [base64.urlsafe_b64decode(str(part + '=' * (-len(part) % 4))) for part in code]
+        except TypeError:
+            return None, None, None, None
+        if not hmac.compare_digest(signature, hmac.new(TOKEN_SIGN_KEY, payload, hashlib.sha256).digest()):
+            return None, None, None, None
+        payload_list = payload.split('&')
+        if len(payload_list) != 4:
+            return None, None, None, None
+        uuid, user_id, issue_time, md5 = payload_list
+        try:
+            return uuid, int(user_id), int(issue_time), md5
+        except ValueError:
+            return None, None, None, None
+
+    @staticmethod
+    def _get_session(uuid):
+        user_id, role_id, md5_stamp, time_stamp = Authorize._parse_cache_value(uuid=uuid)
+        if not md5_stamp:
+            return None
+        return md5_stamp, int(time_stamp), user_id, role_id
+
     @staticmethod
     def _parse_cache_value(uuid):
         value = RedisClient().get(name=uuid)
@@ -236,20 +540,35 @@ class Authorize(object):
 
 
 class Grant(object):
+    # compiled permissions of this worker, keyed by role id
+    __cache = LocalCache(version_key='ROLE_PERMISSION_VERSION',
+                         size=PERMISSION_CACHE_SIZE,
+                         check_interval=PERMISSION_CACHE_CHECK_INTERVAL)
+
     def load_permission(self, role=None):
-        if role:
-            self.set_permission(role=role)
-        else:
-            roles = Role.objects.all()
-            for role in roles:
-                self.set_permission(role=role)
+        roles = [role] if role else Role.objects.all()
+        perm_dict = self._build_permission(roles=roles)
+        redis_client = RedisClient()
+        with redis_client.pipeline() as pipe:
+            pipe.hash_set_many(name='ROLE_PERMISSION',
+                               mapping=dict((str(role_id), json.dumps(perm)) for role_id, perm in perm_dict.items()))
+            Grant.__cache.update_version(redis_client=pipe)
+
+    def remove_permission(self, role_id):
+        redis_client = RedisClient()
+        with redis_client.pipeline() as pipe:
+            pipe.hash_delete('ROLE_PERMISSION', str(role_id))
+            Grant.__cache.update_version(redis_client=pipe)
 
     def get_permission(self, role_id):
-        value = RedisClient().hash_get(name='ROLE_PERMISSION', key=str(role_id))
+        return Grant.__cache.get(str(role_id), self._get_compiled_permission)
+
+    def _get_compiled_permission(self, role_id):
+        value = RedisClient().hash_get(name='ROLE_PERMISSION', key=role_id)
         if value:
-            return json.loads(value)
-        else:
-            return self.set_permission(role_id=role_id)
+            return CompiledPermission(json.loads(value))
+        perm = self.set_permission(role_id=role_id)
+        return CompiledPermission(perm) if perm is not None else None
 
     @staticmethod
     def set_permission(role_id=None, role=None):
@@ -258,10 +577,24 @@ class Grant(object):
                 role = Role.objects.get(id=role_id)
             except Role.DoesNotExist:
                 return None
-        perm = {'_role_level': role.role_level}
-        for k, v in PermissionName():
-            try:
-                grant = role.rolepermission_set.get(permission__name=v)
+        perm = Grant._build_permission(roles=[role])[role.id]
+        RedisClient().hash_set(name='ROLE_PERMISSION', key=str(role.id), value=json.dumps(perm))
+        return perm
+
+    @staticmethod
+    def _build_permission(roles):
+        perm_dict = dict((role.id, {'_role_level': role.role_level}) for role in roles)
+        grant_dict = {}
+        role_permissions = RolePermission.objects.filter(role_id__in=list(perm_dict)) \
+            .select_related('permission').order_by('id')
+        for grant in role_permissions:
+            grant_dict.setdefault((grant.role_id, grant.permission.name), grant)
+        for role_id, perm in perm_dict.items():
+            for k, v in PermissionName():
+                grant = grant_dict.get((role_id, v))
+                if grant is None:
+                    perm[v] = {'state': False}
+                    continue
                 perm[v] = {'state': grant.state}
                 if grant.major_level is not None:
                     perm[v]['major_level'] = int(grant.major_level)
@@ -269,16 +602,23 @@ class Grant(object):
                     perm[v]['minor_level'] = int(grant.minor_level)
                 if grant.value is not None:
                     perm[v]['value'] = int(grant.value)
-            except RolePermission.DoesNotExist:
-                perm[v] = {'state': False}
-        RedisClient().hash_set(name='ROLE_PERMISSION', key=str(role.id), value=json.dumps(perm))
-        return perm
+        return perm_dict
 
 
 class LevelObject(object):
+    # one read-only instance per level, shared by every compiled permission
+    __shared = {}
+
     def __init__(self, level=0):
         self.level = int(level)
 
+    @classmethod
+    def get(cls, level):
+        level_object = cls.__shared.get(level)
+        if level_object is None:
+            level_object = cls.__shared.setdefault(level, cls(level))
+        return level_object
+
     def __cmp__(self, other):
         if isinstance(other, (int, float)):
             value = other
@@ -354,6 +694,39 @@ class LevelObject(object):
         return self.level < PermissionLevel.LEVEL_1
 
 
+class CompiledPermission(object):
+    __slots__ = ('role_level', '_grants')
+
+    # (state, major_level, minor_level, value) shared by every denied or unknown permission
+    NONE_GRANT = (False, 0, 0, 0)
+
+    def __init__(self, perm):
+        grants = {}
+        for perm_name, grant in perm.items():
+            if not isinstance(grant, dict):
+                continue
+            if not grant.get('state'):
+                grants[perm_name] = self.NONE_GRANT
+                continue
+            grants[perm_name] = (True, int(grant.get('major_level') or 0), int(grant.get('minor_level') or 0),
+                                 grant.get('value') or 0)
+        object.__setattr__(self, 'role_level', perm.get('_role_level'))
+        object.__setattr__(self, '_grants', grants)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('CompiledPermission is immutable')
+
+    def has(self, perm_name):
+        return self._grants.get(perm_name, self.NONE_GRANT)[0]
+
+    def level(self, perm_name):
+        grant = self._grants.get(perm_name, self.NONE_GRANT)
+        return LevelObject.get(grant[1]), LevelObject.get(grant[2])
+
+    def value(self, perm_name):
+        return self._grants.get(perm_name, self.NONE_GRANT)[3]
+
+
 class Service(object):
     def __init__(self, request=None, instance=None, auth_type=AuthType.HEADER, token=None):
         if instance:
@@ -363,6 +736,7 @@ class Service(object):
             self.uuid, self.uid, self.role_id = instance.uuid, instance.uid, instance.role_id
             self.permission = instance.permission
             self.role_level = instance.role_level
+            self.cache = instance.cache
             return
         self.request = request
         self.auth_type = auth_type
@@ -370,6 +744,8 @@ class Service(object):
         self.uuid, self.uid, self.role_id = None, None, None
         self.permission = None
         self.role_level = None
+        # request scoped memo shared by every service built from this one through instance=
+        self.cache = {}
         if auth_type != AuthType.NONE:
             self._auth_init()
 
@@ -387,10 +763,9 @@ class Service(object):
     def _auth_init(self):
         self.uuid, self.uid, self.role_id = Authorize().auth_token(self.token)
         self.permission = Grant().get_permission(role_id=self.role_id)
-        try:
-            self.role_level = self.permission['_role_level']
-        except (KeyError, TypeError):
+        if self.permission is None or self.permission.role_level is None:
             raise AuthError(code=503, message=ErrorMsg.PERMISSION_KEY_ERROR + '_role_level')
+        self.role_level = self.permission.role_level
 
     def has_permission(self, perm_name, raise_error=True):
         if self.auth_type == AuthType.NONE:
@@ -402,33 +777,17 @@ class Service(object):
         return False
 
     def _has_permission(self, perm_name):
-        try:
-            if not self.permission[perm_name]['state']:
-                return False
-        except (KeyError, TypeError):
-            return False
-        return True
+        return self.permission is not None and self.permission.has(perm_name)
 
     def get_permission_level(self, perm_name, raise_error=True):
-        if not self.has_permission(perm_name, raise_error):
-            return LevelObject(0), LevelObject(0)
-        try:
-            major_level = LevelObject(self.permission[perm_name]['major_level'])
-        except (KeyError, TypeError):
-            major_level = LevelObject(0)
-        try:
-            minor_level = LevelObject(self.permission[perm_name]['minor_level'])
-        except (KeyError, TypeError):
-            minor_level = LevelObject(0)
-        return major_level, minor_level
+        if not self.has_permission(perm_name, raise_error) or self.permission is None:
+            return LevelObject.get(0), LevelObject.get(0)
+        return self.permission.level(perm_name)
 
     def get_permission_value(self, perm_name, raise_error=True):
-        if not self.has_permission(perm_name, raise_error):
-            return 0
-        try:
-            return self.permission[perm_name]['value']
-        except (KeyError, TypeError):
+        if not self.has_permission(perm_name, raise_error) or self.permission is None:
             return 0
+        return self.permission.value(perm_name)
 
     @staticmethod
     def choices_format(value, choices, default=None):
@@ -481,10 +840,82 @@ class MetadataService(object):
     LIKE_USER = 1
     DISLIKE_USER = 2
 
+    # KEYS: metadata hash, like list, dislike list, dirty set
+    # ARGV: resource uuid, user id, operate, time stamp
+    # returns nil when the counters or like lists are not cached yet
+    LIKE_SCRIPT = """
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+if not value or redis.call('EXISTS', KEYS[2]) == 0 or redis.call('EXISTS', KEYS[3]) == 0 then
+    return false
+end
+local counts = {}
+for count in string.gmatch(value, '[^&]+') do
+    counts[#counts + 1] = tonumber(count)
+end
+if #counts ~= 5 then
+    return false
+end
+local user_id = ARGV[2]
+local own_key, other_key, own_index, other_index, own_state = KEYS[2], KEYS[3], 3, 4, 1
+if ARGV[3] ~= '1' then
+    own_key, other_key, own_index, other_index, own_state = KEYS[3], KEYS[2], 4, 3, 2
+end
+local state = 0
+if redis.call('ZREM', other_key, user_id) == 1 then
+    counts[other_index] = counts[other_index] - 1
+end
+if redis.call('ZREM', own_key, user_id) == 1 then
+    counts[own_index] = counts[own_index] - 1
+else
+    redis.call('ZADD', own_key, ARGV[4], user_id)
+    counts[own_index] = counts[own_index] + 1
+    state = own_state
+end
+counts[5] = tonumber(ARGV[4])
+redis.call('HSET', KEYS[1], ARGV[1], table.concat(counts, '&'))
+redis.call('SADD', KEYS[4], ARGV[1])
+return {counts[1], counts[2], counts[3], counts[4], counts[5], state}
+"""
+
+    # KEYS: metadata hash, like list, dislike list, dirty set
+    # ARGV: resource uuid, metadata value seen by the sweep
+    # evicts only when the entry is unchanged since the sweep read it and has no pending sync
+    EVICT_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[4], ARGV[1]) == 1 or redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('DEL', KEYS[2], KEYS[3])
+return 1
+"""
+
+    # KEYS: metadata hash
+    # ARGV: time stamp, resource uuids
+    # rewrites only the time stamp of each cached entry, counters changed meanwhile are kept
+    TOUCH_SCRIPT = """
+for i = 2, #ARGV do
+    local value = redis.call('HGET', KEYS[1], ARGV[i])
+    local counts = value and string.match(value, '^([^&]*&[^&]*&[^&]*&[^&]*&)[^&]*$')
+    if counts then
+        redis.call('HSET', KEYS[1], ARGV[i], counts .. ARGV[1])
+    end
+end
+return 0
+"""
+
     __metaclass__ = ABCMeta
 
+    __like_script = None
+    __evict_script = None
+    __touch_script = None
+
     def __init__(self):
         self.redis_client = RedisClient()
+        # the scripts are shared by every instance, each call runs on the client of the calling one
+        if not MetadataService.__like_script:
+            MetadataService.__like_script = self.redis_client.script_register(self.LIKE_SCRIPT)
+            MetadataService.__evict_script = self.redis_client.script_register(self.EVICT_SCRIPT)
+            MetadataService.__touch_script = self.redis_client.script_register(self.TOUCH_SCRIPT)
 
     class Metadata:
         def __init__(self, *args):
@@ -505,6 +936,42 @@ class MetadataService(object):
         self._set_redis_metadata_count(resource=resource, metadata=metadata)
         return metadata
 
+    def get_metadata_many(self, resources, user_id):
+        resources = list(resources)
+        if not resources:
+            return []
+        list_keys = [key for resource in resources for key in self._get_like_list_key(resource.uuid)]
+        with self.redis_client.pipeline() as pipe:
+            pipe.hash_get_many(name=self.METADATA_KEY, keys=[resource.uuid for resource in resources])
+            pipe.exists_many(*list_keys)
+            if user_id is not None:
+                pipe.sorted_set_score_many(list_keys, str(user_id))
+        values = pipe.results[0]
+        exists_list = pipe.results[1:len(list_keys) + 1]
+        scores = pipe.results[len(list_keys) + 1:]
+        metadata_list, missing_resources, stale_uuids = [], [], []
+        touch_time = int(time.time())
+        for resource, value in zip(resources, values):
+            value_list = value.split('&') if value else []
+            if len(value_list) != 5:
+                metadata_list.append(None)
+                missing_resources.append(resource)
+            else:
+                metadata_list.append(self.Metadata(*value_list))
+                if touch_time - metadata_list[-1].time_stamp > METADATA_TOUCH_INTERVAL:
+                    stale_uuids.append(resource.uuid)
+        # entries read through lists stay hot for evict_metadata, refreshed at most once per interval
+        if stale_uuids:
+            self.__touch_script(keys=[self.METADATA_KEY], args=[touch_time] + stale_uuids,
+                                client=self.redis_client.client)
+        if missing_resources:
+            metadata_dict = self._get_sql_metadata_count_many(resources=missing_resources)
+            metadata_list = [metadata or metadata_dict[resource.uuid]
+                             for resource, metadata in zip(resources, metadata_list)]
+        is_like_users = self._is_like_user_many(resources=resources, user_id=user_id,
+                                                exists_list=exists_list, scores=scores)
+        return list(zip(metadata_list, is_like_users))
+
     def update_metadata_count(self, resource, **kwargs):
         metadata = self._get_metadata_count(resource=resource)
         for field in kwargs:
@@ -512,60 +979,100 @@ class MetadataService(object):
             count = count + 1 if int(kwargs[field]) == self.OPERATE_ADD else count - 1
             setattr(metadata, field, count)
         metadata.time_stamp = int(time.time())
-        self._set_redis_metadata_count(resource=resource, metadata=metadata)
+        self._set_redis_metadata_count(resource=resource, metadata=metadata, dirty=True)
         return metadata
 
     def update_like_list(self, resource, user_id, operate=OPERATE_LIKE):
-        user_id = str(user_id)
-        like_list_key, dislike_list_key = self._get_like_list_key(resource.uuid)
-        time_stamp = int(time.time())
-        operate_dict = {}
-        is_like_user = self.is_like_user(resource, user_id)
-        if int(operate) == self.OPERATE_LIKE:
-            if is_like_user == self.DISLIKE_USER:
-                self.redis_client.sorted_set_delete(dislike_list_key, user_id)
-                operate_dict['dislike_count'] = self.OPERATE_MINUS
-            if is_like_user != self.LIKE_USER:
-                self.redis_client.sorted_set_add(like_list_key, time_stamp, user_id)
-                operate_dict['like_count'] = self.OPERATE_ADD
-            else:
-                self.redis_client.sorted_set_delete(like_list_key, user_id)
-                operate_dict['like_count'] = self.OPERATE_MINUS
-        elif int(operate) == self.OPERATE_DISLIKE:
-            if is_like_user == self.LIKE_USER:
-                self.redis_client.sorted_set_delete(like_list_key, user_id)
-                operate_dict['like_count'] = self.OPERATE_MINUS
-            if is_like_user != self.DISLIKE_USER:
-                self.redis_client.sorted_set_add(dislike_list_key, time_stamp, user_id)
-                operate_dict['dislike_count'] = self.OPERATE_ADD
-            else:
-                self.redis_client.sorted_set_delete(dislike_list_key, user_id)
-                operate_dict['dislike_count'] = self.OPERATE_MINUS
-        return self.update_metadata_count(resource=resource, **operate_dict)
-
-    def sync_metadata(self):
-        metadata_dict = self.redis_client.hash_all(name=self.METADATA_KEY)
-        for resource_uuid, value in metadata_dict.items():
+        operate = int(operate)
+        if operate not in (self.OPERATE_LIKE, self.OPERATE_DISLIKE):
+            return self.get_metadata_count(resource=resource), self.is_like_user(resource, user_id)
+        keys = [self.METADATA_KEY] + list(self._get_like_list_key(resource.uuid)) + [self._get_dirty_key()]
+        args = [resource.uuid, str(user_id), operate, int(time.time())]
+        result = self.__like_script(keys=keys, args=args, client=self.redis_client.client)
+        if result is None:
+            self._get_metadata_count(resource=resource)
+            if not all(self.redis_client.exists_many(*keys[1:3])):
+                self._get_sql_like_list(resource=resource)
+            result = self.__like_script(keys=keys, args=args, client=self.redis_client.client)
+            if result is None:
+                raise ServiceError(code=500, message=ErrorMsg.SERVER_ERROR)
+        return self.Metadata(*result[:5]), int(result[5])
+
+    def sync_metadata(self, batch_size=METADATA_SYNC_BATCH_SIZE, max_batches=METADATA_SYNC_MAX_BATCHES):
+        dirty_key = self._get_dirty_key()
+        for _ in range(max_batches):
+            with self.redis_client.pipeline() as pipe:
+                for _ in range(batch_size):
+                    pipe.set_pop(dirty_key)
+            resource_uuids = [resource_uuid for resource_uuid in pipe.results if resource_uuid is not None]
+            if not resource_uuids:
+                break
+            values = self.redis_client.hash_get_many(name=self.METADATA_KEY, keys=resource_uuids)
+            metadata_dict = {}
+            for resource_uuid, value in zip(resource_uuids, values):
+                value_list = value.split('&') if value else []
+                if len(value_list) == 5:
+                    metadata_dict[resource_uuid] = self.Metadata(*value_list)
+            try:
+                self._set_sql_metadata_many(metadata_dict=metadata_dict)
+            except Exception:
+                self.redis_client.set_add(dirty_key, *resource_uuids)
+                raise
+            if len(resource_uuids) < batch_size:
+                break
+
+    def evict_metadata(self, scan_count=METADATA_EVICT_SCAN_COUNT):
+        expiration_time = time.time() - Setting().HOT_EXPIRATION_TIME
+        dirty_key = self._get_dirty_key()
+        for resource_uuid, value in self.redis_client.hash_scan_iter(name=self.METADATA_KEY, count=scan_count):
             value_list = value.split('&')
-            if len(value_list) != 5:
-                self.redis_client.hash_delete(self.METADATA_KEY, resource_uuid)
-                like_list_key, dislike_list_key = self._get_like_list_key(resource_uuid)
-                self.redis_client.delete(like_list_key, dislike_list_key)
+            if len(value_list) == 5 and int(value_list[4]) > expiration_time:
                 continue
-            metadata = self.Metadata(*value_list)
-            self._set_sql_metadata(resource_uuid=resource_uuid, metadata=metadata)
+            keys = [self.METADATA_KEY] + list(self._get_like_list_key(resource_uuid)) + [dirty_key]
+            self.__evict_script(keys=keys, args=[resource_uuid, value], client=self.redis_client.client)
 
     def is_like_user(self, resource, user_id):
         like_list_key, dislike_list_key = self._get_like_list_key(resource.uuid)
-        if not self.redis_client.exists(like_list_key) or \
-                not self.redis_client.exists(dislike_list_key):
+        with self.redis_client.pipeline() as pipe:
+            pipe.exists_many(like_list_key, dislike_list_key)
+            pipe.sorted_set_score_many([like_list_key, dislike_list_key], user_id)
+        like_exists, dislike_exists, like_score, dislike_score = pipe.results
+        if not like_exists or not dislike_exists:
             self._get_sql_like_list(resource)
-        if self.redis_client.sorted_set_score(like_list_key, user_id) is not None:
+            like_score, dislike_score = self.redis_client.sorted_set_score_many(
+                [like_list_key, dislike_list_key], user_id)
+        if like_score is not None:
             return self.LIKE_USER
-        if self.redis_client.sorted_set_score(dislike_list_key, user_id) is not None:
+        if dislike_score is not None:
             return self.DISLIKE_USER
         return self.NONE_USER
 
+    def _is_like_user_many(self, resources, user_id, exists_list, scores):
+        is_like_users = [self.NONE_USER] * len(resources)
+        if user_id is None:
+            return is_like_users
+        sql_resources = []
+        for index, resource in enumerate(resources):
+            if not exists_list[index * 2] or not exists_list[index * 2 + 1]:
+                sql_resources.append((index, resource))
+            elif scores[index * 2] is not None:
+                is_like_users[index] = self.LIKE_USER
+            elif scores[index * 2 + 1] is not None:
+                is_like_users[index] = self.DISLIKE_USER
+        if sql_resources:
+            metadata_model = self._get_metadata_model(resources[0])
+            resource_ids = [resource.id for index, resource in sql_resources]
+            like_ids = set(metadata_model.objects.filter(pk__in=resource_ids, like_users__id=user_id)
+                           .values_list('pk', flat=True))
+            dislike_ids = set(metadata_model.objects.filter(pk__in=resource_ids, dislike_users__id=user_id)
+                              .values_list('pk', flat=True))
+            for index, resource in sql_resources:
+                if resource.id in like_ids:
+                    is_like_users[index] = self.LIKE_USER
+                elif resource.id in dislike_ids:
+                    is_like_users[index] = self.DISLIKE_USER
+        return is_like_users
+
     def _get_metadata_count(self, resource):
         value = self.redis_client.hash_get(name=self.METADATA_KEY, key=resource.uuid)
         if not value:
@@ -594,21 +1101,26 @@ class MetadataService(object):
                 dislike_users.remove('PLACEHOLDER')
         return like_users, dislike_users
 
-    def _set_redis_metadata_count(self, resource, metadata):
+    def _set_redis_metadata_count(self, resource, metadata, dirty=False):
         value = '%s&%s&%s&%s&%s' % (metadata.read_count, metadata.comment_count,
                                     metadata.like_count, metadata.dislike_count,
                                     metadata.time_stamp)
-        self.redis_client.hash_set(name=self.METADATA_KEY, key=resource.uuid, value=value)
+        with self.redis_client.pipeline() as pipe:
+            pipe.hash_set(name=self.METADATA_KEY, key=resource.uuid, value=value)
+            if dirty:
+                pipe.set_add(self._get_dirty_key(), resource.uuid)
 
     def _set_redis_like_list(self, resource, like_users, dislike_users):
         like_list_key, dislike_list_key = self._get_like_list_key(resource.uuid)
-        self.redis_client.delete(like_list_key, dislike_list_key)
-        self.redis_client.sorted_set_add(like_list_key, -1, 'PLACEHOLDER')
-        self.redis_client.sorted_set_add(dislike_list_key, -1, 'PLACEHOLDER')
-        for (index, user_uid) in like_users:
-            self.redis_client.sorted_set_add(like_list_key, index, user_uid)
-        for (index, user_uid) in dislike_users:
-            self.redis_client.sorted_set_add(dislike_list_key, index, user_uid)
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(like_list_key, dislike_list_key)
+            pipe.sorted_set_add(like_list_key, -1, 'PLACEHOLDER')
+            pipe.sorted_set_add(dislike_list_key, -1, 'PLACEHOLDER')
+            # users loaded from sql keep their order ahead of likes scored by time stamp
+            for index, user_uid in enumerate(like_users):
+                pipe.sorted_set_add(like_list_key, index, user_uid)
+            for index, user_uid in enumerate(dislike_users):
+                pipe.sorted_set_add(dislike_list_key, index, user_uid)
 
     def _get_sql_metadata_count(self, resource):
         read_count = resource.metadata.read_count
@@ -620,6 +1132,25 @@ class MetadataService(object):
         self._set_redis_metadata_count(resource=resource, metadata=metadata)
         return metadata
 
+    def _get_sql_metadata_count_many(self, resources):
+        metadata_model = self._get_metadata_model(resources[0])
+        sql_metadata_dict = metadata_model.objects.in_bulk([resource.id for resource in resources])
+        time_stamp = str(int(time.time()))
+        metadata_dict, value_dict = {}, {}
+        for resource in resources:
+            sql_metadata = sql_metadata_dict.get(resource.id)
+            if sql_metadata:
+                metadata = self.Metadata(sql_metadata.read_count, sql_metadata.comment_count,
+                                         sql_metadata.like_count, sql_metadata.dislike_count, time_stamp)
+            else:
+                metadata = self.Metadata(0, 0, 0, 0, time_stamp)
+            metadata_dict[resource.uuid] = metadata
+            value_dict[resource.uuid] = '%s&%s&%s&%s&%s' % (metadata.read_count, metadata.comment_count,
+                                                            metadata.like_count, metadata.dislike_count,
+                                                            metadata.time_stamp)
+        self.redis_client.hash_set_many(name=self.METADATA_KEY, mapping=value_dict)
+        return metadata_dict
+
     def _get_sql_like_list(self, resource, start=0, end=-1):
         like_users = resource.metadata.like_users.all()
         like_users = list(user.id for user in like_users)
@@ -633,28 +1164,80 @@ class MetadataService(object):
         return like_users[start:end + 1], dislike_users[start:end + 1]
 
     @abstractmethod
-    def _set_sql_metadata(self, resource_uuid, metadata):
+    def _get_sql_resources(self, resource_uuids):
         pass
 
-    def _set_resource_sql_metadata(self, resource, metadata, like_list_key, dislike_list_key):
-        resource.metadata.read_count = metadata.read_count
-        resource.metadata.comment_count = metadata.comment_count
-        resource.metadata.like_count = metadata.like_count
-        resource.metadata.dislike_count = metadata.dislike_count
-        if self.redis_client.exists(name=like_list_key):
-            like_users, dislike_users = self._get_like_list(resource=resource, list_type=self.ALL_LIST)
-            resource.metadata.like_users.clear()
-            for user_uid in like_users:
-                with ignored(User.DoesNotExist):
-                    resource.metadata.like_users.add(user_uid)
-            resource.metadata.dislike_users.clear()
-            for user_uid in dislike_users:
-                with ignored(User.DoesNotExist):
-                    resource.metadata.dislike_users.add(user_uid)
-        resource.metadata.save()
-        if time.time() - metadata.time_stamp > Setting().HOT_EXPIRATION_TIME:
-            self.redis_client.hash_delete(self.METADATA_KEY, resource.uuid)
-            self.redis_client.delete(like_list_key, dislike_list_key)
+    @staticmethod
+    def _get_metadata_model(resource):
+        return resource._meta.get_field('metadata').related_model
+
+    def _set_sql_metadata_many(self, metadata_dict):
+        if not metadata_dict:
+            return
+        resources = self._get_sql_resources(resource_uuids=list(metadata_dict)).only('id', 'uuid')
+        resource_ids = dict((resource.uuid, resource.id) for resource in resources)
+        missing_uuids = [resource_uuid for resource_uuid in metadata_dict if resource_uuid not in resource_ids]
+        if missing_uuids:
+            with self.redis_client.pipeline() as pipe:
+                pipe.hash_delete(self.METADATA_KEY, *missing_uuids)
+                pipe.delete(*[key for resource_uuid in missing_uuids
+                              for key in self._get_like_list_key(resource_uuid)])
+        if not resource_ids:
+            return
+        metadata_model = self._get_metadata_model(resources.model)
+        update_dict = {}
+        for field in ('read_count', 'comment_count', 'like_count', 'dislike_count'):
+            whens = [When(pk=resource_id, then=Value(getattr(metadata_dict[resource_uuid], field)))
+                     for resource_uuid, resource_id in resource_ids.items()]
+            update_dict[field] = Case(*whens, output_field=IntegerField())
+        metadata_model.objects.filter(pk__in=list(resource_ids.values())).update(**update_dict)
+        self._set_sql_like_list_many(metadata_model=metadata_model, resource_ids=resource_ids)
+
+    def _set_sql_like_list_many(self, metadata_model, resource_ids):
+        resource_items = list(resource_ids.items())
+        with self.redis_client.pipeline() as pipe:
+            for resource_uuid, _ in resource_items:
+                like_list_key, dislike_list_key = self._get_like_list_key(resource_uuid)
+                pipe.exists_many(like_list_key, dislike_list_key)
+                pipe.sorted_set_range(like_list_key)
+                pipe.sorted_set_range(dislike_list_key)
+        like_users_dict, dislike_users_dict = {}, {}
+        for index, (_, resource_id) in enumerate(resource_items):
+            like_exists, dislike_exists, like_users, dislike_users = pipe.results[index * 4:index * 4 + 4]
+            if not like_exists or not dislike_exists:
+                continue
+            like_users_dict[resource_id] = [user_id for user_id in like_users if user_id != 'PLACEHOLDER']
+            dislike_users_dict[resource_id] = [user_id for user_id in dislike_users if user_id != 'PLACEHOLDER']
+        self._set_sql_like_users(metadata_model, 'like_users', like_users_dict)
+        self._set_sql_like_users(metadata_model, 'dislike_users', dislike_users_dict)
+
+    @staticmethod
+    def _set_sql_like_users(metadata_model, field_name, user_ids_dict):
+        if not user_ids_dict:
+            return
+        field = metadata_model._meta.get_field(field_name)
+        through = getattr(metadata_model, field_name).through
+        source_field = '%s_id' % field.m2m_field_name()
+        target_field = '%s_id' % field.m2m_reverse_field_name()
+        user_pairs = set((source_id, int(user_id))
+                         for source_id, user_ids in user_ids_dict.items() for user_id in user_ids)
+        sql_pairs = {}
+        for through_id, source_id, user_id in through.objects.filter(
+                **{'%s__in' % source_field: list(user_ids_dict)}).values_list('id', source_field, target_field):
+            sql_pairs[(source_id, user_id)] = through_id
+        remove_ids = [through_id for pair, through_id in sql_pairs.items() if pair not in user_pairs]
+        if remove_ids:
+            through.objects.filter(id__in=remove_ids).delete()
+        add_pairs = user_pairs.difference(sql_pairs)
+        if add_pairs:
+            user_ids = set(User.objects.filter(id__in=set(user_id for _, user_id in add_pairs))
+                           .values_list('id', flat=True))
+            through.objects.bulk_create([through(**{source_field: source_id, target_field: user_id})
+                                         for source_id, user_id in add_pairs if user_id in user_ids],
+                                        batch_size=1000)
+
+    def _get_dirty_key(self):
+        return '%s&%s' % (self.METADATA_KEY, 'DIRTY')
 
     def _get_like_list_key(self, resource_uuid):
         like_list_key = '%s&%s' % (self.LIKE_LIST_KEY, resource_uuid)
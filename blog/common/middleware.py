@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+PROC_STATUS_PATH = '/proc/self/status'
+PROC_CLEAR_REFS_PATH = '/proc/self/clear_refs'
+
+
+class ServerTimingMiddleware(object):
+    # reports the request duration and the worker's peak resident memory while it ran,
+    # the peak is only reported when it was reset for this request and no other request overlapped it
+    __lock = threading.Lock()
+    __active = 0
+    __started = 0
+
+    def process_request(self, request):
+        with ServerTimingMiddleware.__lock:
+            peak_reset = ServerTimingMiddleware.__active == 0 and ServerTimingMiddleware._reset_peak_rss()
+            ServerTimingMiddleware.__active += 1
+            ServerTimingMiddleware.__started += 1
+            request.server_timing_seq = ServerTimingMiddleware.__started if peak_reset else None
+        request.server_timing_start = time.time()
+        request.server_timing_rss = ServerTimingMiddleware._get_rss('VmRSS')
+
+    def process_exception(self, request, exception):
+        if getattr(request, 'server_timing_start', None) is not None:
+            ServerTimingMiddleware._finish(request)
+
+    def process_response(self, request, response):
+        start = getattr(request, 'server_timing_start', None)
+        if start is None:
+            return response
+        exclusive = ServerTimingMiddleware._finish(request)
+        metrics = ['app;dur=%.1f' % ((time.time() - start) * 1000)]
+        peak_rss = ServerTimingMiddleware._get_rss('VmHWM') if exclusive else None
+        if peak_rss is not None:
+            start_rss = request.server_timing_rss
+            metrics.append('rss;desc="peak %dKB, +%dKB"' % (peak_rss, peak_rss - (start_rss or peak_rss)))
+        response['Server-Timing'] = ', '.join(metrics)
+        return response
+
+    @staticmethod
+    def _finish(request):
+        # leaves the in-flight count once per request, both exception and response hooks may run
+        # returns whether the peak rss of the process belongs to this request alone
+        if not getattr(request, 'server_timing_active', True):
+            return request.server_timing_exclusive
+        with ServerTimingMiddleware.__lock:
+            ServerTimingMiddleware.__active -= 1
+            seq = getattr(request, 'server_timing_seq', None)
+            request.server_timing_exclusive = seq is not None and seq == ServerTimingMiddleware.__started
+            request.server_timing_active = False
+        return request.server_timing_exclusive
+
+    @staticmethod
+    def _reset_peak_rss():
+        try:
+            with open(PROC_CLEAR_REFS_PATH, 'w') as clear_refs:
+                clear_refs.write('5')
+            return True
+        except (IOError, OSError):
+            return False
+
+    @staticmethod
+    def _get_rss(key):
+        try:
+            with open(PROC_STATUS_PATH) as status:
+                for line in status:
+                    if line.startswith(key + ':'):
+                        return int(line.split()[1])
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+        return None
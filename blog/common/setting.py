@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import time
+import threading
+
 from blog.account.models import ServerSetting
 from blog.common.utils import StaticObject
 from blog.common.error import ServerError
 from blog.common.message import ErrorMsg
+from blog.settings import SETTING_CHECK_INTERVAL
 
 
 class Setting(StaticObject):
@@ -30,31 +34,54 @@ class Setting(StaticObject):
     PHOTO_SMALL_SIZE = 200
     HOT_EXPIRATION_TIME = 604800
 
-    __instance = True
+    # bumped by saves and deletes of ServerSetting rows, other edits need the reload_setting command
+    _VERSION_KEY = 'SERVER_SETTING_VERSION'
+
+    __snapshot = None
+    __version = None
+    __check_time = 0
+    __lock = threading.Lock()
 
     def __init__(self):
         super(Setting, self).__init__()
         self._init_setting()
+        # an instance keeps the snapshot it was created with, reloads never mix old and new values
+        self.__dict__.update(Setting.__snapshot)
 
     @classmethod
-    def load_setting(cls):
-        settings = ServerSetting.objects.all()
+    def load_setting(cls, version=None):
+        setting_keys = dict((v, k) for k, v in SettingKey())
+        settings = dict(ServerSetting.objects.filter(key__in=list(setting_keys)).values_list('key', 'value'))
+        if len(settings) != len(setting_keys):
+            raise ServerError(code=503, message=ErrorMsg.SETTING_ERROR)
         int_setting_keys = ['TOKEN_EXPIRATION_TIME', 'GUEST_ROLE',
                             'PHOTO_LARGE_SIZE', 'PHOTO_MIDDLE_SIZE',
                             'PHOTO_SMALL_SIZE', 'HOT_EXPIRATION_TIME']
-        try:
-            for k, v in SettingKey():
-                value = cls._format_value(settings.get(key=v).value, 'int') \
-                    if k in int_setting_keys else cls._format_value(settings.get(key=v).value)
-                setattr(cls, k, value)
-        except ServerSetting.DoesNotExist:
-            raise ServerError(code=503, message=ErrorMsg.SETTING_ERROR)
+        snapshot = {}
+        for v, k in setting_keys.items():
+            snapshot[k] = cls._format_value(settings[v], 'int') \
+                if k in int_setting_keys else cls._format_value(settings[v])
+        for k, value in snapshot.items():
+            setattr(cls, k, value)
+        cls.__snapshot, cls.__version = snapshot, version
+
+    @classmethod
+    def update_version(cls):
+        from blog.common.base import RedisClient
+        RedisClient().increase(cls._VERSION_KEY)
 
     @classmethod
     def _init_setting(cls):
-        if cls.__instance:
-            cls.load_setting()
-            cls.__instance = False
+        if cls.__snapshot is not None and time.time() - cls.__check_time < SETTING_CHECK_INTERVAL:
+            return
+        with cls.__lock:
+            if cls.__snapshot is not None and time.time() - cls.__check_time < SETTING_CHECK_INTERVAL:
+                return
+            from blog.common.base import RedisClient
+            version = RedisClient().get(name=cls._VERSION_KEY)
+            if cls.__snapshot is None or version != cls.__version:
+                cls.load_setting(version=version)
+            cls.__check_time = time.time()
 
     @classmethod
     def _format_value(cls, value, date_type='bool'):
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import base64
+import shutil
+import datetime
+import tempfile
+import uuid
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from blog.account.models import ServerSetting
+from blog.account.roles.models import Role
+from blog.account.users.models import User
+from blog.common import base
+from blog.common.base import RedisClient, CompiledPermission, LocalCache, Authorize
+from blog.common.setting import Setting, SettingKey
+from blog.common.utils import cursor_paging, cursor_encode, cursor_decode, CURSOR_NEXT, CURSOR_PREV
+from blog.settings import REDIS_DB, REDIS_TEST_DB
+
+
+class BlogTestCase(TestCase):
+    # base of the service tests, runs against its own Redis database emptied before every test
+    # and a temporary media root, and seeds the server settings rows with the defaults declared on Setting
+    @classmethod
+    def setUpClass(cls):
+        if REDIS_TEST_DB == REDIS_DB:
+            raise ImproperlyConfigured('REDIS_TEST_DB must differ from REDIS_DB, tests empty it')
+        cls.media_root = tempfile.mkdtemp()
+        cls.isolated_settings = override_settings(REDIS_DB=REDIS_TEST_DB, MEDIA_ROOT=cls.media_root)
+        cls.isolated_settings.enable()
+        try:
+            super(BlogTestCase, cls).setUpClass()
+        except Exception:
+            cls._restore_settings()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        super(BlogTestCase, cls).tearDownClass()
+        cls._restore_settings()
+
+    @classmethod
+    def setUpTestData(cls):
+        super(BlogTestCase, cls).setUpTestData()
+        ServerSetting.objects.bulk_create([ServerSetting(key=key, value=cls._format_setting(getattr(Setting, name)))
+                                           for name, key in SettingKey()])
+
+    def setUp(self):
+        super(BlogTestCase, self).setUp()
+        RedisClient().client.flushdb()
+
+    @classmethod
+    def _restore_settings(cls):
+        cls.isolated_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    @staticmethod
+    def _format_setting(value):
+        if isinstance(value, bool):
+            return 'on' if value else 'off'
+        return str(value)
+
+
+class ListVisibilityMixin(object):
+    # list() must return exactly the rows the per-row permission check of self.service lets through,
+    # the first grant profile sees a part of the rows and the last one every row
+    def assert_list_visibility(self, queryset, list_key, has_get_permission, grant_profiles, **list_kwargs):
+        visible_list = []
+        for grants in grant_profiles:
+            self.set_grants(grants)
+            _, data = self.service.list(**list_kwargs)
+            visible = set(instance.uuid for instance in queryset.all() if has_get_permission(instance))
+            self.assertEqual(set(item['uuid'] for item in data[list_key]), visible)
+            visible_list.append(visible)
+        self.assertLess(len(visible_list[0]), len(visible_list[-1]))
+        self.assertEqual(len(visible_list[-1]), queryset.count())
+        return visible_list
+
+    def set_grants(self, grants):
+        self.service.permission = CompiledPermission(grants)
+        self.service.cache.clear()
+
+
+class SettingVersionTest(BlogTestCase):
+    def test_bulk_edits_need_reload(self):
+        ServerSetting.objects.filter(key=SettingKey.SIGN_UP).update(value='off')
+        self.assertIsNone(RedisClient().get(Setting._VERSION_KEY))
+        call_command('reload_setting')
+        self.assertEqual(RedisClient().get(Setting._VERSION_KEY), '1')
+        setting = ServerSetting.objects.get(key=SettingKey.SIGN_UP)
+        setting.value = 'on'
+        setting.save()
+        self.assertEqual(RedisClient().get(Setting._VERSION_KEY), '2')
+
+
+class LocalCacheRevokeTest(BlogTestCase):
+    def setUp(self):
+        super(LocalCacheRevokeTest, self).setUp()
+        self.loads = []
+        self.workers = [LocalCache(version_key='TEST_VERSION', size=10, check_interval=0,
+                                   revoke_key='TEST_REVOKED', revoke_size=2) for _ in range(2)]
+
+    def _load(self, key):
+        self.loads.append(key)
+        return key.upper()
+
+    def _fill(self, worker, keys):
+        for key in keys:
+            self.assertEqual(worker.get(key, self._load), key.upper())
+
+    def test_revoke_reaches_other_workers(self):
+        for worker in self.workers:
+            self._fill(worker, ['a', 'b', 'c'])
+        self.workers[0].revoke('a')
+        del self.loads[:]
+        self._fill(self.workers[1], ['a', 'b', 'c'])
+        self.assertEqual(self.loads, ['a'])
+
+    def test_trimmed_log_drops_everything(self):
+        self._fill(self.workers[1], ['a', 'b', 'c', 'd'])
+        for key in ('a', 'b', 'c'):
+            self.workers[0].revoke(key)
+        del self.loads[:]
+        self._fill(self.workers[1], ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.loads, ['a', 'b', 'c', 'd'])
+
+    def test_version_bump_drops_everything(self):
+        self._fill(self.workers[1], ['a', 'b'])
+        self.workers[0].update_version()
+        del self.loads[:]
+        self._fill(self.workers[1], ['a', 'b'])
+        self.assertEqual(self.loads, ['a', 'b'])
+
+
+class UpdateTokenTest(BlogTestCase):
+    def setUp(self):
+        super(UpdateTokenTest, self).setUp()
+        self.role, self.other_role = Role.objects.create(name='role', nick='role'), \
+            Role.objects.create(name='other', nick='other')
+        self.user = User.objects.create(uuid=str(uuid.uuid4()), username='token_user', password='password',
+                                        nick='token_user', role=self.role)
+        self.token_signed = base.TOKEN_SIGNED
+
+    def tearDown(self):
+        base.TOKEN_SIGNED = self.token_signed
+        super(UpdateTokenTest, self).tearDown()
+
+    def _get_revoked(self):
+        return RedisClient().sorted_set_range('TOKEN_SESSION_REVOKED', desc=False)
+
+    def test_unchanged_role_keeps_session(self):
+        Authorize().gen_token(uuid=self.user.uuid)
+        Authorize().update_token(uuid=self.user.uuid, role_id=str(self.role.id), update_stamp=False)
+        self.assertEqual(self._get_revoked(), [])
+        Authorize().update_token(uuid=self.user.uuid, role_id=str(self.other_role.id), update_stamp=False)
+        self.assertEqual(self._get_revoked(), [self.user.uuid])
+        self.assertEqual(RedisClient().get('TOKEN_SESSION_VERSION'), None)
+
+    def test_signed_token(self):
+        for signed, flag in ((False, Authorize.TOKEN_FLAG), (True, Authorize.SIGNED_FLAG)):
+            base.TOKEN_SIGNED = signed
+            Authorize().gen_token(uuid=self.user.uuid)
+            token = Authorize().update_token(uuid=self.user.uuid, role_id=self.other_role.id)
+            self.assertTrue(token.startswith(flag))
+            self.assertEqual(Authorize().auth_token(token=token), (self.user.uuid, self.user.id, self.other_role.id))
+
+
+def encode_raw_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value)).rstrip('=')
+
+
+class CursorCodecTest(TestCase):
+    def test_round_trip(self):
+        create_at = datetime.datetime(2017, 5, 1, 8, 30, 15)
+        for direction, value, row_id in ((CURSOR_NEXT, None, 1), (CURSOR_PREV, u'b', 42),
+                                         (CURSOR_NEXT, 7, 3), (CURSOR_PREV, create_at, 9)):
+            expected = create_at.isoformat() if value is create_at else value
+            self.assertEqual(cursor_decode(cursor_encode(direction, value, row_id)), (direction, expected, row_id))
+
+    def test_undecodable(self):
+        for cursor in (None, '', 'not a cursor', '!!!!', encode_raw_cursor('n'), encode_raw_cursor(['x', 'a', 1]),
+                       encode_raw_cursor(['n', 'a']), encode_raw_cursor(['n', 'a', 'id']),
+                       encode_raw_cursor({'n': 1, 'a': 2, 'b': 3})):
+            self.assertIsNone(cursor_decode(cursor))
+
+
+class CursorPagingTest(TestCase):
+    def setUp(self):
+        for index, qq in enumerate((None, 'b', None, 'a', 'b', 'c', 'b', None, 'a')):
+            User.objects.create(uuid=str(uuid.uuid4()), username='cursor_%d' % index, password='password',
+                                nick='cursor_%d' % index, qq=qq)
+
+    @staticmethod
+    def _expected(desc):
+        # MySQL sorts NULL first, row ids break ties in the direction of the sort
+        users = User.objects.all()
+        null_ids = [user.id for user in users if user.qq is None]
+        value_ids = [user.id for user in sorted((user for user in users if user.qq is not None),
+                                                key=lambda user: (user.qq, user.id))]
+        return list(reversed(null_ids + value_ids)) if desc else null_ids + value_ids
+
+    @staticmethod
+    def _walk(users, cursor=None, direction='next_cursor'):
+        pages = []
+        while True:
+            page_list, page_dict = cursor_paging(users, cursor=cursor, page_size=2)
+            pages.append([user.id for user in page_list])
+            cursor = page_dict[direction]
+            if cursor is None:
+                return pages, page_dict
+
+    def test_nulls_and_ties_ascending(self):
+        pages, _ = self._walk(User.objects.order_by('qq'))
+        self.assertEqual(sum(pages, []), self._expected(desc=False))
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 2, 1])
+
+    def test_nulls_and_ties_descending(self):
+        pages, _ = self._walk(User.objects.order_by('-qq'))
+        self.assertEqual(sum(pages, []), self._expected(desc=True))
+
+    def test_backward(self):
+        for order_field in ('qq', '-qq'):
+            users = User.objects.order_by(order_field)
+            pages, last_page_dict = self._walk(users)
+            back_pages, first_page_dict = self._walk(users, cursor=last_page_dict['prev_cursor'],
+                                                     direction='prev_cursor')
+            self.assertEqual(list(reversed(back_pages)), pages[:-1])
+            page_list, _ = cursor_paging(users, cursor=first_page_dict['next_cursor'], page_size=2)
+            self.assertEqual([user.id for user in page_list], pages[1])
+
+    def _assert_first_page(self, users, cursors):
+        first_page, _ = cursor_paging(users, page_size=2)
+        for cursor in cursors:
+            page_list, page_dict = cursor_paging(users, cursor=cursor, page_size=2)
+            self.assertEqual(page_list, first_page)
+            self.assertIsNone(page_dict['prev_cursor'])
+
+    def test_undecodable_or_tampered_cursor(self):
+        self._assert_first_page(User.objects.order_by('qq'), ['not a cursor', encode_raw_cursor(['n', 'a'])])
+        # values that do not fit the sort field
+        self._assert_first_page(User.objects.order_by('-create_at'),
+                                [encode_raw_cursor(['n', 'yesterday', 1]), encode_raw_cursor(['p', 'yesterday', 1])])
+        self._assert_first_page(User.objects.order_by('status'), [encode_raw_cursor(['n', 'high', 1])])
@@ -1,15 +1,29 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import re
+import json
+import hashlib
+import base64
+import datetime
+import mimetypes
 
 from Crypto.Hash import MD5
 from contextlib import contextmanager
 
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified, FileResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from django.db.models import Q
+from django.db.models.query import QuerySet
 from django.core.paginator import Paginator, EmptyPage, InvalidPage, PageNotAnInteger
+from django.core.exceptions import ValidationError
 from django.db.models.fields.files import ImageField, FileField
 from django.db.models.fields.related import ManyToManyField
+from django.core.files.uploadhandler import FileUploadHandler
+
+from blog.settings import MEDIA_SENDFILE_HEADER, MEDIA_SENDFILE_PREFIX, FILE_CHUNK_SIZE
 
 
 class _Const(object):
@@ -79,6 +93,124 @@ def json_response(fun):
     return wrapper
 
 
+class HashUploadHandler(FileUploadHandler):
+    # installed ahead of the storing handlers, every chunk is hashed on its way through and
+    # the sha256 of each uploaded file ends up in request.upload_digests by field name
+    def __init__(self, request=None):
+        super(HashUploadHandler, self).__init__(request)
+        self.sha256 = None
+        if request is not None:
+            request.upload_digests = {}
+
+    def new_file(self, *args, **kwargs):
+        super(HashUploadHandler, self).new_file(*args, **kwargs)
+        self.sha256 = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.request.upload_digests[self.field_name] = self.sha256.hexdigest()
+        return None
+
+
+def file_response(request, file_path, content_type=None, etag=None, last_modified=None, max_age=None):
+    if is_not_modified(request, etag=etag, last_modified=last_modified):
+        response = HttpResponseNotModified()
+    else:
+        response = _file_response(request, file_path, content_type=content_type,
+                                  etag=etag, last_modified=last_modified)
+    if etag is not None:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    if max_age is not None:
+        response['Cache-Control'] = 'private, max-age=%d' % max_age if max_age else 'private, no-cache'
+    return response
+
+
+def is_not_modified(request, etag=None, last_modified=None):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        etags = [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')]
+        return '*' in etags or etag.replace('W/', '', 1) in etags
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+    return last_modified is not None and if_modified_since is not None and int(last_modified) <= if_modified_since
+
+
+def _parse_range(range_header, size):
+    # only a single byte range is served, anything else falls back to the whole file
+    if not range_header or not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    start, _, end = range_header[6:].strip().partition('-')
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+        start, end = int(start), int(end) if end else None
+    except ValueError:
+        return None
+    if end is not None and start > end:
+        return None
+    if start >= size:
+        return False
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+def _file_iterator(file_obj, start, length, chunk_size=FILE_CHUNK_SIZE):
+    try:
+        file_obj.seek(start)
+        while length > 0:
+            data = file_obj.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        file_obj.close()
+
+
+def _file_response(request, file_path, content_type=None, etag=None, last_modified=None):
+    if content_type is None:
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    if MEDIA_SENDFILE_HEADER:
+        response = HttpResponse(content_type=content_type)
+        if MEDIA_SENDFILE_HEADER == 'X-Accel-Redirect':
+            response[MEDIA_SENDFILE_HEADER] = MEDIA_SENDFILE_PREFIX + \
+                os.path.relpath(file_path, settings.MEDIA_ROOT).replace(os.sep, '/')
+        else:
+            response[MEDIA_SENDFILE_HEADER] = file_path
+        return response
+    size = os.path.getsize(file_path)
+    byte_range = _parse_range(request.META.get('HTTP_RANGE'), size)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if byte_range and if_range and if_range != etag and \
+            (last_modified is None or parse_http_date_safe(if_range) != int(last_modified)):
+        byte_range = None
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+    elif byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(_file_iterator(open(file_path, 'rb'), start, end - start + 1),
+                                         status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = end - start + 1
+    else:
+        response = FileResponse(open(file_path, 'rb'), content_type=content_type)
+        response.block_size = FILE_CHUNK_SIZE
+        response['Content-Length'] = size
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
 @contextmanager
 def ignored(*exceptions):
     try:
@@ -88,7 +220,7 @@ def ignored(*exceptions):
 
 
 def paging(object_list, page=0, page_size=10):
-    total = len(object_list)
+    total = object_list.count() if isinstance(object_list, QuerySet) else len(object_list)
     if page <= 0:
         return object_list, total
     try:
@@ -101,6 +233,76 @@ def paging(object_list, page=0, page_size=10):
     return page_list, total
 
 
+CURSOR_NEXT = 'n'
+CURSOR_PREV = 'p'
+
+
+def cursor_paging(object_list, cursor=None, page_size=10):
+    order_by = object_list.query.order_by or object_list.model._meta.ordering or ['id']
+    desc = order_by[0].startswith('-')
+    field = order_by[0].lstrip('-')
+    field = 'id' if field == 'pk' else field
+    position = cursor_decode(cursor)
+    backward = position is not None and position[0] == CURSOR_PREV
+    if position is not None:
+        try:
+            object_list = object_list.filter(_cursor_query(field, position[1], position[2], desc != backward))
+        except (ValidationError, ValueError, TypeError):
+            # a value that does not fit the sort field starts over like an undecodable cursor
+            position, backward = None, False
+    if desc != backward:
+        object_list = object_list.order_by('-' + field, '-id')
+    else:
+        object_list = object_list.order_by(field, 'id')
+    keys = list(object_list.values_list(field, 'id')[:page_size + 1])
+    has_more = len(keys) > page_size
+    keys = keys[:page_size]
+    page_list = list(object_list.filter(id__in=[key[1] for key in keys])) if keys else []
+    next_cursor, prev_cursor = None, None
+    if backward:
+        keys.reverse()
+        page_list.reverse()
+        if keys:
+            next_cursor = cursor_encode(CURSOR_NEXT, *keys[-1])
+            prev_cursor = cursor_encode(CURSOR_PREV, *keys[0]) if has_more else None
+    elif keys:
+        next_cursor = cursor_encode(CURSOR_NEXT, *keys[-1]) if has_more else None
+        prev_cursor = cursor_encode(CURSOR_PREV, *keys[0]) if position is not None else None
+    return page_list, {'next_cursor': next_cursor, 'prev_cursor': prev_cursor}
+
+
+def cursor_encode(direction, value, row_id):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([direction, value, row_id])).rstrip('=')
+
+
+def cursor_decode(cursor):
+    if not cursor:
+        return None
+    try:
+        direction, value, row_id = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+        if direction not in (CURSOR_NEXT, CURSOR_PREV):
+            return None
+        return direction, value, int(row_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _cursor_query(field, value, row_id, desc):
+    # MySQL sorts NULL before any value, so NULL rows open an ascending scan and close a descending one
+    if field == 'id':
+        return Q(id__lt=row_id) if desc else Q(id__gt=row_id)
+    if value is None:
+        if desc:
+            return Q(**{field + '__isnull': True, 'id__lt': row_id})
+        return Q(**{field + '__isnull': False}) | Q(**{field + '__isnull': True, 'id__gt': row_id})
+    if desc:
+        return Q(**{field + '__lt': value}) | Q(**{field: value, 'id__lt': row_id}) | \
+            Q(**{field + '__isnull': True})
+    return Q(**{field + '__gt': value}) | Q(**{field: value, 'id__gt': row_id})
+
+
 def model_to_dict(instance, **kwargs):
     if not hasattr(instance, '_meta'):
         return instance
@@ -165,5 +367,5 @@ def encode(data, salt):
 
 def get_md5(data):
     md5 = MD5.new()
-    md5.update(data)
+    md5.update(data.encode('utf-8') if isinstance(data, unicode) else data)
     return md5.hexdigest()
@@ -13,7 +13,7 @@ from blog.content.photos.models import Photo
 from blog.common.base import Service, MetadataService
 from blog.common.error import ServiceError
 from blog.common.message import ErrorMsg, AccountErrorMsg, ContentErrorMsg
-from blog.common.utils import paging, str_to_list, model_to_dict
+from blog.common.utils import paging, cursor_paging, str_to_list, model_to_dict
 from blog.common.setting import PermissionName, Setting
 
 
@@ -52,7 +52,7 @@ class AlbumService(Service):
         return 200, album_dict
 
     def list(self, page=0, page_size=10, author_uuid=None, privacy=None, system=None,
-             order_field=None, order='desc', query=None, query_field=None):
+             order_field=None, order='desc', query=None, query_field=None, cursor=None):
         query_level, order_level = self.get_permission_level(PermissionName.ALBUM_SELECT)
         albums = Album.objects.all()
         if author_uuid:
@@ -94,20 +94,23 @@ class AlbumService(Service):
             else:
                 raise ServiceError(code=403,
                                    message=ErrorMsg.QUERY_PERMISSION_DENIED)
-        # Todo fix performance issue
-        for album in albums:
-            if not self.has_get_permission(album=album):
-                albums = albums.exclude(id=album.id)
-        albums, total = paging(albums, page=page, page_size=page_size)
+        get_level, _ = self.get_permission_level(PermissionName.ALBUM_PRIVACY, False)
+        if get_level.is_lt_lv10():
+            albums = albums.filter(Q(author_id=self.uid) | Q(privacy=Album.PUBLIC))
+        if cursor is None:
+            albums, total = paging(albums, page=page, page_size=page_size)
+            page_dict = {'total': total}
+        else:
+            albums, page_dict = cursor_paging(albums, cursor=cursor, page_size=page_size)
         album_dict_list = []
-        for album in albums:
-            metadata = AlbumMetadataService().get_metadata_count(resource=album)
-            is_like_user = AlbumMetadataService().is_like_user(resource=album, user_id=self.uid)
+        metadata_list = AlbumMetadataService().get_metadata_many(resources=albums, user_id=self.uid)
+        for album, (metadata, is_like_user) in zip(albums, metadata_list):
             album_dict = AlbumService._album_to_dict(album=album,
                                                      metadata=metadata,
                                                      is_like_user=is_like_user)
             album_dict_list.append(album_dict)
-        return 200, {'albums': album_dict_list, 'total': total}
+        page_dict['albums'] = album_dict_list
+        return 200, page_dict
 
     def create(self, name, description=None, cover_uuid=None, author_uuid=None,
                privacy=Album.PUBLIC, system=None):
@@ -144,8 +147,7 @@ class AlbumService(Service):
             raise ServiceError(code=404,
                                message=ContentErrorMsg.ALBUM_NOT_FOUND)
         if like_operate is not None:
-            metadata = self._update_like_list(album=album, operate=like_operate)
-            is_like_user = AlbumMetadataService().is_like_user(resource=album, user_id=self.uid)
+            metadata, is_like_user = self._update_like_list(album=album, operate=like_operate)
             return 200, AlbumService._album_to_dict(album=album,
                                                     metadata=metadata,
                                                     is_like_user=is_like_user)
@@ -265,11 +267,5 @@ class AlbumMetadataService(MetadataService):
             user_dict['dislike_users'] = dislike_users
         return metadata, user_dict
 
-    def _set_sql_metadata(self, resource_uuid, metadata):
-        like_list_key, dislike_list_key = self._get_like_list_key(resource_uuid)
-        try:
-            album = Album.objects.get(uuid=resource_uuid)
-            self._set_resource_sql_metadata(album, metadata, like_list_key, dislike_list_key)
-        except Album.DoesNotExist:
-            self.redis_client.hash_delete(self.METADATA_KEY, resource_uuid)
-            self.redis_client.delete(like_list_key, dislike_list_key)
+    def _get_sql_resources(self, resource_uuids):
+        return Album.objects.filter(uuid__in=resource_uuids)
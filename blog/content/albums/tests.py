@@ -1,3 +1,196 @@
-from django.test import TestCase
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
-# Create your tests here.
+import uuid
+
+from django.db import DatabaseError
+
+from blog.account.users.models import User
+from blog.content.albums.models import Album, AlbumMetaData
+from blog.content.albums.services import AlbumService, AlbumMetadataService
+from blog.common.setting import PermissionName, AuthType
+from blog.common.tests import BlogTestCase, ListVisibilityMixin
+
+
+class AlbumListVisibilityTest(ListVisibilityMixin, BlogTestCase):
+    def setUp(self):
+        super(AlbumListVisibilityTest, self).setUp()
+        self.user, other = [User.objects.create(uuid=str(uuid.uuid4()), username=username,
+                                                password='password', nick=username)
+                            for username in ('album_author', 'album_other')]
+        for author in (self.user, other):
+            for privacy, _ in Album.PRIVACY_CHOICES:
+                Album.objects.create(uuid=str(uuid.uuid4()), name='album', author=author, privacy=privacy)
+        self.service = AlbumService(auth_type=AuthType.NONE)
+        self.service.uid = self.user.id
+
+    def test_list_matches_get_permission(self):
+        self.assert_list_visibility(Album.objects.all(), 'albums',
+                                    lambda album: self.service.has_get_permission(album=album),
+                                    [{}, {PermissionName.ALBUM_PRIVACY: {'state': True, 'major_level': 1000}}])
+
+
+class AlbumMetadataTestCase(BlogTestCase):
+    def setUp(self):
+        super(AlbumMetadataTestCase, self).setUp()
+        self.users = [User.objects.create(uuid=str(uuid.uuid4()), username='metadata_%s' % index,
+                                          password='password', nick='metadata_%s' % index)
+                      for index in range(3)]
+        self.albums = [Album.objects.create(uuid=str(uuid.uuid4()), name='album', author=self.users[0])
+                       for _ in range(3)]
+        self.service = AlbumMetadataService()
+        self.dirty_key = self.service._get_dirty_key()
+
+
+class AlbumLikeListTest(AlbumMetadataTestCase):
+    def test_like_then_unlike(self):
+        album, user = self.albums[0], self.users[1]
+        metadata, state = self.service.update_like_list(resource=album, user_id=user.id)
+        self.assertEqual((metadata.like_count, metadata.dislike_count, state), (1, 0, AlbumMetadataService.LIKE_USER))
+        metadata, state = self.service.update_like_list(resource=album, user_id=user.id)
+        self.assertEqual((metadata.like_count, metadata.dislike_count, state), (0, 0, AlbumMetadataService.NONE_USER))
+        self.assertEqual(self.service.is_like_user(resource=album, user_id=user.id), AlbumMetadataService.NONE_USER)
+        self.assertIn(album.uuid, self.service.redis_client.set_all(self.dirty_key))
+
+    def test_dislike_replaces_like(self):
+        album, user = self.albums[0], self.users[1]
+        self.service.update_like_list(resource=album, user_id=user.id)
+        metadata, state = self.service.update_like_list(resource=album, user_id=user.id,
+                                                        operate=AlbumMetadataService.OPERATE_DISLIKE)
+        self.assertEqual((metadata.like_count, metadata.dislike_count, state),
+                         (0, 1, AlbumMetadataService.DISLIKE_USER))
+
+    def test_toggle_on_cold_cache(self):
+        album = self.albums[0]
+        album.metadata.like_users.add(self.users[1])
+        album.metadata.like_count = 1
+        album.metadata.read_count = 7
+        album.metadata.save()
+        metadata, state = self.service.update_like_list(resource=album, user_id=self.users[2].id)
+        self.assertEqual((metadata.read_count, metadata.like_count, state), (7, 2, AlbumMetadataService.LIKE_USER))
+        self.assertEqual(self.service.is_like_user(resource=album, user_id=self.users[1].id),
+                         AlbumMetadataService.LIKE_USER)
+        _, like_users, _ = self.service.get_metadata(resource=album)
+        self.assertEqual(like_users, [str(self.users[2].id), str(self.users[1].id)])
+
+    def test_repeated_toggles(self):
+        album, user = self.albums[0], self.users[1]
+        for index in range(6):
+            metadata, state = self.service.update_like_list(resource=album, user_id=user.id)
+            liked = index % 2 == 0
+            self.assertEqual(metadata.like_count, 1 if liked else 0)
+            self.assertEqual(state, AlbumMetadataService.LIKE_USER if liked else AlbumMetadataService.NONE_USER)
+        metadata, state = self.service.update_like_list(resource=album, user_id=self.users[2].id)
+        self.assertEqual((metadata.like_count, state), (1, AlbumMetadataService.LIKE_USER))
+
+
+class FailingAlbumMetadataService(AlbumMetadataService):
+    def _set_sql_metadata_many(self, metadata_dict):
+        raise DatabaseError('sync failed')
+
+
+class AlbumMetadataSyncTest(AlbumMetadataTestCase):
+    def _update(self):
+        for album in self.albums:
+            self.service.update_metadata_count(resource=album, read_count=AlbumMetadataService.OPERATE_ADD)
+        self.service.update_like_list(resource=self.albums[0], user_id=self.users[1].id)
+
+    def test_sync_drains_dirty_set(self):
+        self._update()
+        self.service.sync_metadata(batch_size=2)
+        self.assertEqual(self.service.redis_client.set_count(self.dirty_key), 0)
+        self.assertEqual([metadata.read_count for metadata in AlbumMetaData.objects.order_by('album_id')], [1, 1, 1])
+        metadata = AlbumMetaData.objects.get(album=self.albums[0])
+        self.assertEqual(metadata.like_count, 1)
+        self.assertEqual(list(metadata.like_users.values_list('id', flat=True)), [self.users[1].id])
+
+    def test_sync_failure_keeps_keys_dirty(self):
+        self._update()
+        with self.assertRaises(DatabaseError):
+            FailingAlbumMetadataService().sync_metadata(batch_size=2)
+        self.assertEqual(self.service.redis_client.set_all(self.dirty_key), set(album.uuid for album in self.albums))
+        self.assertEqual([metadata.read_count for metadata in AlbumMetaData.objects.all()], [0, 0, 0])
+        self.service.sync_metadata(batch_size=2)
+        self.assertEqual([metadata.read_count for metadata in AlbumMetaData.objects.all()], [1, 1, 1])
+
+
+class AlbumMetadataEvictTest(AlbumMetadataTestCase):
+    def _expire(self, album):
+        # as if the entry was last written at the epoch
+        value = self.service.redis_client.hash_get(name=self.service.METADATA_KEY, key=album.uuid)
+        self.service.redis_client.hash_set(name=self.service.METADATA_KEY, key=album.uuid,
+                                           value=value.rsplit('&', 1)[0] + '&0')
+
+    def _is_cached(self, album):
+        return self.service.redis_client.hash_get(name=self.service.METADATA_KEY, key=album.uuid) is not None
+
+    def test_dirty_entries_never_evicted(self):
+        dirty_album, clean_album = self.albums[:2]
+        self.service.update_like_list(resource=dirty_album, user_id=self.users[1].id)
+        self.service.get_metadata_count(resource=clean_album)
+        self._expire(dirty_album)
+        self._expire(clean_album)
+        self.service.evict_metadata()
+        self.assertTrue(self._is_cached(dirty_album))
+        self.assertTrue(all(self.service.redis_client.exists_many(*self.service._get_like_list_key(dirty_album.uuid))))
+        self.assertFalse(self._is_cached(clean_album))
+        self.service.sync_metadata()
+        self.service.evict_metadata()
+        self.assertFalse(self._is_cached(dirty_album))
+        self.assertFalse(any(self.service.redis_client.exists_many(*self.service._get_like_list_key(dirty_album.uuid))))
+        self.assertEqual(AlbumMetaData.objects.get(album=dirty_album).like_count, 1)
+
+    def test_recent_and_listed_entries_kept(self):
+        _, listed_album, cold_album = self.albums
+        for album in self.albums:
+            self.service.get_metadata_count(resource=album)
+        self._expire(listed_album)
+        self._expire(cold_album)
+        self.service.get_metadata_many(resources=[listed_album], user_id=None)
+        self.service.evict_metadata()
+        self.assertEqual([self._is_cached(album) for album in self.albums], [True, True, False])
+
+
+class AlbumMetadataSqlTest(AlbumMetadataTestCase):
+    @staticmethod
+    def _user_ids(album, field_name='like_users'):
+        return set(getattr(AlbumMetaData.objects.get(album=album), field_name).values_list('id', flat=True))
+
+    def test_like_users_added_and_removed(self):
+        album, emptied_album, other_album = self.albums
+        album.metadata.like_users.add(self.users[0], self.users[1])
+        emptied_album.metadata.like_users.add(self.users[2])
+        other_album.metadata.like_users.add(self.users[0])
+        through = AlbumMetaData.like_users.through
+        kept_id = through.objects.get(albummetadata_id=album.id, user_id=self.users[1].id).id
+        AlbumMetadataService._set_sql_like_users(AlbumMetaData, 'like_users', {
+            album.id: [str(self.users[1].id), str(self.users[2].id), '999999'],
+            emptied_album.id: []
+        })
+        self.assertEqual(self._user_ids(album), set([self.users[1].id, self.users[2].id]))
+        self.assertEqual(self._user_ids(emptied_album), set())
+        self.assertEqual(self._user_ids(other_album), set([self.users[0].id]))
+        self.assertTrue(through.objects.filter(id=kept_id).exists())
+
+    def test_metadata_many(self):
+        album, unlisted_album, untouched_album = self.albums
+        unlisted_album.metadata.like_users.add(self.users[0])
+        self.service._set_redis_like_list(resource=album, like_users=[self.users[0].id],
+                                          dislike_users=[self.users[1].id])
+        missing_uuid = str(uuid.uuid4())
+        self.service.redis_client.hash_set(name=self.service.METADATA_KEY, key=missing_uuid, value='1&0&0&0&0')
+        self.service._set_sql_metadata_many(metadata_dict={
+            album.uuid: AlbumMetadataService.Metadata(5, 4, 1, 1, 0),
+            unlisted_album.uuid: AlbumMetadataService.Metadata(2, 0, 1, 0, 0),
+            missing_uuid: AlbumMetadataService.Metadata(1, 0, 0, 0, 0)
+        })
+        counts = dict((metadata.album_id, (metadata.read_count, metadata.comment_count,
+                                           metadata.like_count, metadata.dislike_count))
+                      for metadata in AlbumMetaData.objects.all())
+        self.assertEqual(counts, {album.id: (5, 4, 1, 1), unlisted_album.id: (2, 0, 1, 0),
+                                  untouched_album.id: (0, 0, 0, 0)})
+        self.assertEqual(self._user_ids(album), set([self.users[0].id]))
+        self.assertEqual(self._user_ids(album, 'dislike_users'), set([self.users[1].id]))
+        # without cached like lists the sql like users are left as they are
+        self.assertEqual(self._user_ids(unlisted_album), set([self.users[0].id]))
+        self.assertIsNone(self.service.redis_client.hash_get(name=self.service.METADATA_KEY, key=missing_uuid))
@@ -96,6 +96,7 @@ def album_list(request):
     @apiUse Header
     @apiParam {number} [page=0] 相册信息列表页码, 页码为0时返回所有数据
     @apiParam {number} [page_size=10] 相册信息列表页长
+    @apiParam {string} [cursor] 相册信息列表游标, 传入时使用游标分页并忽略page参数, 空字符串返回第一页
     @apiParam {string} [author_uuid] 相册作者
     @apiParam {number=0, 1, 2} [privacy] 相册私有状态
     @apiParam {number=0, 1, 2, 3} [system] 系统相册类型, Avatar=0, AlbumCover=1, SectionCover=2, ArticleCover=3
@@ -103,7 +104,9 @@ def album_list(request):
     @apiParam {string=desc, asc} [order="desc"] 相册信息列表排序方向
     @apiParam {string} [query] 搜索内容，若无搜索字段则全局搜索name, description, author
     @apiParam {string=uuid, name, description, author, DjangoFilterParams} [query_field] 搜索字段, 支持Django filter参数
-    @apiSuccess {String} total 相册信息列表总数
+    @apiSuccess {String} total 相册信息列表总数, 游标分页时不返回
+    @apiSuccess {String} next_cursor 下一页游标, 仅游标分页时返回, 无下一页时为null
+    @apiSuccess {String} prev_cursor 上一页游标, 仅游标分页时返回, 无上一页时为null
     @apiSuccess {String} albums 相册信息列表
     @apiSuccessExample {json} Success-Response:
     HTTP/1.1 200 OK
@@ -146,7 +149,8 @@ def album_list(request):
         'order_field': str,
         'order': str,
         'query': str,
-        'query_field': str
+        'query_field': str,
+        'cursor': str
     }
     try:
         params_dict = request_parser(data=request.GET, params=params)
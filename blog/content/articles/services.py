@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import uuid
 import time
 
 from functools import reduce
 
-from django.db.models import Q
+from django.db.models import Q, Case, When, Value, BooleanField
 from django.utils import timezone
 from django.core.files.base import ContentFile
 
@@ -19,7 +20,7 @@ from blog.content.photos.models import Photo
 from blog.common.base import Service, MetadataService
 from blog.common.error import ServiceError
 from blog.common.message import ErrorMsg, ContentErrorMsg
-from blog.common.utils import paging, str_to_list, model_to_dict, html_to_str, get_md5
+from blog.common.utils import paging, cursor_paging, str_to_list, model_to_dict, html_to_str, get_md5
 from blog.common.setting import Setting, PermissionName, AuthType
 
 
@@ -67,9 +68,33 @@ class ArticleService(Service):
                                                        **like_user_dict)
         return 200, article_dict
 
+    def get_content(self, article_uuid):
+        self.has_permission(PermissionName.ARTICLE_SELECT)
+        try:
+            article = Article.objects.get(uuid=article_uuid)
+            get_permission, read_permission = self.has_get_permission(article=article)
+            if not get_permission:
+                raise Article.DoesNotExist
+            if not read_permission:
+                raise ServiceError(code=403, message=ErrorMsg.PERMISSION_DENIED)
+            if article.content_file:
+                content_stat = os.stat(article.content_file.path)
+                content_dict = {'path': article.content_file.path,
+                                'last_modified': int(content_stat.st_mtime)}
+                version = '%s&%s' % (int(content_stat.st_mtime), content_stat.st_size)
+            else:
+                content_dict = {'content': article.content or '',
+                                'last_modified': None}
+                version = get_md5(content_dict['content'])
+        except (OSError, Article.DoesNotExist):
+            raise ServiceError(code=404, message=ContentErrorMsg.ARTICLE_NOT_FOUND)
+        content_dict['etag'] = '"%s"' % get_md5('%s&%s&%s&%s&%s' % (article.uuid, version, article.status,
+                                                                   article.privacy, article.read_level))
+        return 200, content_dict
+
     def list(self, page=0, page_size=10, section_name=None, author_uuid=None,
              status=None, order_field=None, order='desc', query=None,
-             query_field=None):
+             query_field=None, cursor=None):
         query_level, order_level = self.get_permission_level(PermissionName.ARTICLE_SELECT)
         articles = Article.objects.all()
         if section_name:
@@ -119,26 +144,31 @@ class ArticleService(Service):
                                            Q(section__nick__icontains=query))
             else:
                 raise ServiceError(code=403, message=ErrorMsg.QUERY_PERMISSION_DENIED)
-        # Todo fix performance issue
-        article_read_list = {}
-        for article in articles:
-            get_permission, read_permission = self.has_get_permission(article=article)
-            if not get_permission:
-                articles = articles.exclude(id=article.id)
-            else:
-                article_read_list[article.id] = read_permission
-        articles, total = paging(articles, page=page, page_size=page_size)
+        get_query, read_query = self._get_list_query()
+        if get_query is not None:
+            articles = articles.filter(get_query)
+            read_permission = Case(When(read_query, then=Value(True)),
+                                   default=Value(False),
+                                   output_field=BooleanField())
+        else:
+            read_permission = Value(True, output_field=BooleanField())
+        articles = articles.annotate(read_permission=read_permission)
+        if cursor is None:
+            articles, total = paging(articles, page=page, page_size=page_size)
+            page_dict = {'total': total}
+        else:
+            articles, page_dict = cursor_paging(articles, cursor=cursor, page_size=page_size)
         article_dict_list = []
-        for article in articles:
-            metadata = ArticleMetadataService().get_metadata_count(resource=article)
-            is_like_user = ArticleMetadataService().is_like_user(resource=article, user_id=self.uid)
+        metadata_list = ArticleMetadataService().get_metadata_many(resources=articles, user_id=self.uid)
+        for article, (metadata, is_like_user) in zip(articles, metadata_list):
             article_dict = ArticleService._article_to_dict(article=article,
                                                            metadata=metadata,
                                                            content=False,
                                                            is_like_user=is_like_user,
-                                                           read_permission=article_read_list[article.id])
+                                                           read_permission=bool(article.read_permission))
             article_dict_list.append(article_dict)
-        return 200, {'articles': article_dict_list, 'total': total}
+        page_dict['articles'] = article_dict_list
+        return 200, page_dict
 
     def create(self, title, keywords=None, cover_uuid=None, overview=None,
                content=None, section_name=None, status=Article.AUDIT,
@@ -187,14 +217,13 @@ class ArticleService(Service):
             raise ServiceError(code=404,
                                message=ContentErrorMsg.ARTICLE_NOT_FOUND)
         if like_operate is not None:
-            metadata = self._update_like_list(article=article, operate=like_operate)
-            is_like_user = ArticleMetadataService().is_like_user(resource=article, user_id=self.uid)
+            metadata, is_like_user = self._update_like_list(article=article, operate=like_operate)
             return 200, ArticleService._article_to_dict(article=article,
                                                         metadata=metadata,
                                                         is_like_user=is_like_user)
         is_self = article.author_id == self.uid
         is_content_change, is_edit = False, False
-        set_role = SectionService.is_manager(user_uuid=self.uuid, section=article.section)
+        set_role = SectionService.is_manager(user_uuid=self.uuid, section=article.section, cache=self.cache)
         edit_permission = SectionService.has_set_permission(
             permission=article.section.permission.article_edit,
             set_role=set_role,
@@ -218,7 +247,7 @@ class ArticleService(Service):
             if section_name is not None and (not article.section or section_name != article.section.name):
                 section = self._get_section(section_name=section_name)
                 article.section, is_content_change = section, True
-                set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+                set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
             if privacy is not None and int(privacy) != article.privacy:
                 article.privacy, is_edit = self._get_privacy(privacy=privacy), True
             if read_level is not None and int(read_level) != article.read_level:
@@ -294,7 +323,7 @@ class ArticleService(Service):
             if (article.privacy == Article.PUBLIC or privacy_level.is_gt_lv10()) and \
                     (read_level >= article.read_level or read_permission_level.is_gt_lv10()):
                 return True, True
-            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
             if SectionService.has_set_permission(
                     permission=section.permission.article_audit,
                     set_role=set_role):
@@ -304,7 +333,7 @@ class ArticleService(Service):
             cancel_level, _ = self.get_permission_level(PermissionName.ARTICLE_CANCEL, False)
             if cancel_level.is_gt_lv10():
                 return True, True
-            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
             if SectionService.has_set_permission(
                     permission=section.permission.article_delete,
                     set_role=set_role):
@@ -313,31 +342,83 @@ class ArticleService(Service):
             audit_level, _ = self.get_permission_level(PermissionName.ARTICLE_AUDIT, False)
             if audit_level.is_gt_lv10():
                 return True, True
-            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
             if SectionService.has_set_permission(
                     permission=section.permission.article_audit,
                     set_role=set_role):
                 return True, True
         elif article.status == Article.DRAFT:
-            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
             if SectionService.has_set_permission(
                     permission=section.permission.article_draft,
                     set_role=set_role):
                 return True, True
         elif article.status == Article.RECYCLED:
-            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
             if SectionService.has_set_permission(
                     permission=section.permission.article_recycled,
                     set_role=set_role):
                 return True, True
         return False, False
 
+    def _get_list_query(self):
+        permission_level, _ = self.get_permission_level(PermissionName.ARTICLE_PERMISSION, False)
+        if permission_level.is_gt_lv10():
+            return None, None
+        privacy_level, _ = self.get_permission_level(PermissionName.ARTICLE_PRIVACY, False)
+        read_permission_level, _ = self.get_permission_level(PermissionName.ARTICLE_READ, False)
+        cancel_level, _ = self.get_permission_level(PermissionName.ARTICLE_CANCEL, False)
+        audit_level, _ = self.get_permission_level(PermissionName.ARTICLE_AUDIT, False)
+        read_level = self.get_permission_value(PermissionName.READ_LEVEL, False)
+        read_query = Q(author_id=self.uid) & ~Q(status=Article.CANCEL)
+        get_query = read_query
+        section_ids, section_status_dict = [], {}
+        sections = list(Section.objects.select_related('permission').all())
+        set_roles = SectionService.is_manager_many(user_uuid=self.uuid, sections=sections, cache=self.cache)
+        for section in sections:
+            _, read_permission = self.section_service.has_get_permission(section)
+            if not read_permission:
+                continue
+            section_ids.append(section.id)
+            set_role = set_roles[section.id]
+            permission = section.permission
+            status_list = []
+            if SectionService.has_set_permission(permission=permission.article_audit, set_role=set_role):
+                status_list.extend([Article.ACTIVE, Article.AUDIT, Article.FAILED])
+            if SectionService.has_set_permission(permission=permission.article_delete, set_role=set_role):
+                status_list.append(Article.CANCEL)
+            if SectionService.has_set_permission(permission=permission.article_draft, set_role=set_role):
+                status_list.append(Article.DRAFT)
+            if SectionService.has_set_permission(permission=permission.article_recycled, set_role=set_role):
+                status_list.append(Article.RECYCLED)
+            if status_list:
+                section_status_dict.setdefault(tuple(sorted(set(status_list))), []).append(section.id)
+        if section_ids:
+            active_query = Q(status=Article.ACTIVE)
+            if privacy_level.is_lt_lv10():
+                active_query &= Q(privacy=Article.PUBLIC)
+            if read_permission_level.is_lt_lv10():
+                active_query &= Q(read_level__lte=read_level)
+            status_list = []
+            if cancel_level.is_gt_lv10():
+                status_list.append(Article.CANCEL)
+            if audit_level.is_gt_lv10():
+                status_list.extend([Article.AUDIT, Article.FAILED])
+            if status_list:
+                active_query |= Q(status__in=status_list)
+            read_query |= Q(section_id__in=section_ids) & active_query
+            for status_list, manage_section_ids in section_status_dict.items():
+                read_query |= Q(section_id__in=manage_section_ids, status__in=status_list)
+            get_query = read_query | Q(section_id__in=section_ids, status=Article.ACTIVE) & \
+                ~Q(privacy=Article.PRIVATE)
+        return get_query, read_query
+
     def _has_delete_permission(self, article):
         delete_level, _ = self.get_permission_level(PermissionName.ARTICLE_DELETE, False)
         is_self = article.author_id == self.uid
         if delete_level.is_gt_lv10() or is_self and delete_level.is_gt_lv1():
             return True
-        set_role = SectionService.is_manager(user_uuid=self.uuid, section=article.section)
+        set_role = SectionService.is_manager(user_uuid=self.uuid, section=article.section, cache=self.cache)
         if SectionService.has_set_permission(
                 permission=article.section.permission.article_delete,
                 set_role=set_role):
@@ -349,7 +430,7 @@ class ArticleService(Service):
         is_self = article.author_id == self.uid
         if cancel_level.is_gt_lv10() or is_self and cancel_level.is_gt_lv1():
             return True
-        set_role = SectionService.is_manager(user_uuid=self.uuid, section=article.section)
+        set_role = SectionService.is_manager(user_uuid=self.uuid, section=article.section, cache=self.cache)
         if SectionService.has_set_permission(
                 permission=article.section.permission.article_cancel,
                 set_role=set_role):
@@ -395,7 +476,7 @@ class ArticleService(Service):
             if not section or not Setting().ARTICLE_AUDIT:
                 return Article.ACTIVE
             _, audit_level = self.get_permission_level(PermissionName.ARTICLE_AUDIT, False)
-            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
             if SectionService.has_set_permission(permission=section.permission.article_audit,
                                                  set_role=set_role,
                                                  op=audit_level.is_gt_lv10()):
@@ -404,7 +485,7 @@ class ArticleService(Service):
         if status == Article.CANCEL:
             if section and Setting().ARTICLE_CANCEL:
                 _, cancel_level = self.get_permission_level(PermissionName.ARTICLE_CANCEL, False)
-                set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+                set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
                 if SectionService.has_set_permission(permission=section.permission.article_cancel,
                                                      set_role=set_role,
                                                      op=cancel_level.is_gt_lv10()):
@@ -540,6 +621,7 @@ class ArticleService(Service):
             del article_dict['content']
         elif article.content_file:
             article_dict['content'] = article.content_file.read()
+            article.content_file.close()
         UserService.dict_add_user(article.author, article_dict, 'author')
         UserService.dict_add_user(article.last_editor, article_dict, 'last_editor')
         if article.section:
@@ -576,11 +658,5 @@ class ArticleMetadataService(MetadataService):
             user_dict['dislike_users'] = dislike_users
         return metadata, user_dict
 
-    def _set_sql_metadata(self, resource_uuid, metadata):
-        like_list_key, dislike_list_key = self._get_like_list_key(resource_uuid)
-        try:
-            article = Article.objects.get(uuid=resource_uuid)
-            self._set_resource_sql_metadata(article, metadata, like_list_key, dislike_list_key)
-        except Article.DoesNotExist:
-            self.redis_client.hash_delete(self.METADATA_KEY, resource_uuid)
-            self.redis_client.delete(like_list_key, dislike_list_key)
+    def _get_sql_resources(self, resource_uuids):
+        return Article.objects.filter(uuid__in=resource_uuids)
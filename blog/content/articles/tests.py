@@ -1,3 +1,84 @@
-from django.test import TestCase
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
-# Create your tests here.
+import uuid
+
+from blog.account.users.models import User
+from blog.content.articles.models import Article
+from blog.content.articles.services import ArticleService
+from blog.content.sections.models import Section
+from blog.content.sections.services import SectionMetadataService
+from blog.common.setting import PermissionName, AuthType
+from blog.common.tests import BlogTestCase, ListVisibilityMixin
+
+
+class ArticleListVisibilityTest(ListVisibilityMixin, BlogTestCase):
+    def setUp(self):
+        super(ArticleListVisibilityTest, self).setUp()
+        self.user, other = [User.objects.create(uuid=str(uuid.uuid4()), username=username,
+                                                password='password', nick=username)
+                            for username in ('article_author', 'article_other')]
+        open_section = Section.objects.create(name='open', nick='open', owner=other)
+        moderated_section = Section.objects.create(name='moderated', nick='moderated', owner=other)
+        moderated_section.moderators.add(self.user)
+        assisted_section = Section.objects.create(name='assisted', nick='assisted', owner=other)
+        assisted_section.assistants.add(self.user)
+        closed_section = Section.objects.create(name='closed', nick='closed', owner=other, read_level=1000)
+        role_section = Section.objects.create(name='role', nick='role', owner=other, only_roles=True)
+        cancel_section = Section.objects.create(name='cancel', nick='cancel', owner=other, status=Section.CANCEL)
+        for section in (None, open_section, moderated_section, assisted_section, closed_section, role_section,
+                        cancel_section):
+            if section:
+                SectionMetadataService().clear_manager(section=section)
+            for author in (self.user, other):
+                for status, _ in Article.STATUS_CHOICES:
+                    for privacy, _ in Article.PRIVACY_CHOICES:
+                        for read_level in (50, 200):
+                            Article.objects.create(uuid=str(uuid.uuid4()), title='article', overview='article',
+                                                   author=author, last_editor=author, section=section,
+                                                   status=status, privacy=privacy, read_level=read_level)
+        self.service = ArticleService(auth_type=AuthType.NONE)
+        self.service.uuid, self.service.uid = self.user.uuid, self.user.id
+
+    def set_grants(self, grants):
+        super(ArticleListVisibilityTest, self).set_grants(grants)
+        # the section service copied the permission when the article service was built
+        self.service.section_service.permission = self.service.permission
+
+    @staticmethod
+    def _get_grant_profiles():
+        granted = {'state': True, 'major_level': 1000, 'minor_level': 1000}
+        grant_profiles = [{},
+                          {PermissionName.ARTICLE_PRIVACY: granted},
+                          {PermissionName.ARTICLE_READ: granted},
+                          {PermissionName.ARTICLE_CANCEL: granted, PermissionName.ARTICLE_AUDIT: granted},
+                          {PermissionName.SECTION_PERMISSION: granted},
+                          {PermissionName.ARTICLE_PERMISSION: granted}]
+        for grants in grant_profiles:
+            grants[PermissionName.READ_LEVEL] = {'state': True, 'value': 100}
+        return grant_profiles
+
+    def test_list_matches_get_permission(self):
+        other_articles = Article.objects.exclude(author_id=self.user.id)
+        moderated_uuid = other_articles.filter(section__name='moderated', status=Article.DRAFT)[0].uuid
+        assisted_uuid = other_articles.filter(section__name='assisted', status=Article.DRAFT)[0].uuid
+        closed_uuid = other_articles.get(section__name='closed', status=Article.ACTIVE,
+                                         privacy=Article.PUBLIC, read_level=50).uuid
+        visible_list = self.assert_list_visibility(
+            Article.objects.select_related('section__permission'), 'articles',
+            lambda article: self.service.has_get_permission(article=article)[0], self._get_grant_profiles())
+        # a moderator reaches drafts, an assistant does not, the closed section needs a global grant
+        expected_list = [(False, False)] * 4 + [(True, False), (True, True)]
+        for visible, (closed_visible, assisted_visible) in zip(visible_list, expected_list):
+            self.assertIn(moderated_uuid, visible)
+            self.assertEqual(assisted_uuid in visible, assisted_visible)
+            self.assertEqual(closed_uuid in visible, closed_visible)
+
+    def test_list_read_permission(self):
+        for grants in self._get_grant_profiles():
+            self.set_grants(grants)
+            _, data = self.service.list()
+            for article_dict in data['articles']:
+                article = Article.objects.get(uuid=article_dict['uuid'])
+                self.assertEqual(article_dict['read_permission'],
+                                 self.service.has_get_permission(article=article)[1])
@@ -1,12 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from django.http import QueryDict
+from django.http import QueryDict, HttpResponse, HttpResponseNotModified, JsonResponse
 
 from blog.content.articles.services import ArticleService
 from blog.common.message import ErrorMsg
 from blog.common.error import ParamsError
-from blog.common.utils import Response, json_response, request_parser
+from blog.common.utils import Response, json_response, request_parser, file_response, is_not_modified
 
 
 @json_response
@@ -96,6 +96,50 @@ def article_get(request, article_uuid):
     return Response(code=code, data=data)
 
 
+def article_content(request, article_uuid):
+    """
+    @api {get} /content/articles/{uuid}/content/ article content
+    @apiVersion 0.1.0
+    @apiName article_content
+    @apiGroup content
+    @apiDescription 获取文章原始内容, 文件存储的文章支持Range分段下载
+    @apiPermission ARTICLE_SELECT
+    @apiPermission ARTICLE_PERMISSION
+    @apiPermission ARTICLE_PRIVACY
+    @apiPermission ARTICLE_READ
+    @apiPermission ARTICLE_CANCEL
+    @apiPermission ARTICLE_AUDIT
+    @apiUse Header
+    @apiHeader {String} [Range] 请求的字节范围, 如bytes=0-1023, 返回206
+    @apiHeader {String} [If-None-Match] 上次响应的ETag, 未变化时返回304
+    @apiSuccess {file} file 文章内容
+    @apiUse ErrorData
+    @apiErrorExample {json} Error-Response:
+    HTTP/1.1 404 Not Found
+    {
+        "data": "Article not found"
+    }
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return JsonResponse({'data': ErrorMsg.REQUEST_METHOD_ERROR}, status=405)
+    try:
+        code, data = ArticleService(request).get_content(article_uuid=article_uuid)
+        if 'path' in data:
+            return file_response(request, data['path'], content_type='text/plain; charset=utf-8',
+                                 etag=data['etag'], last_modified=data['last_modified'], max_age=0)
+        if is_not_modified(request, etag=data['etag']):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(data['content'], content_type='text/plain; charset=utf-8')
+        response['ETag'] = data['etag']
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+    except Exception as e:
+        code, data = getattr(e, 'code', 400), \
+                     getattr(e, 'message', ErrorMsg.REQUEST_ERROR)
+    return JsonResponse({'data': data}, status=code)
+
+
 def article_list(request):
     """
     @api {get} /content/articles/ article list
@@ -112,6 +156,7 @@ def article_list(request):
     @apiUse Header
     @apiParam {number} [page=0] 文章信息列表页码, 页码为0时返回所有数据
     @apiParam {number} [page_size=10] 文章信息列表页长
+    @apiParam {string} [cursor] 文章信息列表游标, 传入时使用游标分页并忽略page参数, 空字符串返回第一页
     @apiParam {string} [section_name] 文章所属板块
     @apiParam {string} [author_uuid] 文章作者
     @apiParam {number=0, 1, 2, 3, 4, 5} [status] 文章状态，Cancel=0, Active=1, Draft=2, Audit=3,
@@ -121,7 +166,9 @@ def article_list(request):
     @apiParam {string} [query] 搜索内容，若无搜索字段则全局搜索title, keywords, content, author, section
     @apiParam {string=uuid, title, keywords, content,
                author, section, status, DjangoFilterParams} [query_field] 搜索字段, 支持Django filter参数
-    @apiSuccess {String} total 文章信息列表总数
+    @apiSuccess {String} total 文章信息列表总数, 游标分页时不返回
+    @apiSuccess {String} next_cursor 下一页游标, 仅游标分页时返回, 无下一页时为null
+    @apiSuccess {String} prev_cursor 上一页游标, 仅游标分页时返回, 无上一页时为null
     @apiSuccess {String} articles 文章信息列表
     @apiSuccessExample {json} Success-Response:
     HTTP/1.1 200 OK
@@ -180,7 +227,8 @@ def article_list(request):
         'order_field': str,
         'order': str,
         'query': str,
-        'query_field': str
+        'query_field': str,
+        'cursor': str
     }
     try:
         params_dict = request_parser(data=request.GET, params=params)
@@ -11,6 +11,7 @@ from django.utils import timezone
 
 from blog.account.users.services import UserService
 from blog.content.comments.models import Comment
+from blog.content.sections.models import Section
 from blog.content.sections.services import SectionService
 from blog.content.articles.models import Article
 from blog.content.articles.services import ArticleService, ArticleMetadataService
@@ -21,7 +22,7 @@ from blog.content.photos.services import PhotoService, PhotoMetadataService
 from blog.common.base import Service, MetadataService
 from blog.common.error import ServiceError
 from blog.common.message import ErrorMsg, ContentErrorMsg
-from blog.common.utils import paging, str_to_list, model_to_dict, get_md5
+from blog.common.utils import paging, cursor_paging, str_to_list, model_to_dict, get_md5
 from blog.common.setting import Setting, PermissionName
 
 
@@ -65,7 +66,7 @@ class CommentService(Service):
     def list(self, page=0, page_size=10, resource_type=None, resource_uuid=None,
              resource_section_name=None, dialog_uuid=None, reply_uuid=None,
              author_uuid=None, status=None, order_field=None, order='desc',
-             query=None, query_field=None):
+             query=None, query_field=None, cursor=None):
         query_level, order_level = self.get_permission_level(PermissionName.COMMENT_SELECT)
         comments = Comment.objects.all()
         if resource_type and int(resource_type) in dict(Comment.TYPE_CHOICES):
@@ -115,20 +116,23 @@ class CommentService(Service):
                                            Q(author__nick__icontains=query))
             else:
                 raise ServiceError(code=403, message=ErrorMsg.QUERY_PERMISSION_DENIED)
-        # Todo fix performance issue
-        for comment in comments:
-            if not self._has_get_permission(comment=comment):
-                comments = comments.exclude(id=comment.id)
-        comments, total = paging(comments, page=page, page_size=page_size)
+        list_query = self._get_list_query()
+        if list_query is not None:
+            comments = comments.filter(list_query)
+        if cursor is None:
+            comments, total = paging(comments, page=page, page_size=page_size)
+            page_dict = {'total': total}
+        else:
+            comments, page_dict = cursor_paging(comments, cursor=cursor, page_size=page_size)
         comment_dict_list = []
-        for comment in comments:
-            metadata = CommentMetadataService().get_metadata_count(resource=comment)
-            is_like_user = CommentMetadataService().is_like_user(resource=comment, user_id=self.uid)
+        metadata_list = CommentMetadataService().get_metadata_many(resources=comments, user_id=self.uid)
+        for comment, (metadata, is_like_user) in zip(comments, metadata_list):
             comment_dict = CommentService._comment_to_dict(comment=comment,
                                                            metadata=metadata,
                                                            is_like_user=is_like_user)
             comment_dict_list.append(comment_dict)
-        return 200, {'comments': comment_dict_list, 'total': total}
+        page_dict['comments'] = comment_dict_list
+        return 200, page_dict
 
     def create(self, resource_type, resource_uuid, reply_uuid=None, content=None, status=Comment.AUDIT):
         self.has_permission(PermissionName.COMMENT_CREATE)
@@ -159,8 +163,7 @@ class CommentService(Service):
         except Comment.DoesNotExist:
             raise ServiceError(code=404, message=ContentErrorMsg.COMMENT_NOT_FOUND)
         if like_operate is not None:
-            metadata = self._update_like_list(comment=comment, operate=like_operate)
-            is_like_user = CommentMetadataService().is_like_user(resource=comment, user_id=self.uid)
+            metadata, is_like_user = self._update_like_list(comment=comment, operate=like_operate)
             return 200, CommentService._comment_to_dict(comment=comment,
                                                         metadata=metadata,
                                                         is_like_user=is_like_user)
@@ -168,7 +171,7 @@ class CommentService(Service):
         is_content_change = False
         edit_permission, set_role = False, None
         if comment.resource_section:
-            set_role = SectionService.is_manager(user_uuid=self.uuid, section=comment.resource_section)
+            set_role = SectionService.is_manager(user_uuid=self.uuid, section=comment.resource_section, cache=self.cache)
             edit_permission = SectionService.has_set_permission(
                 permission=comment.resource_section.permission.comment_edit,
                 set_role=set_role)
@@ -256,7 +259,7 @@ class CommentService(Service):
             if cancel_level.is_gt_lv10():
                 return True
             if section:
-                set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+                set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
                 if SectionService.has_set_permission(permission=section.permission.comment_delete,
                                                      set_role=set_role):
                     return True
@@ -265,24 +268,61 @@ class CommentService(Service):
             if audit_level.is_gt_lv10():
                 return True
             if section:
-                set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+                set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
                 if SectionService.has_set_permission(permission=section.permission.comment_audit,
                                                      set_role=set_role):
                     return True
         elif section and comment.status == Comment.RECYCLED:
-            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
             if SectionService.has_set_permission(permission=section.permission.comment_recycled,
                                                  set_role=set_role):
                 return True
         return False
 
+    def _get_list_query(self):
+        permission_level, _ = self.get_permission_level(PermissionName.COMMENT_PERMISSION, False)
+        if permission_level.is_gt_lv10():
+            return None
+        cancel_level, _ = self.get_permission_level(PermissionName.COMMENT_CANCEL, False)
+        audit_level, _ = self.get_permission_level(PermissionName.COMMENT_AUDIT, False)
+        section_service = SectionService(request=self.request, instance=self)
+        section_ids, section_status_dict = [], {}
+        for section in Section.objects.select_related('permission').all():
+            _, read_permission = section_service.has_get_permission(section)
+            if not read_permission:
+                continue
+            section_ids.append(section.id)
+            set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
+            permission = section.permission
+            status_list = []
+            if SectionService.has_set_permission(permission=permission.comment_delete, set_role=set_role):
+                status_list.append(Comment.CANCEL)
+            if SectionService.has_set_permission(permission=permission.comment_audit, set_role=set_role):
+                status_list.extend([Comment.AUDIT, Comment.FAILED])
+            if SectionService.has_set_permission(permission=permission.comment_recycled, set_role=set_role):
+                status_list.append(Comment.RECYCLED)
+            if status_list:
+                section_status_dict.setdefault(tuple(sorted(set(status_list))), []).append(section.id)
+        status_list = [Comment.ACTIVE]
+        if cancel_level.is_gt_lv10():
+            status_list.append(Comment.CANCEL)
+        if audit_level.is_gt_lv10():
+            status_list.extend([Comment.AUDIT, Comment.FAILED])
+        section_query = Q(resource_section__isnull=True)
+        if section_ids:
+            section_query |= Q(resource_section_id__in=section_ids)
+        list_query = Q(author_id=self.uid) & ~Q(status=Comment.CANCEL) | section_query & Q(status__in=status_list)
+        for status_list, manage_section_ids in section_status_dict.items():
+            list_query |= Q(resource_section_id__in=manage_section_ids, status__in=status_list)
+        return list_query
+
     def _has_delete_permission(self, comment):
         delete_level, _ = self.get_permission_level(PermissionName.COMMENT_DELETE, False)
         is_self = comment.author_id == self.uid
         if delete_level.is_gt_lv10() or is_self and delete_level.is_gt_lv1():
             return True
         if comment.resource_section:
-            set_role = SectionService.is_manager(user_uuid=self.uuid, section=comment.resource_section)
+            set_role = SectionService.is_manager(user_uuid=self.uuid, section=comment.resource_section, cache=self.cache)
             if SectionService.has_set_permission(permission=comment.resource_section.permission.comment_delete,
                                                  set_role=set_role):
                 return True
@@ -294,7 +334,7 @@ class CommentService(Service):
         if cancel_level.is_gt_lv10() or is_self and cancel_level.is_gt_lv1():
             return True
         if comment.resource_section:
-            set_role = SectionService.is_manager(user_uuid=self.uuid, section=comment.resource_section)
+            set_role = SectionService.is_manager(user_uuid=self.uuid, section=comment.resource_section, cache=self.cache)
             if SectionService.has_set_permission(permission=comment.resource_section.permission.comment_cancel,
                                                  set_role=set_role):
                 return True
@@ -312,7 +352,7 @@ class CommentService(Service):
             if audit_level.is_gt_lv10():
                 return status
             if section:
-                set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+                set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
                 if SectionService.has_set_permission(permission=section.permission.comment_audit,
                                                      set_role=set_role):
                     return status
@@ -323,7 +363,7 @@ class CommentService(Service):
                 if cancel_level.is_gt_lv10():
                     return status
                 if section:
-                    set_role = SectionService.is_manager(user_uuid=self.uuid, section=section)
+                    set_role = SectionService.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
                     if SectionService.has_set_permission(permission=section.permission.comment_cancel,
                                                          set_role=set_role):
                         return status
@@ -489,11 +529,5 @@ class CommentMetadataService(MetadataService):
             user_dict['dislike_users'] = dislike_users
         return metadata, user_dict
 
-    def _set_sql_metadata(self, resource_uuid, metadata):
-        like_list_key, dislike_list_key = self._get_like_list_key(resource_uuid)
-        try:
-            comment = Comment.objects.get(uuid=resource_uuid)
-            self._set_resource_sql_metadata(comment, metadata, like_list_key, dislike_list_key)
-        except Comment.DoesNotExist:
-            self.redis_client.hash_delete(self.METADATA_KEY, resource_uuid)
-            self.redis_client.delete(like_list_key, dislike_list_key)
+    def _get_sql_resources(self, resource_uuids):
+        return Comment.objects.filter(uuid__in=resource_uuids)
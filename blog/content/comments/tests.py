@@ -1,3 +1,54 @@
-from django.test import TestCase
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
-# Create your tests here.
+import uuid
+
+from blog.account.users.models import User
+from blog.content.comments.models import Comment
+from blog.content.comments.services import CommentService
+from blog.content.sections.models import Section
+from blog.content.sections.services import SectionMetadataService
+from blog.common.setting import PermissionName, AuthType
+from blog.common.tests import BlogTestCase, ListVisibilityMixin
+
+
+class CommentListVisibilityTest(ListVisibilityMixin, BlogTestCase):
+    def setUp(self):
+        super(CommentListVisibilityTest, self).setUp()
+        self.user, other = [User.objects.create(uuid=str(uuid.uuid4()), username=username,
+                                                password='password', nick=username)
+                            for username in ('comment_author', 'comment_other')]
+        open_section = Section.objects.create(name='open', nick='open', owner=other)
+        managed_section = Section.objects.create(name='managed', nick='managed', owner=other)
+        managed_section.moderators.add(self.user)
+        closed_section = Section.objects.create(name='closed', nick='closed', owner=other, read_level=1000)
+        role_section = Section.objects.create(name='role', nick='role', owner=other, only_roles=True)
+        for section in (None, open_section, managed_section, closed_section, role_section):
+            if section:
+                SectionMetadataService().clear_manager(section=section)
+            for author in (self.user, other):
+                for status, _ in Comment.STATUS_CHOICES:
+                    Comment.objects.create(uuid=str(uuid.uuid4()), resource_uuid=str(uuid.uuid4()),
+                                           resource_section=section, content='comment', author=author,
+                                           last_editor=author, status=status)
+        self.service = CommentService(auth_type=AuthType.NONE)
+        self.service.uuid, self.service.uid = self.user.uuid, self.user.id
+
+    def test_list_matches_get_permission(self):
+        other_comments = Comment.objects.exclude(author_id=self.user.id)
+        managed_uuid = other_comments.get(resource_section__name='managed', status=Comment.RECYCLED).uuid
+        closed_uuid = other_comments.get(resource_section__name='closed', status=Comment.ACTIVE).uuid
+        granted = {'state': True, 'major_level': 1000, 'minor_level': 1000}
+        # the section permission and the global one reach sections the user may not read
+        grant_profiles = [{},
+                          {PermissionName.COMMENT_CANCEL: granted, PermissionName.COMMENT_AUDIT: granted},
+                          {PermissionName.SECTION_PERMISSION: granted},
+                          {PermissionName.COMMENT_PERMISSION: granted}]
+        for grants in grant_profiles:
+            grants[PermissionName.READ_LEVEL] = {'state': True, 'value': 100}
+        visible_list = self.assert_list_visibility(
+            Comment.objects.all(), 'comments', lambda comment: self.service._has_get_permission(comment=comment),
+            grant_profiles)
+        for visible, closed_visible in zip(visible_list, (False, False, True, True)):
+            self.assertIn(managed_uuid, visible)
+            self.assertEqual(closed_uuid in visible, closed_visible)
@@ -126,6 +126,7 @@ def comment_list(request):
     @apiUse Header
     @apiParam {number} [page=0] 评论信息列表页码, 页码为0时返回所有数据
     @apiParam {number} [page_size=10] 文评论信息列表页长
+    @apiParam {string} [cursor] 评论信息列表游标, 传入时使用游标分页并忽略page参数, 空字符串返回第一页
     @apiParam {number=0, 1, 2} [resource_type] 评论资源类型，Article=0, Album=1, Photo=2
     @apiParam {string} [resource_uuid] 评论资源UUID
     @apiParam {number} [resource_section_id] 评论资源所属板块
@@ -138,7 +139,9 @@ def comment_list(request):
     @apiParam {string=desc, asc} [order="desc"] 评论信息列表排序方向
     @apiParam {string} [query] 搜索内容，若无搜索字段则全局搜索content, author
     @apiParam {string=uuid, content, author, status, DjangoFilterParams} [query_field] 搜索字段, 支持Django filter参数
-    @apiSuccess {String} total 评论信息列表总数
+    @apiSuccess {String} total 评论信息列表总数, 游标分页时不返回
+    @apiSuccess {String} next_cursor 下一页游标, 仅游标分页时返回, 无下一页时为null
+    @apiSuccess {String} prev_cursor 上一页游标, 仅游标分页时返回, 无上一页时为null
     @apiSuccess {String} comments 评论信息列表
     @apiSuccessExample {json} Success-Response:
     HTTP/1.1 200 OK
@@ -203,7 +206,8 @@ def comment_list(request):
         'order_field': str,
         'order': str,
         'query': str,
-        'query_field': str
+        'query_field': str,
+        'cursor': str
     }
     try:
         params_dict = request_parser(data=request.GET, params=params)
@@ -18,7 +18,7 @@ from blog.content.marks.models import Mark, MarkResource
 from blog.common.base import Service
 from blog.common.error import ServiceError
 from blog.common.message import ErrorMsg, AccountErrorMsg, ContentErrorMsg
-from blog.common.utils import paging, str_to_list, model_to_dict
+from blog.common.utils import paging, cursor_paging, str_to_list, model_to_dict
 from blog.common.setting import PermissionName
 
 
@@ -41,7 +41,7 @@ class MarkService(Service):
 
     def list(self, page=0, page_size=10, author_uuid=None, resource_type=None,
              resource_uuid=None, order_field=None, order='desc',
-             query=None, query_field=None):
+             query=None, query_field=None, cursor=None):
         query_level, order_level = self.get_permission_level(PermissionName.MARK_SELECT)
         marks = Mark.objects.all()
         if author_uuid:
@@ -83,13 +83,16 @@ class MarkService(Service):
             else:
                 raise ServiceError(code=403,
                                    message=ErrorMsg.QUERY_PERMISSION_DENIED)
-        # Todo fix performance issue
-        for mark in marks:
-            if not self._has_get_permission(mark=mark):
-                marks = marks.exclude(id=mark.id)
-        marks, total = paging(marks, page=page, page_size=page_size)
-        return 200, {'marks': [MarkService._mark_to_dict(mark=mark) for mark in marks],
-                     'total': total}
+        get_level, _ = self.get_permission_level(PermissionName.MARK_PRIVACY, False)
+        if get_level.is_lt_lv10():
+            marks = marks.filter(Q(author_id=self.uid) | Q(privacy=Mark.PUBLIC))
+        if cursor is None:
+            marks, total = paging(marks, page=page, page_size=page_size)
+            page_dict = {'total': total}
+        else:
+            marks, page_dict = cursor_paging(marks, cursor=cursor, page_size=page_size)
+        page_dict['marks'] = [MarkService._mark_to_dict(mark=mark) for mark in marks]
+        return 200, page_dict
 
     def create(self, name, description=None, color=None, privacy=Mark.PUBLIC,
                author_uuid=None, resource_type=None, resource_uuid=None):
@@ -1,3 +1,28 @@
-from django.test import TestCase
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
-# Create your tests here.
+import uuid
+
+from blog.account.users.models import User
+from blog.content.marks.models import Mark
+from blog.content.marks.services import MarkService
+from blog.common.setting import PermissionName, AuthType
+from blog.common.tests import BlogTestCase, ListVisibilityMixin
+
+
+class MarkListVisibilityTest(ListVisibilityMixin, BlogTestCase):
+    def setUp(self):
+        super(MarkListVisibilityTest, self).setUp()
+        self.user, other = [User.objects.create(uuid=str(uuid.uuid4()), username=username,
+                                                password='password', nick=username)
+                            for username in ('mark_author', 'mark_other')]
+        for author in (self.user, other):
+            for privacy, _ in Mark.PRIVACY_CHOICES:
+                Mark.objects.create(uuid=str(uuid.uuid4()), name='mark', author=author, privacy=privacy)
+        self.service = MarkService(auth_type=AuthType.NONE)
+        self.service.uid = self.user.id
+
+    def test_list_matches_get_permission(self):
+        self.assert_list_visibility(Mark.objects.all(), 'marks',
+                                    lambda mark: self.service._has_get_permission(mark=mark),
+                                    [{}, {PermissionName.MARK_PRIVACY: {'state': True, 'major_level': 1000}}])
@@ -94,6 +94,7 @@ def mark_list(request):
     @apiUse Header
     @apiParam {number} [page=0] 标签信息列表页码, 页码为0时返回所有数据
     @apiParam {number} [page_size=10] 标签信息列表页长
+    @apiParam {string} [cursor] 标签信息列表游标, 传入时使用游标分页并忽略page参数, 空字符串返回第一页
     @apiParam {string} [author_uuid] 标签作者UUID
     @apiParam {number=0, 1, 2} [resource_type] 标签绑定资源类型，Article=0, Album=1, Photo=2
     @apiParam {string} [resource_uuid] 标签绑定资源UUID
@@ -102,7 +103,9 @@ def mark_list(request):
     @apiParam {string} [query] 搜索内容，若无搜索字段则全局搜索uuid, name, description, author, color
     @apiParam {string=uuid, name, description, author, color, DjangoFilterParams} [query_field]
                                搜索字段, 支持Django filter参数
-    @apiSuccess {String} total 标签信息列表总数
+    @apiSuccess {String} total 标签信息列表总数, 游标分页时不返回
+    @apiSuccess {String} next_cursor 下一页游标, 仅游标分页时返回, 无下一页时为null
+    @apiSuccess {String} prev_cursor 上一页游标, 仅游标分页时返回, 无上一页时为null
     @apiSuccess {String} marks 标签信息列表
     @apiSuccessExample {json} Success-Response:
     HTTP/1.1 200 OK
@@ -148,7 +151,8 @@ def mark_list(request):
         'order_field': str,
         'order': str,
         'query': str,
-        'query_field': str
+        'query_field': str,
+        'cursor': str
     }
     try:
         params_dict = request_parser(data=request.GET, params=params)
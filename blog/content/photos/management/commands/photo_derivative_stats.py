@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from blog.content.photos.services import PhotoDerivativeCache
+
+
+class Command(BaseCommand):
+    help = 'Print the disk usage and hit counters of the resized photo cache'
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(PhotoDerivativeCache().stats(), sort_keys=True))
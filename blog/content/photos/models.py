@@ -11,6 +11,19 @@ from blog.common.tools import photo_large_path, photo_middle_path, \
                               photo_small_path, photo_untreated_path
 
 
+class PhotoBlob(models.Model):
+    id = models.AutoField(primary_key=True)
+    digest = models.CharField(max_length=64, unique=True)
+    image_large = models.CharField(max_length=200, null=True)
+    image_middle = models.CharField(max_length=200, null=True)
+    image_small = models.CharField(max_length=200, null=True)
+    ref_count = models.IntegerField(default=0)
+    create_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'photo_blob'
+
+
 class Photo(models.Model, BaseModel):
     CANCEL = 0
     ACTIVE = 1
@@ -49,6 +62,9 @@ class Photo(models.Model, BaseModel):
     status = models.IntegerField(choices=STATUS_CHOICES, default=ACTIVE)
     privacy = models.IntegerField(choices=PRIVACY_CHOICES, default=PUBLIC)
     read_level = models.IntegerField(default=100)
+    processing = models.BooleanField(default=False)
+    render_failed = models.BooleanField(default=False)
+    blob = models.ForeignKey(PhotoBlob, null=True, on_delete=models.SET_NULL)
     create_at = models.DateTimeField(auto_now_add=True)
     last_editor = models.ForeignKey(to=User, related_name='photos_edit')
     edit_at = models.DateTimeField(default=timezone.now)
@@ -80,7 +96,12 @@ def photo_obj_create(sender, instance, created, **kwargs):
 
 @receiver(models.signals.pre_delete, sender=Photo, dispatch_uid='models.photo_obj_delete')
 def photo_obj_delete(sender, instance, **kwargs):
+    from blog.content.photos.services import PhotoService, PhotoDerivativeCache
+    PhotoDerivativeCache().remove(photo=instance)
+    PhotoService.remove_variants(photo=instance)
     instance.image_large.delete(save=False)
     instance.image_middle.delete(save=False)
     instance.image_small.delete(save=False)
     instance.image_untreated.delete(save=False)
+    if instance.blob_id:
+        PhotoService.release_blob(blob_id=instance.blob_id)
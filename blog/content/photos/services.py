@@ -1,27 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import re
 import uuid
 import time
 import os
+import hashlib
 
 from functools import reduce
-from io import BytesIO
 from PIL import Image
 
+from django.conf import settings
+from django.db import transaction, IntegrityError
 from django.db.models import Q
 from django.utils import timezone
-from django.core.files.uploadedfile import InMemoryUploadedFile
 
-from blog.settings import MEDIA_ROOT, MEDIA_URL
+from blog.settings import MEDIA_URL, PHOTO_THUMBNAIL_ASYNC, PHOTO_CACHE_MAX_AGE, \
+    PHOTO_VARIANTS, PHOTO_VARIANT_QUALITY, \
+    PHOTO_DERIVATIVE_WIDTHS, PHOTO_DERIVATIVE_CACHE_SIZE, PHOTO_DERIVATIVE_EVICT_BATCH, PHOTO_DERIVATIVE_LOCK_TIMEOUT
 from blog.account.users.services import UserService
 from blog.content.albums.models import Album
-from blog.content.photos.models import Photo
-from blog.common.base import Service, MetadataService
+from blog.content.photos.models import Photo, PhotoBlob
+from blog.common.base import Service, MetadataService, RedisClient
 from blog.common.error import ServiceError
 from blog.common.message import ErrorMsg, ContentErrorMsg
-from blog.common.utils import paging, str_to_list, model_to_dict
+from blog.common.utils import paging, cursor_paging, str_to_list, model_to_dict, get_md5, ignored
 from blog.common.setting import Setting, PermissionName
+from blog.common.tools import path_format
 
 
 class PhotoService(Service):
@@ -31,19 +36,38 @@ class PhotoService(Service):
                          'comment_count', 'like_count', 'dislike_count']
     METADATA_ORDER_FIELD = ['read_count', 'comment_count', 'like_count',
                             'dislike_count']
+    # smallest first, a variant is only kept when it beats the rendered file
+    VARIANT_FORMATS = [('image/webp', 'WEBP', '.webp'),
+                       ('image/jpeg', 'JPEG', '.jpg')]
 
-    def show(self, url):
+    def show(self, url, accept=None):
         self.has_permission(PermissionName.PHOTO_SELECT)
         try:
             photo_uuid = url.rsplit('.')[-2].rsplit('/')[-1]
             photo = Photo.objects.get(uuid=photo_uuid)
             if not self.has_get_permission(photo=photo):
                 raise Photo.DoesNotExist
-            image_path = os.path.join(MEDIA_ROOT, url.replace(MEDIA_URL, ''))
-            image_data = open(image_path, "rb").read()
-        except (IndexError, IOError, Photo.DoesNotExist):
+            image_path = os.path.normpath(os.path.join(settings.MEDIA_ROOT, url.replace(MEDIA_URL, '', 1)))
+            if not image_path.startswith(os.path.join(settings.MEDIA_ROOT, 'photos', '')):
+                raise IOError
+            width = PhotoDerivativeCache.get_width(url.rsplit('/')[-2])
+            if width and not PhotoDerivativeCache().get(photo=photo, width=width, path=image_path):
+                raise IOError
+            if not os.path.isfile(image_path):
+                raise IOError
+            image_path, content_type = PhotoService._get_variant(image_path, accept)
+            image_stat = os.stat(image_path)
+        except (IndexError, IOError, OSError, Photo.DoesNotExist):
             raise ServiceError(code=404, message=ContentErrorMsg.PHOTO_NOT_FOUND)
-        return 200, image_data
+        # the validator changes with the file and with anything deciding who may see it
+        etag = get_md5('%s&%s&%s&%s&%s&%s&%s&%s' % (photo.uuid, url, content_type, int(image_stat.st_mtime),
+                                                    image_stat.st_size, photo.status, photo.privacy, photo.read_level))
+        is_public = photo.status == Photo.ACTIVE and photo.privacy == Photo.PUBLIC
+        return 200, {'path': image_path,
+                     'content_type': content_type,
+                     'etag': '"%s"' % etag,
+                     'last_modified': int(image_stat.st_mtime),
+                     'max_age': PHOTO_CACHE_MAX_AGE if is_public else 0}
 
     def get(self, photo_uuid, like_list_type=None, like_list_start=0, like_list_end=10):
         self.has_permission(PermissionName.PHOTO_SELECT)
@@ -75,7 +99,7 @@ class PhotoService(Service):
 
     def list(self, page=0, page_size=10, album_uuid=None, album_system=None,
              author_uuid=None, status=None, privacy=None, order_field=None,
-             order='desc', query=None, query_field=None):
+             order='desc', query=None, query_field=None, cursor=None):
         query_level, order_level = self.get_permission_level(PermissionName.PHOTO_SELECT)
         photos = Photo.objects.all()
         if album_uuid is not None:
@@ -127,23 +151,26 @@ class PhotoService(Service):
                                        Q(album__name__icontains=query))
             else:
                 raise ServiceError(code=403, message=ErrorMsg.QUERY_PERMISSION_DENIED)
-        for photo in photos:
-            if not self.has_get_permission(photo=photo):
-                photos = photos.exclude(id=photo.id)
-        photos, total = paging(photos, page=page, page_size=page_size)
-        # Todo fix performance issue
+        list_query = self._get_list_query()
+        if list_query is not None:
+            photos = photos.filter(list_query)
+        if cursor is None:
+            photos, total = paging(photos, page=page, page_size=page_size)
+            page_dict = {'total': total}
+        else:
+            photos, page_dict = cursor_paging(photos, cursor=cursor, page_size=page_size)
         photo_dict_list = []
-        for photo in photos:
-            metadata = PhotoMetadataService().get_metadata_count(resource=photo)
-            is_like_user = PhotoMetadataService().is_like_user(resource=photo, user_id=self.uid)
+        metadata_list = PhotoMetadataService().get_metadata_many(resources=photos, user_id=self.uid)
+        for photo, (metadata, is_like_user) in zip(photos, metadata_list):
             photo_dict = PhotoService._photo_to_dict(photo=photo,
                                                      metadata=metadata,
                                                      is_like_user=is_like_user)
             photo_dict_list.append(photo_dict)
-        return 200, {'photos': photo_dict_list, 'total': total}
+        page_dict['photos'] = photo_dict_list
+        return 200, page_dict
 
     def create(self, image, description=None, album_uuid=None, status=Photo.AUDIT,
-               privacy=Photo.PUBLIC, read_level=100, origin=False, untreated=False):
+               privacy=Photo.PUBLIC, read_level=100, origin=False, untreated=False, image_digest=None):
         create_level, _ = self.get_permission_level(PermissionName.PHOTO_CREATE)
         count_level = self.get_permission_value(PermissionName.PHOTO_CREATE)
         if create_level.is_lt_lv10() and count_level != -1 and \
@@ -155,37 +182,109 @@ class PhotoService(Service):
         status = self._get_create_status(status=status)
         privacy = self._get_privacy(privacy=privacy)
         read_level = self._get_read_level(read_level=read_level)
-        stream_large, stream_middle, stream_small = BytesIO(), BytesIO(), BytesIO()
+        origin_level, untreated_level = self.get_permission_level(PermissionName.PHOTO_LIMIT)
+        origin = bool(origin and origin_level.is_gt_lv10())
+        untreated = bool(untreated and untreated_level.is_gt_lv10())
+        photo = Photo(uuid=photo_uuid,
+                      description=description,
+                      author_id=self.uid,
+                      album=album,
+                      status=status,
+                      privacy=privacy,
+                      read_level=read_level,
+                      last_editor_id=self.uid)
+        sizes = ['origin' if origin else 'large']
+        if Setting().PHOTO_THUMBNAIL:
+            sizes.extend(['middle', 'small'])
+        blob_digest = self._get_blob_digest(image_digest or self._get_image_digest(image), sizes)
+        blob = self._acquire_blob(digest=blob_digest)
+        image_names = None
         try:
-            origin_level, untreated_level = self.get_permission_level(PermissionName.PHOTO_LIMIT)
-            if origin and origin_level.is_gt_lv10():
-                image_large = self._get_thumbnail(image, stream_large, 'origin', photo_uuid)
-            else:
-                image_large = self._get_thumbnail(image, stream_large, 'large', photo_uuid)
-            if Setting().PHOTO_THUMBNAIL:
-                image_middle = self._get_thumbnail(image, stream_middle, 'middle', photo_uuid)
-                image_small = self._get_thumbnail(image, stream_small, 'small', photo_uuid)
-            else:
-                image_middle, image_small = None, None
-            image_untreated = image if untreated and untreated_level.is_gt_lv10() else None
-            photo = Photo.objects.create(uuid=photo_uuid,
-                                         image_large=image_large,
-                                         image_middle=image_middle,
-                                         image_small=image_small,
-                                         image_untreated=image_untreated,
-                                         description=description,
-                                         author_id=self.uid,
-                                         album=album,
-                                         status=status,
-                                         privacy=privacy,
-                                         read_level=read_level,
-                                         last_editor_id=self.uid)
-        finally:
-            stream_large.close()
-            stream_middle.close()
-            stream_small.close()
+            if blob is not None:
+                # the same content was rendered with the same sizes before, its files are linked instead
+                image_names = self._link_blob(blob=blob, photo=photo)
+                if image_names is None:
+                    blob = None
+            if image_names is None and not PHOTO_THUMBNAIL_ASYNC:
+                # encoded straight into their final paths, the upload itself is only read
+                image_names = self._get_thumbnails(image, photo, sizes)
+            if image_names is not None:
+                photo.image_large, photo.image_middle, photo.image_small = (image_names + [None, None])[:3]
+            elif not untreated:
+                # the upload is stored as is, photo_thumbnail renders the sizes later
+                photo.image_large = image
+            if untreated:
+                photo.image_untreated = image
+            photo.processing = image_names is None
+            photo.blob = blob
+            photo.save()
+        except Exception:
+            # no photo owns the files and the blob reference taken above
+            for name in image_names or []:
+                if name:
+                    PhotoService.remove_file(os.path.join(settings.MEDIA_ROOT, name))
+            if blob is not None:
+                PhotoService.release_blob(blob_id=blob.id)
+            raise
+        if photo.processing:
+            if untreated:
+                # a spooled upload is moved into place once, the large source shares the untreated file
+                photo.image_large = path_format(photo, photo.image_untreated.name, 'photos', size='large')
+                PhotoService._link_file(photo.image_untreated.path, photo.image_large.path)
+                photo.save(update_fields=['image_large'])
+            from blog.scheduler.tasks import photo_thumbnail_task
+            photo_thumbnail_task.delay(photo_id=photo.id, origin=origin, blob_digest=blob_digest)
+        elif blob is None:
+            self._create_blob(photo=photo, digest=blob_digest)
         return 201, PhotoService._photo_to_dict(photo=photo)
 
+    @staticmethod
+    def render_thumbnails(photo_id, origin=False, blob_digest=None):
+        try:
+            photo = Photo.objects.get(id=photo_id)
+        except Photo.DoesNotExist:
+            return
+        if not photo.processing:
+            return
+        sizes = ['origin' if origin else 'large']
+        if Setting().PHOTO_THUMBNAIL:
+            sizes.extend(['middle', 'small'])
+        try:
+            source_path = photo.image_large.path
+            image_names = PhotoService._get_thumbnails(source_path, photo, sizes)
+            photo.image_large, photo.image_middle, photo.image_small = (image_names + [None, None])[:3]
+            if photo.image_large.path != source_path:
+                with ignored(OSError):
+                    os.remove(source_path)
+        except Exception:
+            # kept apart from the moderation status, a failed render changes neither audit queues nor visibility
+            photo.render_failed = True
+        finally:
+            photo.processing = False
+            photo.save(update_fields=['image_large', 'image_middle', 'image_small', 'processing', 'render_failed'])
+        if not photo.render_failed and blob_digest:
+            PhotoService._create_blob(photo=photo, digest=blob_digest)
+
+    @staticmethod
+    def release_blob(blob_id):
+        with transaction.atomic():
+            try:
+                blob = PhotoBlob.objects.select_for_update().get(id=blob_id)
+            except PhotoBlob.DoesNotExist:
+                return
+            blob.ref_count -= 1
+            if blob.ref_count > 0:
+                blob.save(update_fields=['ref_count'])
+                return
+            blob.delete()
+            # the last reference is gone, dropping the blob links frees the shared data,
+            # done under the row lock so a new blob of the same digest waits for the old files to go
+            for name in (blob.image_large, blob.image_middle, blob.image_small):
+                if name:
+                    PhotoService.remove_file(os.path.join(settings.MEDIA_ROOT, name))
+            with ignored(OSError):
+                os.rmdir(os.path.join(settings.MEDIA_ROOT, 'photos', 'blobs', blob.digest))
+
     def update(self, photo_uuid, description=None, album_uuid=None,
                status=None, privacy=None, read_level=None, like_operate=None):
         update_level, _ = self.get_permission_level(PermissionName.PHOTO_UPDATE)
@@ -194,8 +293,7 @@ class PhotoService(Service):
         except Photo.DoesNotExist:
             raise ServiceError(code=404, message=ContentErrorMsg.PHOTO_NOT_FOUND)
         if like_operate is not None:
-            metadata = self._update_like_list(photo=photo, operate=like_operate)
-            is_like_user = PhotoMetadataService().is_like_user(resource=photo, user_id=self.uid)
+            metadata, is_like_user = self._update_like_list(photo=photo, operate=like_operate)
             return 200, PhotoService._photo_to_dict(photo=photo,
                                                     metadata=metadata,
                                                     is_like_user=is_like_user)
@@ -279,6 +377,27 @@ class PhotoService(Service):
             return audit_level.is_gt_lv10()
         return False
 
+    def _get_list_query(self):
+        permission_level, _ = self.get_permission_level(PermissionName.PHOTO_PERMISSION, False)
+        if permission_level.is_gt_lv10():
+            return None
+        privacy_level, _ = self.get_permission_level(PermissionName.PHOTO_PRIVACY, False)
+        read_permission_level, _ = self.get_permission_level(PermissionName.PHOTO_READ, False)
+        cancel_level, _ = self.get_permission_level(PermissionName.PHOTO_CANCEL, False)
+        audit_level, _ = self.get_permission_level(PermissionName.PHOTO_AUDIT, False)
+        read_level = self.get_permission_value(PermissionName.READ_LEVEL, False)
+        active_query = Q(status=Photo.ACTIVE)
+        if privacy_level.is_lt_lv10():
+            active_query &= Q(privacy=Photo.PUBLIC)
+        if read_permission_level.is_lt_lv10():
+            active_query &= Q(read_level__lte=read_level)
+        list_query = Q(author_id=self.uid) & ~Q(status=Photo.CANCEL) | active_query
+        if cancel_level.is_gt_lv10():
+            list_query |= Q(status=Photo.CANCEL)
+        if audit_level.is_gt_lv10():
+            list_query |= Q(status__in=[Photo.AUDIT, Photo.FAILED])
+        return list_query
+
     def _has_delete_permission(self, photo):
         delete_level, _ = self.get_permission_level(PermissionName.PHOTO_DELETE, False)
         is_self = photo.author_id == self.uid
@@ -404,25 +523,234 @@ class PhotoService(Service):
         return read_level
 
     @staticmethod
-    def _get_thumbnail(image, stream, size, photo_uuid='pic'):
+    def _get_size_dict():
+        setting = Setting()
+        return {'origin': None,
+                'large': setting.PHOTO_LARGE_SIZE,
+                'middle': setting.PHOTO_MIDDLE_SIZE,
+                'small': setting.PHOTO_SMALL_SIZE}
+
+    @staticmethod
+    def _get_image_digest(image):
+        sha256 = hashlib.sha256()
+        for chunk in image.chunks():
+            sha256.update(chunk)
+        image.seek(0)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def _get_blob_digest(image_digest, sizes):
+        # rendered files only match when the source and every requested box size match
+        size_dict = PhotoService._get_size_dict()
+        size_str = '&'.join('%s:%s' % (size, size_dict.get(size)) for size in sizes)
+        return hashlib.sha256(('%s&%s' % (image_digest, size_str)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _acquire_blob(digest):
+        with transaction.atomic():
+            try:
+                blob = PhotoBlob.objects.select_for_update().get(digest=digest)
+            except PhotoBlob.DoesNotExist:
+                return None
+            blob.ref_count += 1
+            blob.save(update_fields=['ref_count'])
+        return blob
+
+    @staticmethod
+    def _link_blob(blob, photo):
+        names = []
+        try:
+            for size in ('large', 'middle', 'small'):
+                blob_name = getattr(blob, 'image_%s' % size)
+                name = path_format(photo, blob_name, 'photos', size=size) if blob_name else None
+                if name:
+                    PhotoService._link_file(os.path.join(settings.MEDIA_ROOT, blob_name),
+                                            os.path.join(settings.MEDIA_ROOT, name))
+                names.append(name)
+        except (OSError, AttributeError):
+            for name in names:
+                if name:
+                    PhotoService.remove_file(os.path.join(settings.MEDIA_ROOT, name))
+            PhotoService.release_blob(blob_id=blob.id)
+            return None
+        return names
+
+    @staticmethod
+    def _create_blob(photo, digest):
+        blob_names = {}
+        for size in ('large', 'middle', 'small'):
+            image_field = getattr(photo, 'image_%s' % size)
+            if image_field:
+                blob_names['image_%s' % size] = 'photos/blobs/%s/%s%s' % (digest, size,
+                                                                         os.path.splitext(image_field.name)[1])
+        linked_names = []
+        try:
+            with transaction.atomic():
+                if PhotoBlob.objects.select_for_update().filter(digest=digest).exists():
+                    # a concurrent upload of the same content registered first, this photo keeps its own files
+                    return None
+                blob = PhotoBlob.objects.create(digest=digest, ref_count=1, **blob_names)
+                # linked before commit, the blob is never visible to _acquire_blob without its files
+                for key, blob_name in blob_names.items():
+                    # files left by an interrupted upload belong to no row
+                    PhotoService.remove_file(os.path.join(settings.MEDIA_ROOT, blob_name))
+                    PhotoService._link_file(getattr(photo, key).path, os.path.join(settings.MEDIA_ROOT, blob_name))
+                    linked_names.append(blob_name)
+                Photo.objects.filter(id=photo.id).update(blob=blob)
+        except IntegrityError:
+            return None
+        except (OSError, AttributeError):
+            for blob_name in linked_names:
+                PhotoService.remove_file(os.path.join(settings.MEDIA_ROOT, blob_name))
+            return None
+        photo.blob = blob
+        return blob
+
+    @staticmethod
+    def _link_file(source_path, target_path):
+        # hard links share the data blocks, every photo keeps its own path and url
+        if not os.path.isdir(os.path.dirname(target_path)):
+            with ignored(OSError):
+                os.makedirs(os.path.dirname(target_path))
+        os.link(source_path, target_path)
+        for (_, source_variant), (_, target_variant) in zip(PhotoService.get_variant_paths(source_path),
+                                                            PhotoService.get_variant_paths(target_path)):
+            if os.path.isfile(source_variant):
+                with ignored(OSError):
+                    os.link(source_variant, target_variant)
+
+    @staticmethod
+    def get_variant_paths(path):
+        base_path = os.path.splitext(path)[0]
+        return [(content_type, base_path + extension) for content_type, _, extension in PhotoService.VARIANT_FORMATS]
+
+    @staticmethod
+    def get_files_size(path):
+        return sum(os.path.getsize(file_path) for file_path in
+                   [path] + [variant_path for _, variant_path in PhotoService.get_variant_paths(path)]
+                   if os.path.isfile(file_path))
+
+    @staticmethod
+    def remove_file(path):
+        for file_path in [path] + [variant_path for _, variant_path in PhotoService.get_variant_paths(path)]:
+            with ignored(OSError):
+                os.remove(file_path)
+
+    @staticmethod
+    def remove_variants(photo):
+        for image_field in (photo.image_large, photo.image_middle, photo.image_small):
+            if image_field:
+                for _, variant_path in PhotoService.get_variant_paths(image_field.path):
+                    with ignored(OSError):
+                        os.remove(variant_path)
+
+    @staticmethod
+    def save_variants(pil_image, path, pil_format):
+        if not PHOTO_VARIANTS or pil_format == 'GIF':
+            return
+        has_alpha = pil_image.mode in ('RGBA', 'LA') or \
+            (pil_image.mode == 'P' and 'transparency' in pil_image.info)
+        try:
+            if pil_image.mode not in ('RGB', 'RGBA'):
+                pil_image = pil_image.convert('RGBA' if has_alpha else 'RGB')
+        except (IOError, ValueError):
+            return
+        source_size = os.path.getsize(path)
+        for (_, variant_format, _), (_, variant_path) in zip(PhotoService.VARIANT_FORMATS,
+                                                            PhotoService.get_variant_paths(path)):
+            # jpeg sources are already stored progressive, jpeg cannot carry transparency
+            if variant_format == 'JPEG' and (pil_format == 'JPEG' or has_alpha):
+                continue
+            temp_path = '%s.%s.tmp' % (variant_path, uuid.uuid4().hex)
+            try:
+                pil_image.save(temp_path, format=variant_format, quality=PHOTO_VARIANT_QUALITY,
+                               optimize=True, progressive=True)
+                if os.path.getsize(temp_path) < source_size:
+                    os.rename(temp_path, variant_path)
+            except (IOError, OSError, KeyError, ValueError):
+                # encoder missing from this PIL build
+                pass
+            finally:
+                with ignored(OSError):
+                    os.remove(temp_path)
+
+    @staticmethod
+    def _get_variant(path, accept):
+        # webp only when announced explicitly, the jpeg of a png or gif source goes to anyone taking images
+        accept = accept or '*/*'
+        for content_type, variant_path in PhotoService.get_variant_paths(path):
+            quality, exact = PhotoService._get_accept_quality(accept, content_type)
+            acceptable = quality > 0 and (exact or content_type != 'image/webp')
+            if acceptable and os.path.isfile(variant_path):
+                return variant_path, content_type
+        return path, None
+
+    @staticmethod
+    def _get_accept_quality(accept, content_type):
+        # q of the most specific media range matching the type, and whether that range names the type itself
+        ranges = (content_type, content_type.split('/')[0] + '/*', '*/*')
+        quality, match = 0.0, len(ranges)
+        for media_range in accept.split(','):
+            params = [param.strip() for param in media_range.split(';')]
+            media_type = params[0].lower()
+            if media_type not in ranges or ranges.index(media_type) >= match:
+                continue
+            match, quality = ranges.index(media_type), 1.0
+            for param in params[1:]:
+                key, _, value = param.partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+        return quality, match == 0
+
+    @staticmethod
+    def _get_thumbnails(image, photo, sizes):
+        size_dict = PhotoService._get_size_dict()
+        if any(size not in size_dict for size in sizes):
+            raise ServiceError(code=500, message=ErrorMsg.REQUEST_PARAMS_ERROR)
+        # only the header is parsed here, pixels are decoded by load() below
         pil_image = Image.open(image)
         pil_format = pil_image.format.lower()
         if pil_format not in ('jpeg', 'png', 'gif'):
             pil_format = 'jpeg'
-        content_type = 'image/%s' % pil_format
-        image_name = '%s.%s' % (photo_uuid, pil_format)
-        setting = Setting()
-        if size == 'large':
-            pil_image.thumbnail((setting.PHOTO_LARGE_SIZE, setting.PHOTO_LARGE_SIZE), Image.ANTIALIAS)
-        elif size == 'middle':
-            pil_image.thumbnail((setting.PHOTO_MIDDLE_SIZE, setting.PHOTO_MIDDLE_SIZE), Image.ANTIALIAS)
-        elif size == 'small':
-            pil_image.thumbnail((setting.PHOTO_SMALL_SIZE, setting.PHOTO_SMALL_SIZE), Image.ANTIALIAS)
-        elif size != 'origin':
-            raise ServiceError(code=500, message=ErrorMsg.REQUEST_PARAMS_ERROR)
-        pil_image.save(stream, format=pil_format)
-        return InMemoryUploadedFile(stream, None, image_name,
-                                    content_type, stream.tell(), {})
+        image_name = '%s.%s' % (photo.uuid, pil_format)
+        # the biggest requested box bounds the decode, jpeg draft mode lets the decoder downscale by 1/2 to 1/8
+        if 'origin' not in sizes and pil_image.format == 'JPEG':
+            max_size = max(size_dict[size] for size in sizes)
+            ratio = min(float(max_size) / pil_image.size[0], float(max_size) / pil_image.size[1])
+            if ratio < 1:
+                pil_image.draft(pil_image.mode, (int(pil_image.size[0] * ratio), int(pil_image.size[1] * ratio)))
+        pil_image.load()
+        # decoded once, every size is resized in place from the previous larger one
+        thumbnails = [None] * len(sizes)
+        order = sorted(range(len(sizes)), key=lambda index: size_dict[sizes[index]] or float('inf'), reverse=True)
+        for index in order:
+            box_size = size_dict[sizes[index]]
+            if box_size:
+                pil_image.thumbnail((box_size, box_size), Image.ANTIALIAS)
+            name = path_format(photo, image_name, 'photos', size='large' if sizes[index] == 'origin' else sizes[index])
+            path = os.path.join(settings.MEDIA_ROOT, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                with ignored(OSError):
+                    os.makedirs(os.path.dirname(path))
+            # written aside and renamed, readers never see a partial file
+            temp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+            try:
+                if pil_format == 'jpeg':
+                    pil_image.save(temp_path, format=pil_format, optimize=True, progressive=True)
+                else:
+                    pil_image.save(temp_path, format=pil_format)
+                os.rename(temp_path, path)
+            except (IOError, OSError):
+                with ignored(OSError):
+                    os.remove(temp_path)
+                raise IOError
+            if box_size:
+                PhotoService.save_variants(pil_image, path, pil_format.upper())
+            thumbnails[index] = name
+        return thumbnails
 
     @staticmethod
     def _photo_to_dict(photo, metadata=None, **kwargs):
@@ -434,11 +762,171 @@ class PhotoService(Service):
         photo_dict['metadata']['comment_count'] = metadata.comment_count if metadata else 0
         photo_dict['metadata']['like_count'] = metadata.like_count if metadata else 0
         photo_dict['metadata']['dislike_count'] = metadata.dislike_count if metadata else 0
+        photo_dict['ready_sizes'] = [size for size in ('large', 'middle', 'small', 'untreated')
+                                     if getattr(photo, 'image_%s' % size) and
+                                     (not photo.processing and not photo.render_failed or size == 'untreated')]
         for key in kwargs:
             photo_dict[key] = kwargs[key]
         return photo_dict
 
 
+class PhotoDerivativeCache(object):
+    CACHE_KEY = 'PHOTO_DERIVATIVE'
+    SIZE_KEY = 'PHOTO_DERIVATIVE&SIZE'
+    STATS_KEY = 'PHOTO_DERIVATIVE&STATS'
+    LOCK_KEY = 'PHOTO_DERIVATIVE&LOCK&%s'
+    WIDTH_PATTERN = re.compile(r'^w(\d+)$')
+
+    # KEYS: lock key
+    # ARGV: token the lock was taken with
+    # a lock that expired during the render may be held by another worker by now, only the own one is released
+    UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+    __unlock_script = None
+
+    def __init__(self):
+        self.redis_client = RedisClient()
+        if not PhotoDerivativeCache.__unlock_script:
+            PhotoDerivativeCache.__unlock_script = self.redis_client.script_register(self.UNLOCK_SCRIPT)
+
+    @staticmethod
+    def get_width(size):
+        match = PhotoDerivativeCache.WIDTH_PATTERN.match(size)
+        return int(match.group(1)) if match else None
+
+    def get(self, photo, width, path=None):
+        if width not in PHOTO_DERIVATIVE_WIDTHS or not photo.image_large:
+            return None
+        name = self._get_name(photo=photo, width=width)
+        derivative_path = os.path.join(settings.MEDIA_ROOT, name)
+        if path is not None and os.path.normpath(path) != os.path.normpath(derivative_path):
+            return None
+        if os.path.isfile(derivative_path):
+            self._touch(name=name, path=derivative_path)
+            return derivative_path
+        lock_key = self.LOCK_KEY % name
+        lock_token = uuid.uuid4().hex
+        deadline = time.time() + PHOTO_DERIVATIVE_LOCK_TIMEOUT
+        while not self.redis_client.set(lock_key, lock_token, ex=PHOTO_DERIVATIVE_LOCK_TIMEOUT, nx=True):
+            # another worker is resizing the same image, its file is served once written
+            time.sleep(0.05)
+            if os.path.isfile(derivative_path):
+                self._touch(name=name, path=derivative_path)
+                return derivative_path
+            if time.time() > deadline:
+                return None
+        try:
+            if not os.path.isfile(derivative_path):
+                size = self._render(photo=photo, width=width, path=derivative_path)
+                self._add(name=name, size=size)
+        except IOError:
+            return None
+        finally:
+            self.__unlock_script(keys=[lock_key], args=[lock_token], client=self.redis_client.client)
+        return derivative_path
+
+    def remove(self, photo):
+        if not photo.image_large:
+            return
+        for width in PHOTO_DERIVATIVE_WIDTHS:
+            name = self._get_name(photo=photo, width=width)
+            self._remove(name=name)
+            PhotoService.remove_file(os.path.join(settings.MEDIA_ROOT, name))
+
+    def stats(self):
+        with self.redis_client.pipeline() as pipe:
+            pipe.sorted_set_count(self.CACHE_KEY)
+            pipe.hash_all(self.STATS_KEY)
+        count, stats = pipe.results
+        return {'count': count,
+                'capacity': PHOTO_DERIVATIVE_CACHE_SIZE,
+                'size': int(stats.get('size', 0)),
+                'hit': int(stats.get('hit', 0)),
+                'miss': int(stats.get('miss', 0)),
+                'evict': int(stats.get('evict', 0))}
+
+    @staticmethod
+    def _get_name(photo, width):
+        large_dir, large_name = os.path.split(photo.image_large.name)
+        return '%s/w%d/%s' % (os.path.dirname(large_dir), width, large_name)
+
+    @staticmethod
+    def _render(photo, width, path):
+        try:
+            pil_image = Image.open(photo.image_large.path)
+            pil_format = pil_image.format
+            image_width, image_height = pil_image.size
+            height = max(int(image_height * float(width) / image_width), 1)
+            if width < image_width:
+                if pil_format == 'JPEG':
+                    pil_image.draft(pil_image.mode, (width, height))
+                pil_image = pil_image.resize((width, height), Image.ANTIALIAS)
+        except (IOError, ValueError):
+            # truncated or undecodable sources are reported like missing ones
+            raise IOError
+        if not os.path.isdir(os.path.dirname(path)):
+            with ignored(OSError):
+                os.makedirs(os.path.dirname(path))
+        # written aside and renamed, readers never see a partial file
+        temp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            if pil_format == 'JPEG':
+                pil_image.save(temp_path, format=pil_format, optimize=True, progressive=True)
+            else:
+                pil_image.save(temp_path, format=pil_format)
+            os.rename(temp_path, path)
+        except (IOError, OSError, ValueError):
+            with ignored(OSError):
+                os.remove(temp_path)
+            raise IOError
+        PhotoService.save_variants(pil_image, path, pil_format)
+        return PhotoService.get_files_size(path)
+
+    def _touch(self, name, path):
+        with self.redis_client.pipeline() as pipe:
+            pipe.sorted_set_add(self.CACHE_KEY, time.time(), name)
+            pipe.hash_increase(self.STATS_KEY, 'hit')
+        if pipe.results[0]:
+            # the file outlived its entry, track it again
+            self._add(name=name, size=PhotoService.get_files_size(path), miss=False)
+
+    def _add(self, name, size, miss=True):
+        with self.redis_client.pipeline() as pipe:
+            pipe.sorted_set_add(self.CACHE_KEY, time.time(), name)
+            pipe.hash_set(self.SIZE_KEY, name, size)
+            pipe.hash_increase(self.STATS_KEY, 'size', size)
+            if miss:
+                pipe.hash_increase(self.STATS_KEY, 'miss')
+        total = pipe.results[2]
+        while total > PHOTO_DERIVATIVE_CACHE_SIZE:
+            names = self.redis_client.sorted_set_range(self.CACHE_KEY, 0, PHOTO_DERIVATIVE_EVICT_BATCH - 1,
+                                                       desc=False)
+            if not names:
+                break
+            for evict_name in names:
+                total -= self._remove(name=evict_name, evict=True)
+                PhotoService.remove_file(os.path.join(settings.MEDIA_ROOT, evict_name))
+                if total <= PHOTO_DERIVATIVE_CACHE_SIZE:
+                    break
+
+    def _remove(self, name, evict=False):
+        size = int(self.redis_client.hash_get(self.SIZE_KEY, name) or 0)
+        # only the worker that takes the entry out of the index gives its size back
+        if not self.redis_client.sorted_set_delete(self.CACHE_KEY, name):
+            return 0
+        with self.redis_client.pipeline() as pipe:
+            pipe.hash_delete(self.SIZE_KEY, name)
+            pipe.hash_increase(self.STATS_KEY, 'size', -size)
+            if evict:
+                pipe.hash_increase(self.STATS_KEY, 'evict')
+        return size
+
+
 class PhotoMetadataService(MetadataService):
     METADATA_KEY = 'PHOTO_METADATA'
     LIKE_LIST_KEY = 'PHOTO_LIKE_LIST'
@@ -458,11 +946,5 @@ class PhotoMetadataService(MetadataService):
             user_dict['dislike_users'] = dislike_users
         return metadata, user_dict
 
-    def _set_sql_metadata(self, resource_uuid, metadata):
-        like_list_key, dislike_list_key = self._get_like_list_key(resource_uuid)
-        try:
-            photo = Photo.objects.get(uuid=resource_uuid)
-            self._set_resource_sql_metadata(photo, metadata, like_list_key, dislike_list_key)
-        except Photo.DoesNotExist:
-            self.redis_client.hash_delete(self.METADATA_KEY, resource_uuid)
-            self.redis_client.delete(like_list_key, dislike_list_key)
+    def _get_sql_resources(self, resource_uuids):
+        return Photo.objects.filter(uuid__in=resource_uuids)
@@ -1,3 +1,249 @@
-from django.test import TestCase
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
-# Create your tests here.
+import os
+import json
+import uuid
+from io import BytesIO
+
+from PIL import Image
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.core.management import call_command
+from django.utils.six import StringIO
+
+from blog.account.users.models import User
+from blog.content.photos import services
+from blog.content.photos.models import Photo, PhotoBlob
+from blog.content.photos.services import PhotoService, PhotoDerivativeCache
+from blog.common.base import CompiledPermission
+from blog.common.error import ServiceError
+from blog.common.setting import PermissionName, AuthType
+from blog.common.tests import BlogTestCase, ListVisibilityMixin
+from blog.settings import MEDIA_URL
+
+
+def get_upload(name='photo.png', size=(64, 48)):
+    content = BytesIO()
+    Image.linear_gradient('L').resize(size).convert('RGB').save(content, format='PNG')
+    return SimpleUploadedFile(name, content.getvalue(), content_type='image/png')
+
+
+class PhotoTestCase(BlogTestCase):
+    def setUp(self):
+        super(PhotoTestCase, self).setUp()
+        self.user = User.objects.create(uuid=str(uuid.uuid4()), username='photo_author',
+                                        password='password', nick='photo_author')
+        self.service = PhotoService(auth_type=AuthType.NONE)
+        self.service.uid = self.user.id
+        self.service.permission = CompiledPermission({
+            PermissionName.PHOTO_CREATE: {'state': True, 'major_level': 1000, 'value': -1},
+            PermissionName.PHOTO_LIMIT: {'state': True}
+        })
+
+    def tearDown(self):
+        for photo in Photo.objects.all():
+            photo.delete()
+
+    def _create(self, size=(64, 48)):
+        # photo uuids derive from the description and a time stamp, back to back uploads need distinct descriptions
+        _, data = self.service.create(image=get_upload(size=size), description=str(uuid.uuid4()))
+        return Photo.objects.get(uuid=data['uuid'])
+
+    @staticmethod
+    def _add(author, **kwargs):
+        # a row without files, enough for listing and paging
+        return Photo.objects.create(uuid=str(uuid.uuid4()), author=author, last_editor=author, **kwargs)
+
+
+class PhotoBlobTest(PhotoTestCase):
+    def test_same_upload_shares_blob(self):
+        first, second = self._create(), self._create()
+        self.assertIsNotNone(first.blob_id)
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(PhotoBlob.objects.get(id=first.blob_id).ref_count, 2)
+        self.assertNotEqual(first.image_large.path, second.image_large.path)
+        self.assertEqual(os.stat(first.image_large.path).st_ino, os.stat(second.image_large.path).st_ino)
+
+    def test_delete_keeps_shared_file(self):
+        first, second = self._create(), self._create()
+        blob = PhotoBlob.objects.get(id=first.blob_id)
+        blob_path = os.path.join(settings.MEDIA_ROOT, blob.image_large)
+        first_path, second_path = first.image_large.path, second.image_large.path
+        first.delete()
+        self.assertFalse(os.path.exists(first_path))
+        self.assertTrue(os.path.isfile(second_path))
+        self.assertTrue(os.path.isfile(blob_path))
+        self.assertEqual(PhotoBlob.objects.get(id=blob.id).ref_count, 1)
+        second.delete()
+        self.assertFalse(os.path.exists(second_path))
+        self.assertFalse(os.path.exists(blob_path))
+        self.assertFalse(PhotoBlob.objects.filter(id=blob.id).exists())
+
+    def test_failed_create_releases_blob(self):
+        first = self._create()
+        # the author lookup of the photo paths fails once the blob is acquired
+        self.service.uid = self.user.id + 1
+        with self.assertRaises(User.DoesNotExist):
+            self._create()
+        self.assertEqual(PhotoBlob.objects.get(id=first.blob_id).ref_count, 1)
+
+
+class PhotoRenderTest(PhotoTestCase):
+    def _add_processing(self, content):
+        name = 'photos/%s.png' % uuid.uuid4()
+        path = os.path.join(settings.MEDIA_ROOT, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as source_file:
+            source_file.write(content)
+        return self._add(author=self.user, status=Photo.AUDIT, processing=True, image_large=name)
+
+    def _assert_render_failed(self, photo):
+        photo = Photo.objects.get(id=photo.id)
+        self.assertEqual((photo.processing, photo.render_failed, photo.status), (False, True, Photo.AUDIT))
+        self.assertEqual(PhotoService._photo_to_dict(photo=photo)['ready_sizes'], [])
+
+    def test_render(self):
+        content = BytesIO()
+        Image.linear_gradient('L').resize((64, 48)).save(content, format='PNG')
+        photo = self._add_processing(content.getvalue())
+        PhotoService.render_thumbnails(photo_id=photo.id)
+        photo = Photo.objects.get(id=photo.id)
+        self.assertEqual((photo.processing, photo.render_failed), (False, False))
+        self.assertEqual(PhotoService._photo_to_dict(photo=photo)['ready_sizes'], ['large', 'middle', 'small'])
+
+    def test_undecodable_source(self):
+        photo = self._add_processing(b'not an image')
+        PhotoService.render_thumbnails(photo_id=photo.id)
+        self._assert_render_failed(photo)
+
+    def test_any_render_error(self):
+        get_thumbnails = PhotoService.__dict__['_get_thumbnails']
+        try:
+            for error in (ValueError, ServiceError):
+                def failing_thumbnails(*args):
+                    raise error()
+                PhotoService._get_thumbnails = staticmethod(failing_thumbnails)
+                photo = self._add_processing(b'')
+                PhotoService.render_thumbnails(photo_id=photo.id)
+                self._assert_render_failed(photo)
+        finally:
+            PhotoService._get_thumbnails = get_thumbnails
+
+
+class PhotoVariantTest(BlogTestCase):
+    def test_accept_negotiation(self):
+        path = os.path.join(settings.MEDIA_ROOT, 'photo.png')
+        for file_path in [path] + [variant_path for _, variant_path in PhotoService.get_variant_paths(path)]:
+            with open(file_path, 'wb') as variant_file:
+                variant_file.write(b'photo')
+        webp = (os.path.join(settings.MEDIA_ROOT, 'photo.webp'), 'image/webp')
+        jpeg = (os.path.join(settings.MEDIA_ROOT, 'photo.jpg'), 'image/jpeg')
+        for accept, expected in ((None, jpeg),
+                                 ('image/webp,image/*,*/*;q=0.8', webp),
+                                 ('image/webp;q=0, image/*', jpeg),
+                                 ('image/WEBP; q=0.5', webp),
+                                 ('image/*', jpeg),
+                                 ('image/jpeg;q=0, image/*', (path, None)),
+                                 ('image/png', (path, None)),
+                                 ('image/webp;q=0.0, */*;q=0', (path, None))):
+            self.assertEqual(PhotoService._get_variant(path, accept), expected, accept)
+
+
+class PhotoDerivativeCacheTest(PhotoTestCase):
+    def setUp(self):
+        super(PhotoDerivativeCacheTest, self).setUp()
+        self.cache = PhotoDerivativeCache()
+        self.cache_size = services.PHOTO_DERIVATIVE_CACHE_SIZE
+        self.lock_timeout = services.PHOTO_DERIVATIVE_LOCK_TIMEOUT
+
+    def tearDown(self):
+        services.PHOTO_DERIVATIVE_CACHE_SIZE = self.cache_size
+        services.PHOTO_DERIVATIVE_LOCK_TIMEOUT = self.lock_timeout
+        super(PhotoDerivativeCacheTest, self).tearDown()
+
+    def test_least_recently_used_width_evicted(self):
+        photo = self._create(size=(1200, 900))
+        path_800 = self.cache.get(photo=photo, width=800)
+        path_400 = self.cache.get(photo=photo, width=400)
+        self.assertEqual(self.cache.get(photo=photo, width=800), path_800)
+        services.PHOTO_DERIVATIVE_CACHE_SIZE = self.cache.stats()['size']
+        path_200 = self.cache.get(photo=photo, width=200)
+        self.assertEqual(Image.open(path_200).size, (200, 150))
+        self.assertFalse(os.path.exists(path_400))
+        self.assertTrue(os.path.isfile(path_800))
+        stats = self.cache.stats()
+        self.assertEqual((stats['count'], stats['hit'], stats['miss'], stats['evict']), (2, 1, 3, 1))
+        self.assertLessEqual(stats['size'], services.PHOTO_DERIVATIVE_CACHE_SIZE)
+
+    def test_lock_held_by_another_render(self):
+        photo = self._create()
+        lock_key = PhotoDerivativeCache.LOCK_KEY % PhotoDerivativeCache._get_name(photo=photo, width=400)
+        services.PHOTO_DERIVATIVE_LOCK_TIMEOUT = 1
+        self.cache.redis_client.set(lock_key, 1, ex=10, nx=True)
+        self.assertIsNone(self.cache.get(photo=photo, width=400))
+        self.assertEqual(self.cache.stats()['count'], 0)
+        self.cache.redis_client.delete(lock_key)
+        self.assertTrue(os.path.isfile(self.cache.get(photo=photo, width=400)))
+        self.assertFalse(self.cache.redis_client.exists(lock_key))
+
+    def test_lock_taken_over_during_render(self):
+        photo = self._create()
+        lock_key = PhotoDerivativeCache.LOCK_KEY % PhotoDerivativeCache._get_name(photo=photo, width=400)
+        render = PhotoDerivativeCache._render
+
+        def slow_render(**kwargs):
+            # the lock expired while rendering and another worker took it
+            self.cache.redis_client.set(lock_key, 'other')
+            return render(**kwargs)
+        self.cache._render = slow_render
+        self.assertTrue(os.path.isfile(self.cache.get(photo=photo, width=400)))
+        self.assertEqual(self.cache.redis_client.get(lock_key), 'other')
+
+    def test_path_containment(self):
+        photo = self._create()
+        name = PhotoDerivativeCache._get_name(photo=photo, width=400)
+        self.assertIsNone(self.cache.get(photo=photo, width=300))
+        wrong_path = os.path.join(settings.MEDIA_ROOT, 'photos', 'w400', os.path.basename(name))
+        self.assertIsNone(self.cache.get(photo=photo, width=400, path=wrong_path))
+        self.assertEqual(self.service.show(url=MEDIA_URL + name)[0], 200)
+        outside_path = os.path.join(settings.MEDIA_ROOT, os.path.basename(name))
+        with open(outside_path, 'wb') as outside_file:
+            outside_file.write(b'outside')
+        try:
+            with self.assertRaises(ServiceError):
+                self.service.show(url='%sphotos/../%s' % (MEDIA_URL, os.path.basename(name)))
+        finally:
+            os.remove(outside_path)
+
+    def test_stats_command(self):
+        photo = self._create()
+        self.cache.get(photo=photo, width=200)
+        out = StringIO()
+        call_command('photo_derivative_stats', stdout=out)
+        self.assertEqual(json.loads(out.getvalue()), self.cache.stats())
+
+
+class PhotoListVisibilityTest(ListVisibilityMixin, PhotoTestCase):
+    def setUp(self):
+        super(PhotoListVisibilityTest, self).setUp()
+        other = User.objects.create(uuid=str(uuid.uuid4()), username='photo_other',
+                                    password='password', nick='photo_other')
+        for author in (self.user, other):
+            for status, _ in Photo.STATUS_CHOICES:
+                for privacy, _ in Photo.PRIVACY_CHOICES:
+                    for read_level in (50, 200):
+                        self._add(author=author, status=status, privacy=privacy, read_level=read_level)
+
+    def test_list_matches_get_permission(self):
+        granted = {'state': True, 'major_level': 1000}
+        grant_profiles = [{},
+                          {PermissionName.PHOTO_PRIVACY: granted},
+                          {PermissionName.PHOTO_READ: granted},
+                          {PermissionName.PHOTO_CANCEL: granted, PermissionName.PHOTO_AUDIT: granted},
+                          {PermissionName.PHOTO_PERMISSION: granted}]
+        for grants in grant_profiles:
+            grants[PermissionName.READ_LEVEL] = {'state': True, 'value': 100}
+        self.assert_list_visibility(Photo.objects.all(), 'photos',
+                                    lambda photo: self.service.has_get_permission(photo=photo), grant_profiles)
@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 
 from django.http import QueryDict
-from django.http import HttpResponse, JsonResponse
+from django.http import JsonResponse
+from django.utils.cache import patch_vary_headers
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
 
 from blog.content.photos.services import PhotoService
 from blog.common.message import ErrorMsg
 from blog.common.error import ParamsError
-from blog.common.utils import Response, json_response, request_parser
+from blog.common.utils import Response, json_response, request_parser, file_response, HashUploadHandler
 from blog.common.setting import AuthType
 
 
@@ -17,7 +19,7 @@ def photo_show(request):
     @apiVersion 0.1.0
     @apiName photo_show
     @apiGroup content
-    @apiDescription 获取照片文件
+    @apiDescription 获取照片文件, size为large, middle, small, untreated, 或w{width}按需缩放宽度(限PHOTO_DERIVATIVE_WIDTHS)
     @apiPermission PHOTO_SELECT
     @apiPermission PHOTO_PERMISSION
     @apiPermission PHOTO_PRIVACY
@@ -25,6 +27,8 @@ def photo_show(request):
     @apiPermission PHOTO_CANCEL
     @apiPermission PHOTO_AUDIT
     @apiUse Header
+    @apiHeader {String} [If-None-Match] 上次响应的ETag, 未变化时返回304
+    @apiHeader {String} [If-Modified-Since] 上次响应的Last-Modified, 未变化时返回304
     @apiSuccess {file} file 照片文件
     @apiUse ErrorData
     @apiErrorExample {json} Error-Response:
@@ -34,8 +38,12 @@ def photo_show(request):
     }
     """
     try:
-        code, data = PhotoService(request, auth_type=AuthType.COOKIE).show(request.path)
-        return HttpResponse(data, content_type="image/png")
+        code, data = PhotoService(request, auth_type=AuthType.COOKIE).show(request.path,
+                                                                            accept=request.META.get('HTTP_ACCEPT'))
+        response = file_response(request, data['path'], content_type=data['content_type'], etag=data['etag'],
+                                 last_modified=data['last_modified'], max_age=data['max_age'])
+        patch_vary_headers(response, ('Accept',))
+        return response
     except Exception as e:
         code, data = getattr(e, 'code', 400), \
                      getattr(e, 'message', ErrorMsg.REQUEST_ERROR)
@@ -145,6 +153,7 @@ def photo_list(request):
     @apiUse Header
     @apiParam {number} [page=0] 照片信息列表页码, 页码为0时返回所有数据
     @apiParam {number} [page_size=10] 照片信息列表页长
+    @apiParam {string} [cursor] 照片信息列表游标, 传入时使用游标分页并忽略page参数, 空字符串返回第一页
     @apiParam {string} [album_uuid] 照片所属相册
     @apiParam {number=0, 1} [album_system] 照片所属系统相册类型, Avatar=0, Cover=1
     @apiParam {string} [author_uuid] 照片作者
@@ -156,7 +165,9 @@ def photo_list(request):
     @apiParam {string} [query] 搜索内容，若无搜索字段则全局搜索description, author, album
     @apiParam {string=uuid, description, author, album, status, DjangoFilterParams} [query_field] 搜索字段,
                                                                                                   支持Django filter参数
-    @apiSuccess {String} total 照片信息列表总数
+    @apiSuccess {String} total 照片信息列表总数, 游标分页时不返回
+    @apiSuccess {String} next_cursor 下一页游标, 仅游标分页时返回, 无下一页时为null
+    @apiSuccess {String} prev_cursor 上一页游标, 仅游标分页时返回, 无上一页时为null
     @apiSuccess {String} photos 照片信息列表
     @apiSuccessExample {json} Success-Response:
     HTTP/1.1 200 OK
@@ -209,7 +220,8 @@ def photo_list(request):
         'order_field': str,
         'order': str,
         'query': str,
-        'query_field': str
+        'query_field': str,
+        'cursor': str
     }
     try:
         params_dict = request_parser(data=request.GET, params=params)
@@ -264,6 +276,9 @@ def photo_create(request):
             "image_small": "/media/photos/7357d28a-a611-5efd-ae6e-a550a5b95487.jpeg",
             "image_middle": "/media/photos/7357d28a-a611-5efd-ae6e-a550a5b95487.jpeg",
             "image_untreated": "/media/photos/7357d28a-a611-5efd-ae6e-a550a5b95487.jpg",
+            "processing": false,
+            "render_failed": false,
+            "ready_sizes": ["large", "middle", "small", "untreated"],
             "dislike_count": 0,
             "create_at": "2018-03-20T10:36:19.767Z",
             "like_count": 0,
@@ -288,10 +303,13 @@ def photo_create(request):
         'origin': bool,
         'untreated': bool
     }
+    # uploads are hashed on the way in and spooled to disk, never held in memory whole
+    request.upload_handlers = [HashUploadHandler(request), TemporaryFileUploadHandler(request)]
     try:
         image = request.FILES.get('image')
         params_dict = request_parser(data=request.POST, params=params)
         code, data = PhotoService(request).create(image=image,
+                                                  image_digest=request.upload_digests.get('image'),
                                                   **params_dict)
     except Exception as e:
         code, data = getattr(e, 'code', 400), \
@@ -99,3 +99,22 @@ def section_obj_create(sender, instance, created, **kwargs):
     if created:
         SectionPolicy.objects.create(section=instance)
         SectionPermission.objects.create(section=instance)
+
+
+@receiver(models.signals.post_save, sender=Section, dispatch_uid='models.section_access_save')
+@receiver(models.signals.post_delete, sender=Section, dispatch_uid='models.section_access_delete')
+@receiver(models.signals.post_save, sender=SectionPermission, dispatch_uid='models.section_permission_save')
+@receiver(models.signals.m2m_changed, sender=Section.roles.through, dispatch_uid='models.section_roles_change')
+@receiver(models.signals.m2m_changed, sender=Section.groups.through, dispatch_uid='models.section_groups_change')
+def section_access_change(sender, action=None, **kwargs):
+    if action is None or action.startswith('post_'):
+        from blog.content.sections.services import SectionService
+        SectionService.access_cache.update_version()
+
+
+@receiver(models.signals.m2m_changed, sender=User.groups.through, dispatch_uid='models.user_groups_change')
+@receiver(models.signals.post_delete, sender=Group, dispatch_uid='models.group_delete')
+def user_groups_change(sender, action=None, **kwargs):
+    if action is None or action.startswith('post_'):
+        from blog.content.sections.services import SectionService
+        SectionService.group_cache.update_version()
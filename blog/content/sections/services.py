@@ -10,11 +10,12 @@ from blog.account.roles.models import Role
 from blog.content.albums.models import Album
 from blog.content.photos.models import Photo
 from blog.content.sections.models import Section, SectionPermission
-from blog.common.base import Service, RedisClient
+from blog.common.base import Service, RedisClient, LocalCache
 from blog.common.error import ServiceError
 from blog.common.message import ErrorMsg, AccountErrorMsg, ContentErrorMsg
 from blog.common.utils import paging, str_to_list, model_to_dict
 from blog.common.setting import PermissionName, Setting
+from blog.settings import SECTION_CACHE_SIZE, USER_GROUP_CACHE_SIZE, SECTION_CACHE_CHECK_INTERVAL
 
 
 class SectionService(Service):
@@ -42,6 +43,31 @@ class SectionService(Service):
             self.is_controller = is_owner or is_moderator
             self.is_manager = is_assistant or is_moderator or is_owner
 
+    class SectionAccess(object):
+        __slots__ = ('id', 'status', 'read_level', 'only_roles', 'only_groups',
+                     'role_ids', 'group_ids', 'permission')
+
+        def __init__(self, section):
+            self.id = section.id
+            self.status = section.status
+            self.read_level = section.read_level
+            self.only_roles = section.only_roles
+            self.only_groups = section.only_groups
+            self.role_ids = frozenset(section.roles.values_list('id', flat=True)) \
+                if section.only_roles else frozenset()
+            self.group_ids = frozenset(section.groups.values_list('id', flat=True)) \
+                if section.only_groups else frozenset()
+            self.permission = dict((field, getattr(section.permission, field))
+                                   for field in SectionService.SECTION_PERMISSION_FIELD)
+
+    # per-worker caches, rebuilt through the signals in sections.models
+    access_cache = LocalCache(version_key='SECTION_ACCESS_VERSION',
+                              size=SECTION_CACHE_SIZE,
+                              check_interval=SECTION_CACHE_CHECK_INTERVAL)
+    group_cache = LocalCache(version_key='USER_GROUP_VERSION',
+                             size=USER_GROUP_CACHE_SIZE,
+                             check_interval=SECTION_CACHE_CHECK_INTERVAL)
+
     def get(self, section_name):
         self.has_permission(PermissionName.SECTION_SELECT)
         try:
@@ -181,7 +207,7 @@ class SectionService(Service):
             section = Section.objects.get(name=section_name)
         except Section.DoesNotExist:
             raise ServiceError(code=404, message=ContentErrorMsg.SECTION_NOT_FOUND)
-        set_role = self.is_manager(user_uuid=self.uuid, section=section)
+        set_role = self.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
         if not set_role.is_manager and not op and policy_level.is_lt_lv10():
             raise ServiceError(code=403, message=ErrorMsg.PERMISSION_DENIED)
         permission = section.permission
@@ -208,6 +234,7 @@ class SectionService(Service):
             is_manager_update = True
         if is_manager_update:
             SectionMetadataService().update_manager(section=section)
+            self.cache.pop(('is_manager', self.uuid, section.id), None)
         if status is not None:
             if status != Section.CANCEL and self.has_set_permission(permission.set_status, set_role, op):
                 section.status = SectionService.choices_format(status, Section.STATUS_CHOICES, Section.NORMAL)
@@ -244,7 +271,7 @@ class SectionService(Service):
         try:
             section = Section.objects.get(name=delete_id)
             result['name'], result['status'] = section.nick, 'SUCCESS'
-            set_role = self.is_manager(user_uuid=self.uuid, section=section)
+            set_role = self.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
             permission = section.permission
             if force:
                 if self.has_set_permission(permission.delete_permission, set_role, delete_level.is_gt_lv10()):
@@ -266,9 +293,10 @@ class SectionService(Service):
 
     def has_get_permission(self, section):
         get_level, read_level = self.get_permission_level(PermissionName.SECTION_PERMISSION, False)
-        set_role = self.is_manager(user_uuid=self.uuid, section=section)
-        if section.status == Section.CANCEL:
-            cancel_visible = section.permission.cancel_visible
+        set_role = self.is_manager(user_uuid=self.uuid, section=section, cache=self.cache)
+        access = SectionService.get_section_access(section=section)
+        if access.status == Section.CANCEL:
+            cancel_visible = access.permission['cancel_visible']
             if SectionService.has_set_permission(permission=cancel_visible,
                                                  set_role=set_role):
                 return True, True
@@ -282,21 +310,37 @@ class SectionService(Service):
             return True, read_level.is_gt_lv9()
         else:
             not_in_roles, not_in_groups = True, True
-            if section.only_roles:
-                not_in_roles = len(section.roles.filter(id=self.role_id)) == 0
-            if not_in_roles and section.only_groups:
-                section_groups = section.groups.values('id').all()
-                user_groups = User.objects.get(uuid=self.uuid).groups.values('id').all()
-                not_in_groups = len(set(section_groups) & set(user_groups)) == 0
-            if (section.only_roles or section.only_groups) and \
+            if access.only_roles:
+                not_in_roles = self.role_id not in access.role_ids
+            if not_in_roles and access.only_groups:
+                user_group_ids = SectionService.group_cache.get(self.uuid, SectionService._get_user_group_ids)
+                not_in_groups = access.group_ids.isdisjoint(user_group_ids)
+            if (access.only_roles or access.only_groups) and \
                     not_in_roles and not_in_groups:
-                return section.status != Section.HIDE, False
+                return access.status != Section.HIDE, False
             else:
                 read_value = self.get_permission_value(PermissionName.READ_LEVEL)
-                if section.read_level > read_value:
-                    return section.status != Section.HIDE, False
+                if access.read_level > read_value:
+                    return access.status != Section.HIDE, False
         return True, True
 
+    @staticmethod
+    def get_section_access(section):
+        return SectionService.access_cache.get(section.id, SectionService._get_section_access) or \
+            SectionService.SectionAccess(section)
+
+    @staticmethod
+    def _get_section_access(section_id):
+        try:
+            section = Section.objects.select_related('permission').get(id=section_id)
+        except Section.DoesNotExist:
+            return None
+        return SectionService.SectionAccess(section)
+
+    @staticmethod
+    def _get_user_group_ids(user_uuid):
+        return frozenset(Group.objects.filter(user__uuid=user_uuid).values_list('id', flat=True))
+
     @staticmethod
     def has_set_permission(permission, set_role, op=False):
         if op or permission == SectionPermission.OWNER and set_role.is_owner or \
@@ -306,8 +350,31 @@ class SectionService(Service):
         return False
 
     @staticmethod
-    def is_manager(user_uuid, section):
+    def is_manager(user_uuid, section, cache=None):
+        cache_key = ('is_manager', user_uuid, section.id)
+        if cache is not None and cache_key in cache:
+            return cache[cache_key]
         manager = SectionMetadataService().get_manager(section=section)
+        set_role = SectionService._get_set_role(user_uuid=user_uuid, manager=manager)
+        if cache is not None:
+            cache[cache_key] = set_role
+        return set_role
+
+    @staticmethod
+    def is_manager_many(user_uuid, sections, cache=None):
+        # the roles of every section from one Redis round trip, later is_manager calls hit the request memo
+        cache = {} if cache is None else cache
+        missing_sections = [section for section in sections
+                            if ('is_manager', user_uuid, section.id) not in cache]
+        if missing_sections:
+            managers = SectionMetadataService().get_manager_many(sections=missing_sections)
+            for section in missing_sections:
+                cache[('is_manager', user_uuid, section.id)] = \
+                    SectionService._get_set_role(user_uuid=user_uuid, manager=managers[section.id])
+        return dict((section.id, cache[('is_manager', user_uuid, section.id)]) for section in sections)
+
+    @staticmethod
+    def _get_set_role(user_uuid, manager):
         is_owner = True if user_uuid == manager.owner_uuid else False
         is_moderator = True if user_uuid in manager.moderator_uuids else False
         is_assistant = True if user_uuid in manager.assistant_uuids else False
@@ -389,13 +456,31 @@ class SectionMetadataService(object):
 
     def get_manager(self, section):
         owner_key, moderator_key, assistant_key = self._get_manager_key(section.id)
-        owner_uuid = self.redis_client.get(name=owner_key)
-        moderator_uuids = self.redis_client.set_all(name=moderator_key)
-        assistant_uuids = self.redis_client.set_all(name=assistant_key)
+        with self.redis_client.pipeline() as pipe:
+            pipe.get(name=owner_key)
+            pipe.set_all(name=moderator_key)
+            pipe.set_all(name=assistant_key)
+        owner_uuid, moderator_uuids, assistant_uuids = pipe.results
         if not owner_uuid:
             return self.update_manager(section=section)
         return self.Manager(owner_uuid, moderator_uuids, assistant_uuids)
 
+    def get_manager_many(self, sections):
+        with self.redis_client.pipeline() as pipe:
+            for section in sections:
+                owner_key, moderator_key, assistant_key = self._get_manager_key(section.id)
+                pipe.get(name=owner_key)
+                pipe.set_all(name=moderator_key)
+                pipe.set_all(name=assistant_key)
+        managers = {}
+        for index, section in enumerate(sections):
+            owner_uuid, moderator_uuids, assistant_uuids = pipe.results[index * 3:index * 3 + 3]
+            if owner_uuid:
+                managers[section.id] = self.Manager(owner_uuid, moderator_uuids, assistant_uuids)
+            else:
+                managers[section.id] = self.update_manager(section=section)
+        return managers
+
     def update_manager(self, section):
         owner_uuid = section.owner.uuid
         moderators = section.moderators.all()
@@ -412,12 +497,13 @@ class SectionMetadataService(object):
 
     def _set_redis_manager(self, section, manager):
         owner_key, moderator_key, assistant_key = self._get_manager_key(section.id)
-        self.redis_client.delete(moderator_key, assistant_key)
-        self.redis_client.set(name=owner_key, value=manager.owner_uuid)
-        if manager.moderator_uuids:
-            self.redis_client.set_add(moderator_key, *manager.moderator_uuids)
-        if manager.assistant_uuids:
-            self.redis_client.set_add(assistant_key, *manager.assistant_uuids)
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(moderator_key, assistant_key)
+            pipe.set(name=owner_key, value=manager.owner_uuid)
+            if manager.moderator_uuids:
+                pipe.set_add(moderator_key, *manager.moderator_uuids)
+            if manager.assistant_uuids:
+                pipe.set_add(assistant_key, *manager.assistant_uuids)
 
     def _get_manager_key(self, section_id):
         owner_key = '%s&%s' % (self.OWNER_KEY, section_id)
@@ -7,7 +7,7 @@ from celery.schedules import crontab
 from blog.content.albums.services import AlbumMetadataService
 from blog.content.articles.services import ArticleMetadataService
 from blog.content.comments.services import CommentMetadataService
-from blog.content.photos.services import PhotoMetadataService
+from blog.content.photos.services import PhotoService, PhotoMetadataService
 from blog.wechat.common.base import AccessService
 
 
@@ -19,6 +19,19 @@ def sync_redis_task():
     AlbumMetadataService().sync_metadata()
 
 
+@task(name='evict_redis')
+def evict_redis_task():
+    ArticleMetadataService().evict_metadata()
+    CommentMetadataService().evict_metadata()
+    PhotoMetadataService().evict_metadata()
+    AlbumMetadataService().evict_metadata()
+
+
+@task(name='photo_thumbnail')
+def photo_thumbnail_task(photo_id, origin=False, blob_digest=None):
+    PhotoService.render_thumbnails(photo_id=photo_id, origin=origin, blob_digest=blob_digest)
+
+
 @task(name='wechat_access_token')
 def update_access_token_task():
     AccessService.update_access_token()
@@ -65,6 +65,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'blog.common.middleware.ServerTimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     # 'django.middleware.csrf.CsrfViewMiddleware',
@@ -109,6 +110,26 @@ STATIC_URL = '/static/'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'data').replace('\\', '/')
 MEDIA_URL = '/media/'
+# Internal redirect header handing media transfers to the front proxy, e.g. 'X-Accel-Redirect' for nginx
+# or 'X-Sendfile' for apache, None streams the file from the worker
+MEDIA_SENDFILE_HEADER = None
+# Internal location the proxy maps onto MEDIA_ROOT, only used by X-Accel-Redirect
+MEDIA_SENDFILE_PREFIX = '/protected/'
+# Emit webp and progressive jpeg siblings of rendered photos, photo_show picks one by the Accept header,
+# the jpeg sibling is only written for sources without transparency
+PHOTO_VARIANTS = True
+PHOTO_VARIANT_QUALITY = 80
+# Widths served on demand under /media/photos/<author>/w<width>/, resized from the large image
+PHOTO_DERIVATIVE_WIDTHS = (200, 400, 800, 1200)
+# Disk budget (bytes) of the resized photos, least recently used ones are removed beyond it
+PHOTO_DERIVATIVE_CACHE_SIZE = 1024 * 1024 * 1024
+PHOTO_DERIVATIVE_EVICT_BATCH = 100
+# Seconds a resize may hold its lock, concurrent requests for the same width wait at most this long
+PHOTO_DERIVATIVE_LOCK_TIMEOUT = 30
+# Chunk size (bytes) of files streamed from the worker
+FILE_CHUNK_SIZE = 64 * 1024
+# Browser cache lifetime (seconds) of public active photos, everything else is revalidated on each use
+PHOTO_CACHE_MAX_AGE = 30 * 24 * 3600
 
 APPEND_SLASH = False
 
@@ -117,14 +138,49 @@ HEADER_KEY = 'Auth-Token'
 TOKEN_COOKIE_KEY = 'BLOG-TOKEN'
 TOKEN_URL_KEY = 'ticket'
 TOKEN_HEADER_KEY = 'HTTP_%s' % HEADER_KEY.replace('-', '_').upper()
+# Issue HMAC signed tokens, verified without touching the cached session on every request
+TOKEN_SIGNED = False
+TOKEN_SIGN_KEY = SECRET_KEY
+# Fraction of the token lifetime, the cached session is refreshed once less than this remains
+TOKEN_REFRESH_WINDOW = 0.9
+# Sessions of signed tokens cached per worker, revocations reach every worker within the interval (seconds)
+TOKEN_SESSION_CACHE_SIZE = 4096
+TOKEN_SESSION_CHECK_INTERVAL = 1
+# Revoked sessions remembered for the other workers, a worker lagging further behind empties its cache
+TOKEN_SESSION_REVOKE_SIZE = 10000
 
 # Redis
 REDIS_HOSTS = '127.0.0.1'
 REDIS_PASSWORD = 'qwer4321'
+REDIS_DB = 0
+# Database the test suites switch to, every test empties it, never share it with a site
+REDIS_TEST_DB = 15
 
 # Memcached
 MEMCACHED_HOSTS = ['127.0.0.1:11211']
 
+# Server settings are revalidated against Redis at most once per interval (seconds)
+SETTING_CHECK_INTERVAL = 1
+
+# Role permissions cached per worker, revalidated against Redis at most once per interval (seconds)
+PERMISSION_CACHE_SIZE = 64
+PERMISSION_CACHE_CHECK_INTERVAL = 1
+
+# Render photo thumbnails in the photo_thumbnail celery task instead of the upload request
+PHOTO_THUMBNAIL_ASYNC = False
+
+# Section access descriptors and user group ids cached per worker
+SECTION_CACHE_SIZE = 1024
+USER_GROUP_CACHE_SIZE = 4096
+SECTION_CACHE_CHECK_INTERVAL = 1
+
+# Metadata sync
+METADATA_SYNC_BATCH_SIZE = 500
+METADATA_SYNC_MAX_BATCHES = 100
+METADATA_EVICT_SCAN_COUNT = 1000
+# Cached counters read by list endpoints get their time stamp refreshed at most once per interval (seconds)
+METADATA_TOUCH_INTERVAL = 600
+
 # Celery
 djcelery.setup_loader()
 
@@ -156,6 +212,12 @@ CELERYBEAT_SCHEDULE = {
         "args": (),
         "enabled": True
     },
+    'evict_redis': {
+        "task": "evict_redis",
+        "schedule": crontab(minute=0),
+        "args": (),
+        "enabled": True
+    },
     'wechat_access_token': {
         "task": "wechat_access_token",
         "schedule": crontab(minute='*/90'),